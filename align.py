@@ -22,6 +22,10 @@ parser.add_argument(
         '--disfluency', dest='disfluency', action='store_true',
         help='include disfluencies (uh, um) in alignment')
 parser.set_defaults(disfluency=False)
+parser.add_argument(
+        '--hierarchical', dest='hierarchical', action='store_true',
+        help='align long (book-length) inputs in independent segments')
+parser.set_defaults(hierarchical=False)
 parser.add_argument(
         '--log', default="INFO",
         help='the log level (DEBUG, INFO, WARNING, ERROR, or CRITICAL)')
@@ -49,12 +53,16 @@ with open(args.txtfile, encoding="utf-8") as fh:
 resources = gentle.Resources()
 logging.info("converting audio to 8K sampled wav")
 
-with gentle.resampled(args.audiofile) as wavfile:
+# Alignment starts on the audio converted so far
+with gentle.streamed(args.audiofile) as audio:
     logging.info("starting alignment")
-    aligner = gentle.ForcedAligner(resources, transcript, nthreads=args.nthreads, disfluency=args.disfluency, conservative=args.conservative, disfluencies=disfluencies)
-    result = aligner.transcribe(wavfile, progress_cb=on_progress, logging=logging)
+    if args.hierarchical:
+        aligner = gentle.HierarchicalAligner(resources, transcript, nthreads=args.nthreads, disfluency=args.disfluency, conservative=args.conservative, disfluencies=disfluencies)
+    else:
+        aligner = gentle.ForcedAligner(resources, transcript, nthreads=args.nthreads, disfluency=args.disfluency, conservative=args.conservative, disfluencies=disfluencies)
+    result = aligner.transcribe(audio, progress_cb=on_progress, logging=logging)
 
 fh = open(args.output, 'w', encoding="utf-8") if args.output else sys.stdout
-fh.write(result.to_json(indent=2))
+result.write(json_file=fh)
 if args.output:
     logging.info("output written to %s" % (args.output))
@@ -10,6 +10,16 @@
 #include "lat/word-align-lattice.h"
 #include "nnet3/decodable-simple-looped.h"
 
+#include <fcntl.h>
+#include <map>
+#include <memory>
+#include <mutex>
+#include <sstream>
+#include <thread>
+#include <sys/mman.h>
+#include <sys/stat.h>
+#include <unistd.h>
+
 #ifdef HAVE_CUDA
 #include "cudamatrix/cu-device.h"
 #endif
@@ -69,129 +79,374 @@ void ConfigDecoding(kaldi::LatticeFasterDecoderConfig& config) {
 void ConfigEndpoint(kaldi::OnlineEndpointConfig& config) {
   config.silence_phones = "1:2:3:4:5:6:7:8:9:10:11:12:13:14:15:16:17:18:19:20";
 }
+// Word-level alignment of a decoded utterance (see CompactLatticeToWordProns)
+struct WordProns {
+  std::vector<int32> words, times, lengths;
+  std::vector<std::vector<int32> > prons;
+  std::vector<std::vector<int32> > phone_lengths;
+};
+
+void WriteResultText(FILE *out, const WordProns &result,
+                     const fst::SymbolTable &word_syms,
+                     const fst::SymbolTable &phone_syms,
+                     kaldi::BaseFloat frame_shift) {
+  for (size_t i = 0; i < result.words.size(); i++) {
+    if(result.words[i] == 0) {
+      // <eps> links - silence
+      continue;
+    }
+    fprintf(out, "word: %s / start: %f / duration: %f\n",
+            word_syms.Find(result.words[i]).c_str(),
+            result.times[i] * frame_shift,
+            result.lengths[i] * frame_shift);
+    // Print out the phonemes for this word
+    for(size_t j=0; j<result.phone_lengths[i].size(); j++) {
+      fprintf(out, "phone: %s / duration: %f\n",
+              phone_syms.Find(result.prons[i][j]).c_str(),
+              result.phone_lengths[i][j] * frame_shift);
+    }
+  }
+
+  fprintf(out, "done with words\n");
+}
+
+// Writes a length-prefixed reply, in the format read by
+// rpc.RPCProtocol.read_reply
+void WriteReply(FILE *out, int status, const std::string &body) {
+  fprintf(out, "%zu\n%d\n", body.size() + 4, status);
+  fwrite(body.data(), 1, body.size(), out);
+  fprintf(out, "\n");
+}
+
+template<typename T>
+void AppendRaw(std::string *buf, const T &value) {
+  buf->append(reinterpret_cast<const char*>(&value), sizeof(T));
+}
+
+// Writes the result as a single length-prefixed reply (the format read by
+// rpc.RPCProtocol.read_reply).  The body is, in native byte order:
+//
+//   uint32 num_words, uint32 num_phones, float32 frame_shift
+//   int32 word_start[num_words], int32 word_length[num_words]
+//   int32 word_num_phones[num_words]
+//   int32 phone_length[num_phones]
+//   num_words word labels then num_phones phone labels, NUL-terminated
+//
+// Times and durations are in frames.
+void WriteResultFrame(FILE *out, const WordProns &result,
+                      const fst::SymbolTable &word_syms,
+                      const fst::SymbolTable &phone_syms,
+                      kaldi::BaseFloat frame_shift) {
+  std::vector<size_t> kept;
+  uint32_t num_phones = 0;
+  for (size_t i = 0; i < result.words.size(); i++) {
+    if(result.words[i] == 0) {
+      // <eps> links - silence
+      continue;
+    }
+    kept.push_back(i);
+    num_phones += result.phone_lengths[i].size();
+  }
+
+  std::string body;
+  AppendRaw(&body, static_cast<uint32_t>(kept.size()));
+  AppendRaw(&body, num_phones);
+  AppendRaw(&body, static_cast<float>(frame_shift));
+  for (size_t k = 0; k < kept.size(); k++) {
+    AppendRaw(&body, static_cast<int32_t>(result.times[kept[k]]));
+  }
+  for (size_t k = 0; k < kept.size(); k++) {
+    AppendRaw(&body, static_cast<int32_t>(result.lengths[kept[k]]));
+  }
+  for (size_t k = 0; k < kept.size(); k++) {
+    AppendRaw(&body, static_cast<int32_t>(result.phone_lengths[kept[k]].size()));
+  }
+  for (size_t k = 0; k < kept.size(); k++) {
+    const std::vector<int32> &lengths = result.phone_lengths[kept[k]];
+    for (size_t j = 0; j < lengths.size(); j++) {
+      AppendRaw(&body, static_cast<int32_t>(lengths[j]));
+    }
+  }
+  for (size_t k = 0; k < kept.size(); k++) {
+    body.append(word_syms.Find(result.words[kept[k]]));
+    body.push_back('\0');
+  }
+  for (size_t k = 0; k < kept.size(); k++) {
+    const std::vector<int32> &prons = result.prons[kept[k]];
+    for (size_t j = 0; j < prons.size(); j++) {
+      body.append(phone_syms.Find(prons[j]));
+      body.push_back('\0');
+    }
+  }
+
+  WriteReply(out, 200, body);
+}
+
+// Read-only mapping of the audio file that "push-region" commands refer
+// to.  It is kept between commands and remapped when the path changes or
+// the file has grown.
+class MappedAudio {
+ public:
+  MappedAudio(): data_(NULL), size_(0) { }
+  ~MappedAudio() { Unmap(); }
+
+  // Returns a pointer to `len` bytes at `offset` of `path`, or NULL
+  const char *Get(const std::string &path, size_t offset, size_t len) {
+    if(path != path_ || offset + len > size_) {
+      Unmap();
+      int fd = open(path.c_str(), O_RDONLY);
+      if(fd < 0) {
+        return NULL;
+      }
+      struct stat st;
+      if(fstat(fd, &st) == 0 && st.st_size > 0) {
+        void *addr = mmap(NULL, st.st_size, PROT_READ, MAP_SHARED, fd, 0);
+        if(addr != MAP_FAILED) {
+          data_ = static_cast<const char*>(addr);
+          size_ = st.st_size;
+          path_ = path;
+        }
+      }
+      close(fd);
+    }
+    if(data_ == NULL || offset + len > size_) {
+      return NULL;
+    }
+    return data_ + offset;
+  }
+
+  void Unmap() {
+    if(data_ != NULL) {
+      munmap(const_cast<char*>(data_), size_);
+    }
+    data_ = NULL;
+    size_ = 0;
+    path_.clear();
+  }
+
+ private:
+  std::string path_;
+  const char *data_;
+  size_t size_;
+};
+
 void usage() {
-  fprintf(stderr, "usage: k3 [nnet_dir hclg_path]\n");
+  fprintf(stderr, "usage: k3 [--slot-fds=IN:OUT[,IN:OUT...]] [nnet_dir [hclg_path]]\n");
 }
 
-int main(int argc, char *argv[]) {
-    using namespace kaldi;
-    using namespace fst;
+// Decoding graphs shared by all sessions of the process: sessions that
+// load the same path share one copy, which is freed with its last user.
+class GraphCache {
+ public:
+  std::shared_ptr<const fst::Fst<fst::StdArc> > Get(const std::string &path) {
+    std::lock_guard<std::mutex> lock(mutex_);
+    Sweep();
+    std::shared_ptr<const fst::Fst<fst::StdArc> > graph;
+    GraphMap::iterator it = graphs_.find(path);
+    if(it != graphs_.end()) {
+      graph = it->second.lock();
+    }
+    if(!graph) {
+      graph.reset(fst::ReadFstKaldi(path));
+      graphs_[path] = graph;
+    }
+    return graph;
+  }
 
-    setbuf(stdout, NULL);  
+ private:
+  typedef std::map<std::string, std::weak_ptr<const fst::Fst<fst::StdArc> > > GraphMap;
+
+  // Forgets the graphs that have been freed, so that a long-lived process
+  // going through a graph per job doesn't keep an entry for each
+  void Sweep() {
+    GraphMap::iterator it = graphs_.begin();
+    while(it != graphs_.end()) {
+      if(it->second.expired()) {
+        it = graphs_.erase(it);
+      } else {
+        ++it;
+      }
+    }
+  }
 
-    std::string nnet_dir = "exp/tdnn_7b_chain_online";
-    std::string graph_dir = nnet_dir + "/graph_pp";
-    std::string fst_rxfilename = graph_dir + "/HCLG.fst";
-    
-    if(argc == 3) {
-      nnet_dir = argv[1];
-      graph_dir = nnet_dir + "/graph_pp";
-      fst_rxfilename = argv[2];
+  std::mutex mutex_;
+  GraphMap graphs_;
+};
+
+// Read-only state loaded once per process and shared by every session
+struct Models {
+  kaldi::OnlineNnet2FeaturePipelineInfo feature_info;
+  kaldi::LatticeFasterDecoderConfig nnet3_decoding_config;
+  kaldi::OnlineEndpointConfig endpoint_config;
+  kaldi::TransitionModel trans_model;
+  kaldi::nnet3::AmNnetSimple am_nnet;
+  kaldi::nnet3::DecodableNnetSimpleLoopedInfo *de_nnet_simple_looped_info;
+  kaldi::WordBoundaryInfo *word_boundary_info;
+  fst::SymbolTable *word_syms;
+  fst::SymbolTable *phone_syms;
+  kaldi::BaseFloat frame_shift;
+  GraphCache graphs;
+};
+
+// One decoder, driven by commands read from `in` with replies on `out`
+class Session {
+ public:
+  Session(Models &models, FILE *in, FILE *out):
+      m_(models), in_(in), out_(out),
+      feature_pipeline_(new kaldi::OnlineNnet2FeaturePipeline(models.feature_info)),
+      silence_weighting_(models.trans_model,
+                         models.feature_info.silence_weighting_config),
+      decoder_(NULL) {
+    kaldi::OnlineIvectorExtractorAdaptationState adaptation_state(
+        models.feature_info.ivector_extractor_info);
+    feature_pipeline_->SetAdaptationState(adaptation_state);
+  }
+
+  ~Session() {
+    delete decoder_;
+    delete feature_pipeline_;
+  }
+
+  bool LoadGraph(const std::string &path) {
+    std::shared_ptr<const fst::Fst<fst::StdArc> > graph;
+    try {
+      graph = m_.graphs.Get(path);
+    } catch(const std::exception &e) {
+      fprintf(stderr, "could not load graph %s: %s\n", path.c_str(), e.what());
     }
-    else if(argc != 1) {
-      usage();
-      return EXIT_FAILURE;
+    if(!graph) {
+      return false;
     }
-	
-#ifdef HAVE_CUDA
-    fprintf(stdout, "Cuda enabled\n");
-    CuDevice &cu_device = CuDevice::Instantiate();
-    cu_device.SetVerbose(true);
-    cu_device.SelectGpuId("yes");
-    fprintf(stdout, "active gpu: %d\n", cu_device.ActiveGpuId());
-#endif
-    const std::string ivector_model_dir = nnet_dir + "/ivector_extractor";
-    const std::string nnet3_rxfilename = nnet_dir + "/final.mdl";
-    
-    const std::string word_syms_rxfilename = graph_dir + "/words.txt";
-    const string word_boundary_filename = graph_dir + "/phones/word_boundary.int";
-    const string phone_syms_rxfilename = graph_dir + "/phones.txt";
+    delete decoder_;
+    decoder_ = NULL;
+    decode_fst_ = graph;
+    Reset();
+    return true;
+  }
 
-    WordBoundaryInfoNewOpts opts; // use default opts
-    WordBoundaryInfo word_boundary_info(opts, word_boundary_filename);
-
-    OnlineNnet2FeaturePipelineInfo feature_info;
-    ConfigFeatureInfo(feature_info, ivector_model_dir);
-    LatticeFasterDecoderConfig nnet3_decoding_config;
-    ConfigDecoding(nnet3_decoding_config);
-    OnlineEndpointConfig endpoint_config;
-    ConfigEndpoint(endpoint_config);
-    
+  // Loads the initial graph (if any) and tells the client whether the
+  // session is ready for commands
+  bool Start(const std::string &fst_rxfilename) {
+    if(!fst_rxfilename.empty() && !LoadGraph(fst_rxfilename)) {
+      WriteReply(out_, 500, "could not load graph " + fst_rxfilename);
+      return false;
+    }
+    WriteReply(out_, 200, "loaded");
+    return true;
+  }
 
-    BaseFloat frame_shift = feature_info.FrameShiftInSeconds();
+  void Run();
+
+ private:
+  // The decoder is rebuilt whenever the graph changes, so that a
+  // long-lived process can switch transcripts without reloading the
+  // acoustic model.
+  void Reset() {
+    delete decoder_;
+    decoder_ = NULL;
+
+    delete feature_pipeline_;
+    feature_pipeline_ = new kaldi::OnlineNnet2FeaturePipeline(m_.feature_info);
+
+    if(decode_fst_) {
+      decoder_ = new kaldi::SingleUtteranceNnet3Decoder(m_.nnet3_decoding_config,
+                                                        m_.trans_model,
+                                                        *m_.de_nnet_simple_looped_info,
+                                                        //am_nnet, // kaldi::nnet3::DecodableNnetSimpleLoopedInfo
+                                                        *decode_fst_,
+                                                        feature_pipeline_);
+    }
+  }
 
-    TransitionModel trans_model;
-    nnet3::AmNnetSimple am_nnet;
-    {
-      bool binary;
-      Input ki(nnet3_rxfilename, &binary);
-      trans_model.Read(ki.Stream(), binary);
-      am_nnet.Read(ki.Stream(), binary);
+  // Feeds audio to the decoder; false if no graph has been loaded
+  bool AcceptWaveform(const kaldi::Vector<kaldi::BaseFloat> &wave_part) {
+    if(decoder_ == NULL) {
+      return false;
     }
 
-    nnet3::NnetSimpleLoopedComputationOptions nnet_simple_looped_opts;
-    nnet_simple_looped_opts.acoustic_scale = 1.0; // changed from 0.1?
+    feature_pipeline_->AcceptWaveform(arate, wave_part);
 
-    nnet3::DecodableNnetSimpleLoopedInfo de_nnet_simple_looped_info(nnet_simple_looped_opts, &am_nnet);
-    
-    fst::Fst<fst::StdArc> *decode_fst = ReadFstKaldi(fst_rxfilename);
+    std::vector<std::pair<kaldi::int32, kaldi::BaseFloat> > delta_weights;
+    if (silence_weighting_.Active()) {
+      silence_weighting_.ComputeCurrentTraceback(decoder_->Decoder());
+      silence_weighting_.GetDeltaWeights(feature_pipeline_->NumFramesReady(),
+                                         &delta_weights);
+      feature_pipeline_->IvectorFeature()->UpdateFrameWeights(delta_weights);
+    }
 
-    fst::SymbolTable *word_syms =
-      fst::SymbolTable::ReadText(word_syms_rxfilename);
+    decoder_->AdvanceDecoding();
+    return true;
+  }
 
-    fst::SymbolTable* phone_syms =
-      fst::SymbolTable::ReadText(phone_syms_rxfilename);
-    
-    
-    OnlineIvectorExtractorAdaptationState adaptation_state(feature_info.ivector_extractor_info);
+  // Word/phone alignment of the best path so far
+  void BestPath(bool end_of_utterance, WordProns *result) {
+    using namespace kaldi;
+
+    Lattice lat;
+    decoder_->GetBestPath(end_of_utterance, &lat);
+    CompactLattice clat;
+    ConvertLattice(lat, &clat);
+
+    // Compute prons alignment (see: kaldi/latbin/nbest-to-prons.cc)
+    CompactLattice aligned_clat;
 
-    OnlineNnet2FeaturePipeline feature_pipeline(feature_info);
-    feature_pipeline.SetAdaptationState(adaptation_state);
+    WordAlignLattice(clat, m_.trans_model, *m_.word_boundary_info,
+                     0, &aligned_clat);
+
+    if(!CompactLatticeToWordProns(m_.trans_model, aligned_clat, &result->words,
+                                  &result->times, &result->lengths,
+                                  &result->prons, &result->phone_lengths)) {
+      *result = WordProns();
+    }
+  }
 
-    OnlineSilenceWeighting silence_weighting(
-                                             trans_model,
-                                             feature_info.silence_weighting_config);
-        
-    SingleUtteranceNnet3Decoder decoder(nnet3_decoding_config,
-                                        trans_model,
-					de_nnet_simple_looped_info,
-                                        //am_nnet, // kaldi::nnet3::DecodableNnetSimpleLoopedInfo
-                                        *decode_fst,
-                                        &feature_pipeline);
+  Models &m_;
+  FILE *in_;
+  FILE *out_;
+  std::shared_ptr<const fst::Fst<fst::StdArc> > decode_fst_;
+  kaldi::OnlineNnet2FeaturePipeline *feature_pipeline_;
+  kaldi::OnlineSilenceWeighting silence_weighting_;
+  kaldi::SingleUtteranceNnet3Decoder *decoder_;
+  MappedAudio mapped_audio_;
+};
 
+void Session::Run() {
+  using namespace kaldi;
 
   char cmd[1024];
 
   while(true) {
     // Let the client decide what we should do...
-    fgets(cmd, sizeof(cmd), stdin);
+    if(fgets(cmd, sizeof(cmd), in_) == NULL) {
+      break;
+    }
 
     if(strcmp(cmd,"stop\n") == 0) {
       break;
     }
     else if(strcmp(cmd,"reset\n") == 0) {
-      feature_pipeline.~OnlineNnet2FeaturePipeline();
-      new (&feature_pipeline) OnlineNnet2FeaturePipeline(feature_info);
-      
-      decoder.~SingleUtteranceNnet3Decoder();
-      new (&decoder) SingleUtteranceNnet3Decoder(nnet3_decoding_config,
-                                                 trans_model,
-						 de_nnet_simple_looped_info,
-                                                 //am_nnet,
-                                                 *decode_fst,
-                                                 &feature_pipeline);
+      Reset();
+    }
+    else if(strncmp(cmd, "load-graph ", 11) == 0) {
+      // Swap in a new decoding graph, keeping the acoustic model,
+      // ivector extractor and symbol tables that are already loaded.
+      std::string path(cmd + 11);
+      if(!path.empty() && path[path.size() - 1] == '\n') {
+        path.erase(path.size() - 1);
+      }
+      fprintf(out_, LoadGraph(path) ? "ok\n" : "error\n");
     }
     else if(strcmp(cmd,"push-chunk\n") == 0) {
 
       // Get chunk length from python
       int chunk_len;
-      fgets(cmd, sizeof(cmd), stdin);
+      fgets(cmd, sizeof(cmd), in_);
       sscanf(cmd, "%d\n", &chunk_len);
 
-      int16_t audio_chunk[chunk_len];  
+      std::vector<int16_t> audio_chunk(chunk_len);
       Vector<BaseFloat> wave_part = Vector<BaseFloat>(chunk_len);
       
-      fread(&audio_chunk, 2, chunk_len, stdin);
+      fread(audio_chunk.data(), 2, chunk_len, in_);
       
       // We need to copy this into the `wave_part' Vector<BaseFloat> thing.
       // From `gst-audio-source.cc' in gst-kaldi-nnet2
@@ -199,62 +454,70 @@ int main(int argc, char *argv[]) {
         (wave_part)(i) = static_cast<BaseFloat>(audio_chunk[i]);
       }
 
-      feature_pipeline.AcceptWaveform(arate, wave_part);
+      fprintf(out_, AcceptWaveform(wave_part) ? "ok\n" : "error\n");
+    }
+    else if(strncmp(cmd, "push-region ", 12) == 0) {
+      // "push-region <byte offset> <nsamples> <path>": decode samples
+      // straight from a (shared, memory-mapped) file instead of the pipe
+      long offset = 0;
+      int chunk_len = 0;
+      int path_start = 0;
+      if(sscanf(cmd + 12, "%ld %d %n", &offset, &chunk_len, &path_start) < 2 ||
+         offset < 0 || chunk_len < 0) {
+        fprintf(out_, "error\n");
+        continue;
+      }
+      std::string path(cmd + 12 + path_start);
+      if(!path.empty() && path[path.size() - 1] == '\n') {
+        path.erase(path.size() - 1);
+      }
 
-      std::vector<std::pair<int32, BaseFloat> > delta_weights;
-      if (silence_weighting.Active()) {
-        silence_weighting.ComputeCurrentTraceback(decoder.Decoder());
-        silence_weighting.GetDeltaWeights(feature_pipeline.NumFramesReady(),
-                                          &delta_weights);
-        feature_pipeline.IvectorFeature()->UpdateFrameWeights(delta_weights);
+      const char *samples = mapped_audio_.Get(path, offset, 2 * (size_t)chunk_len);
+      if(samples == NULL) {
+        fprintf(stderr, "cannot read %d samples at %ld of %s\n", chunk_len, offset, path.c_str());
+        fprintf(out_, "error\n");
+        continue;
       }
 
-      decoder.AdvanceDecoding();
+      Vector<BaseFloat> wave_part = Vector<BaseFloat>(chunk_len);
+      for (int i = 0; i < chunk_len ; ++i) {
+        int16_t sample;
+        memcpy(&sample, samples + 2 * i, sizeof(sample));
+        (wave_part)(i) = static_cast<BaseFloat>(sample);
+      }
 
-      fprintf(stdout, "ok\n");
+      fprintf(out_, AcceptWaveform(wave_part) ? "ok\n" : "error\n");
     }
-    else if(strcmp(cmd, "get-final\n") == 0) {
-      feature_pipeline.InputFinished(); // Computes last few frames of input
-      decoder.AdvanceDecoding();        // Decodes remaining frames
-      decoder.FinalizeDecoding();
-
-      Lattice final_lat;
-      decoder.GetBestPath(true, &final_lat);
-      CompactLattice clat;
-      ConvertLattice(final_lat, &clat);      
+    else if(strcmp(cmd, "get-partial\n") == 0) {
+      // Best path through the audio pushed so far, without ending the
+      // utterance.  The last word may still change.
+      WordProns result;
 
-      // Compute prons alignment (see: kaldi/latbin/nbest-to-prons.cc)
-      CompactLattice aligned_clat;
-
-      std::vector<int32> words, times, lengths;
-      std::vector<std::vector<int32> > prons;
-      std::vector<std::vector<int32> > phone_lengths;
+      if(decoder_ != NULL && decoder_->NumFramesDecoded() > 0) {
+        BestPath(false, &result);
+      }
 
-      WordAlignLattice(clat, trans_model, word_boundary_info,
-                       0, &aligned_clat);
+      WriteResultFrame(out_, result, *m_.word_syms, *m_.phone_syms, m_.frame_shift);
+    }
+    else if(strcmp(cmd, "get-final\n") == 0 ||
+            strcmp(cmd, "get-final-frame\n") == 0) {
+      bool framed = strcmp(cmd, "get-final-frame\n") == 0;
+      WordProns result;
 
-      CompactLatticeToWordProns(trans_model, aligned_clat, &words, &times,
-                                &lengths, &prons, &phone_lengths);
+      if(decoder_ != NULL) {
+        feature_pipeline_->InputFinished(); // Computes last few frames of input
+        decoder_->AdvanceDecoding();        // Decodes remaining frames
+        decoder_->FinalizeDecoding();
 
-      for (int i = 0; i < words.size(); i++) {
-        if(words[i] == 0) {
-          // <eps> links - silence
-          continue;
-        }
-        fprintf(stdout, "word: %s / start: %f / duration: %f\n",
-                word_syms->Find(words[i]).c_str(),
-                times[i] * frame_shift,
-                lengths[i] * frame_shift);
-        // Print out the phonemes for this word
-        for(size_t j=0; j<phone_lengths[i].size(); j++) {
-          fprintf(stdout, "phone: %s / duration: %f\n",
-                  phone_syms->Find(prons[i][j]).c_str(),
-                  phone_lengths[i][j] * frame_shift);
-        }
+        BestPath(true, &result);
       }
 
-      fprintf(stdout, "done with words\n");
-      
+      if(framed) {
+        WriteResultFrame(out_, result, *m_.word_syms, *m_.phone_syms, m_.frame_shift);
+      }
+      else {
+        WriteResultText(out_, result, *m_.word_syms, *m_.phone_syms, m_.frame_shift);
+      }
     }
     else {
 
@@ -263,3 +526,124 @@ int main(int argc, char *argv[]) {
     }
   }
 }
+
+int main(int argc, char *argv[]) {
+    using namespace kaldi;
+    using namespace fst;
+
+    setbuf(stdout, NULL);  
+
+    // With --slot-fds, each IN:OUT pair of inherited file descriptors
+    // drives its own decoder on its own thread; all of them share the
+    // acoustic model (and any graph they have in common).
+    std::vector<std::pair<int, int> > slot_fds;
+    if(argc > 1 && strncmp(argv[1], "--slot-fds=", 11) == 0) {
+      std::stringstream spec(argv[1] + 11);
+      std::string pair;
+      while(std::getline(spec, pair, ',')) {
+        int in_fd, out_fd;
+        if(sscanf(pair.c_str(), "%d:%d", &in_fd, &out_fd) != 2) {
+          usage();
+          return EXIT_FAILURE;
+        }
+        slot_fds.push_back(std::make_pair(in_fd, out_fd));
+      }
+      argv++;
+      argc--;
+    }
+
+    std::string nnet_dir = "exp/tdnn_7b_chain_online";
+    std::string graph_dir = nnet_dir + "/graph_pp";
+    std::string fst_rxfilename = graph_dir + "/HCLG.fst";
+    
+    if(argc == 3) {
+      nnet_dir = argv[1];
+      graph_dir = nnet_dir + "/graph_pp";
+      fst_rxfilename = argv[2];
+    }
+    else if(argc == 2) {
+      // Only load the acoustic model; a decoding graph is supplied
+      // later with the "load-graph" command.
+      nnet_dir = argv[1];
+      graph_dir = nnet_dir + "/graph_pp";
+      fst_rxfilename = "";
+    }
+    else if(argc != 1) {
+      usage();
+      return EXIT_FAILURE;
+    }
+	
+#ifdef HAVE_CUDA
+    // (stdout is reserved for replies)
+    fprintf(stderr, "Cuda enabled\n");
+    CuDevice &cu_device = CuDevice::Instantiate();
+    cu_device.SetVerbose(true);
+    cu_device.SelectGpuId("yes");
+    fprintf(stderr, "active gpu: %d\n", cu_device.ActiveGpuId());
+#endif
+    const std::string ivector_model_dir = nnet_dir + "/ivector_extractor";
+    const std::string nnet3_rxfilename = nnet_dir + "/final.mdl";
+    
+    const std::string word_syms_rxfilename = graph_dir + "/words.txt";
+    const string word_boundary_filename = graph_dir + "/phones/word_boundary.int";
+    const string phone_syms_rxfilename = graph_dir + "/phones.txt";
+
+    Models models;
+
+    WordBoundaryInfoNewOpts opts; // use default opts
+    models.word_boundary_info = new WordBoundaryInfo(opts, word_boundary_filename);
+
+    ConfigFeatureInfo(models.feature_info, ivector_model_dir);
+    ConfigDecoding(models.nnet3_decoding_config);
+    ConfigEndpoint(models.endpoint_config);
+
+    models.frame_shift = models.feature_info.FrameShiftInSeconds();
+
+    {
+      bool binary;
+      Input ki(nnet3_rxfilename, &binary);
+      models.trans_model.Read(ki.Stream(), binary);
+      models.am_nnet.Read(ki.Stream(), binary);
+    }
+
+    nnet3::NnetSimpleLoopedComputationOptions nnet_simple_looped_opts;
+    nnet_simple_looped_opts.acoustic_scale = 1.0; // changed from 0.1?
+
+    models.de_nnet_simple_looped_info =
+      new nnet3::DecodableNnetSimpleLoopedInfo(nnet_simple_looped_opts, &models.am_nnet);
+
+    models.word_syms = fst::SymbolTable::ReadText(word_syms_rxfilename);
+    models.phone_syms = fst::SymbolTable::ReadText(phone_syms_rxfilename);
+
+    if(slot_fds.empty()) {
+      Session session(models, stdin, stdout);
+      if(!session.Start(fst_rxfilename)) {
+        return EXIT_FAILURE;
+      }
+      session.Run();
+    }
+    else {
+      std::vector<std::thread> threads;
+      for(size_t i = 0; i < slot_fds.size(); i++) {
+        FILE *in = fdopen(slot_fds[i].first, "r");
+        FILE *out = fdopen(slot_fds[i].second, "w");
+        setbuf(out, NULL);
+        threads.push_back(std::thread([&models, in, out, fst_rxfilename]() {
+          Session session(models, in, out);
+          if(session.Start(fst_rxfilename)) {
+            session.Run();
+          }
+          fclose(in);
+          fclose(out);
+        }));
+      }
+      for(size_t i = 0; i < threads.size(); i++) {
+        threads[i].join();
+      }
+    }
+
+    delete models.de_nnet_simple_looped_info;
+    delete models.word_boundary_info;
+    delete models.word_syms;
+    delete models.phone_syms;
+}
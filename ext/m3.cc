@@ -7,182 +7,307 @@
 #include "util/common-utils.h"
 #include <fst/script/arcsort.h>
 #include <fst/script/compile.h>
+#include <cstring>
 
-int main(int argc, char *argv[]) {
-	using namespace kaldi;
-	using namespace fst;
-	using fst::script::ArcSort;
-	try {
-		const char *usage = "Usage: ./mkgraph [options] <proto-dir> <grammar-fst> <out-fst>\n";
-		
-		ParseOptions po(usage);
-		po.Read(argc, argv);
-		if (po.NumArgs() != 3) {
-			po.PrintUsage();
-			return 1;
-		}
+using namespace kaldi;
+using namespace fst;
+using fst::script::ArcSort;
+
+// Inputs that are the same for every graph built from a proto-dir.
+// A server keeps these in memory between requests.
+struct StaticInputs {
+	const SymbolTable *isyms;
+	const SymbolTable *osyms;
+	VectorFst<StdArc> *lang_disambig_fst;
+	std::vector<int32> disambig_symbols;
+	ContextDependency ctx_dep;
+	TransitionModel trans_model;
+};
+
+bool RequireFile(const std::string &filename) {
+	if (!std::ifstream(filename.c_str())) {
+		std::cerr << "expected " << filename << " to exist" << std::endl;
+		return false;
+	}
+	return true;
+}
 
-		int32 N = 3, P = 1;
-		float transition_scale = 1.0;
-		float self_loop_scale = 0.1;
+bool LoadStaticInputs(const std::string &proto_dir, StaticInputs *in) {
+	std::string lang_fst_filename = proto_dir + "/langdir/L.fst",
+		lang_disambig_fst_filename = proto_dir + "/langdir/L_disambig.fst",
+		disambig_phones_filename = proto_dir + "/langdir/phones/disambig.int",
+		model_filename = proto_dir + "/tdnn_7b_chain_online/final.mdl",
+		tree_filename = proto_dir + "/tdnn_7b_chain_online/tree",
+		words_filename = proto_dir + "/tdnn_7b_chain_online/graph_pp/words.txt";
 
-		std::string proto_dir = po.GetArg(1),
-					grammar_fst_filename = po.GetArg(2),
-					out_filename = po.GetArg(3);
+	if (!RequireFile(lang_fst_filename)) return false;
+	if (!RequireFile(lang_disambig_fst_filename)) return false;
+	if (!RequireFile(disambig_phones_filename)) return false;
+	if (!RequireFile(model_filename)) return false;
+	if (!RequireFile(tree_filename)) return false;
 
-		std::string lang_fst_filename = proto_dir + "/langdir/L.fst",
-			lang_disambig_fst_filename = proto_dir + "/langdir/L_disambig.fst",
-			disambig_phones_filename = proto_dir + "/langdir/phones/disambig.int",
-			model_filename = proto_dir + "/tdnn_7b_chain_online/final.mdl",
-			tree_filename = proto_dir + "/tdnn_7b_chain_online/tree",
-			words_filename = proto_dir + "/tdnn_7b_chain_online/graph_pp/words.txt";
+	fst::SymbolTableTextOptions opts;
+	in->isyms = SymbolTable::ReadText(words_filename, opts);
+	if (!in->isyms) { return false; }
+	in->osyms = SymbolTable::ReadText(words_filename, opts);
+	if (!in->osyms) { return false; }
 
-		if (!std::ifstream(lang_fst_filename.c_str())) {
-			std::cerr << "expected " << lang_fst_filename << " to exist" << std::endl;
-			return 1;
-		}
-		if (!std::ifstream(lang_disambig_fst_filename.c_str())) {
-			std::cerr << "expected " << lang_disambig_fst_filename << " to exist" << std::endl;
-			return 1;
+	in->lang_disambig_fst = ReadFstKaldi(lang_disambig_fst_filename);
+	if (in->lang_disambig_fst->Properties(fst::kOLabelSorted, true) == 0) {
+		KALDI_WARN << "L_disambig.fst is not olabel sorted.";
+	}
+
+	ReadIntegerVectorSimple(disambig_phones_filename, &in->disambig_symbols);
+	if (in->disambig_symbols.empty()) {
+		KALDI_WARN << "Disambiguation symbols list is empty; this likely "
+			<< "indicates an error in data preparation.";
+	}
+
+	ReadKaldiObject(tree_filename, &in->ctx_dep);
+	ReadKaldiObject(model_filename, &in->trans_model);
+	return true;
+}
+
+// Reads a grammar written by language_model.write_bigram_lm_binary.  States
+// are numbered in order of appearance, as FstCompiler does for text input.
+bool ReadBinaryGrammar(std::istream &is, const SymbolTable *syms,
+                       VectorFst<StdArc> *fst) {
+	uint32 num_words, num_arcs, final_state;
+	is.read(reinterpret_cast<char*>(&num_words), sizeof(num_words));
+	is.read(reinterpret_cast<char*>(&num_arcs), sizeof(num_arcs));
+	is.read(reinterpret_cast<char*>(&final_state), sizeof(final_state));
+	if (!is) return false;
+
+	std::vector<int32> word_labels(num_words);
+	std::string word;
+	for (uint32 i = 0; i < num_words; i++) {
+		std::getline(is, word, '\0');
+		int64 label = syms->Find(word);
+		if (label == kNoSymbol) {
+			std::cerr << "word not in symbol table: " << word << std::endl;
+			return false;
 		}
-		if (!std::ifstream(grammar_fst_filename.c_str())) {
-			std::cerr << "expected " << grammar_fst_filename << " to exist" << std::endl;
-			return 1;
+		word_labels[i] = label;
+	}
+
+	std::vector<int32> from(num_arcs), to(num_arcs), labels(num_arcs);
+	std::vector<float> weights(num_arcs);
+	is.read(reinterpret_cast<char*>(from.data()), num_arcs * sizeof(int32));
+	is.read(reinterpret_cast<char*>(to.data()), num_arcs * sizeof(int32));
+	is.read(reinterpret_cast<char*>(labels.data()), num_arcs * sizeof(int32));
+	is.read(reinterpret_cast<char*>(weights.data()), num_arcs * sizeof(float));
+	if (!is) return false;
+
+	std::vector<StdArc::StateId> states;
+	auto state = [&](int32 id) {
+		if (id >= static_cast<int32>(states.size())) {
+			states.resize(id + 1, kNoStateId);
 		}
-		if (!std::ifstream(disambig_phones_filename.c_str())) {
-			std::cerr << "expected " << disambig_phones_filename << " to exist" << std::endl;
-			return 1;
+		if (states[id] == kNoStateId) {
+			states[id] = fst->AddState();
 		}
-		if (!std::ifstream(model_filename.c_str())) {
-			std::cerr << "expected " << model_filename << " to exist" << std::endl;
-			return 1;
+		return states[id];
+	};
+
+	for (uint32 i = 0; i < num_arcs; i++) {
+		if (labels[i] < 0 || labels[i] >= static_cast<int32>(num_words)) {
+			return false;
 		}
-		if (!std::ifstream(tree_filename.c_str())) {
-			std::cerr << "expected " << tree_filename << " to exist" << std::endl;
-			return 1;
+		StdArc::StateId src = state(from[i]);
+		if (i == 0) {
+			fst->SetStart(src);
 		}
+		StdArc::StateId dst = state(to[i]);
+		int32 label = word_labels[labels[i]];
+		fst->AddArc(src, StdArc(label, label, weights[i], dst));
+	}
+	fst->SetFinal(state(final_state), StdArc::Weight::One());
+	return true;
+}
+
+bool MakeGraph(const StaticInputs &in,
+               const std::string &grammar_fst_filename,
+               const std::string &out_filename) {
+	int32 N = 3, P = 1;
+	float transition_scale = 1.0;
+	float self_loop_scale = 0.1;
 
+	if (!RequireFile(grammar_fst_filename)) return false;
+
+	VectorFst<StdArc> grammar_fst;
+	std::ifstream grammar_fst_file(grammar_fst_filename.c_str(), std::ios::binary);
+	char magic[4] = {0};
+	grammar_fst_file.read(magic, sizeof(magic));
+	if (grammar_fst_file && std::memcmp(magic, "GBG1", sizeof(magic)) == 0) {
+		// compact binary grammar
+		if (!ReadBinaryGrammar(grammar_fst_file, in.isyms, &grammar_fst)) {
+			std::cerr << "malformed binary grammar " << grammar_fst_filename << std::endl;
+			return false;
+		}
+	}
+	else {
 		// fstcompile
+		grammar_fst_file.clear();
+		grammar_fst_file.seekg(0);
 		const SymbolTable *ssyms = 0;
-		fst::SymbolTableTextOptions opts;
-		const SymbolTable *isyms = SymbolTable::ReadText(words_filename, opts);
-		if (!isyms) { return 1; }
-		const SymbolTable *osyms = SymbolTable::ReadText(words_filename, opts);
-		if (!osyms) { return 1; }
-		std::ifstream grammar_fst_file(grammar_fst_filename.c_str());
-		FstCompiler<StdArc> fstcompiler(grammar_fst_file, "", isyms,
-			osyms, ssyms,
+		FstCompiler<StdArc> fstcompiler(grammar_fst_file, "", in.isyms,
+			in.osyms, ssyms,
 			false, false,
 			false, false,
 			false);
-		VectorFst<StdArc> grammar_fst = fstcompiler.Fst();
+		grammar_fst = fstcompiler.Fst();
+	}
 
-		// fsttablecompose
-		VectorFst<StdArc> *lang_disambig_fst = ReadFstKaldi(lang_disambig_fst_filename);
-		if (lang_disambig_fst->Properties(fst::kOLabelSorted, true) == 0) {
-			KALDI_WARN << "L_disambig.fst is not olabel sorted.";
+	// fsttablecompose
+	TableComposeOptions table_opts;
+	VectorFst<StdArc> lg_fst;
+	TableCompose(*in.lang_disambig_fst, grammar_fst, &lg_fst, table_opts);
+
+	// fstdeterminizestar --use-log
+	ArcSort(&lg_fst, ILabelCompare<StdArc>());
+	int max_states = -1;
+	bool debug_location = false;
+	DeterminizeStarInLog(&lg_fst, kDelta, &debug_location, max_states);
+
+	// fstminimizeencoded
+	MinimizeEncoded(&lg_fst, kDelta);
+
+	// fstarcsort --sort_type=ilabel
+	ArcSort(&lg_fst, ILabelCompare<StdArc>());
+
+	// fstisstochastic
+	StdArc::Weight min, max;
+	if (!IsStochasticFst(lg_fst, 0.01, &min, &max)) {
+		std::cerr << "[info]: LG not stochastic." << std::endl;
+	}
+
+	// fstcomposecontext
+	std::vector<std::vector<int32> > ilabels;
+	VectorFst<StdArc> clg_fst;
+	ComposeContext(in.disambig_symbols, N, P, &lg_fst, &clg_fst, &ilabels);
+
+	// fstarcsort --sort_type=ilabel
+	ArcSort(&clg_fst, ILabelCompare<StdArc>());
+
+	// fstisstochastic
+	if (!IsStochasticFst(clg_fst, 0.01, &min, &max)) {
+		std::cerr << "[info]: CLG not stochastic." << std::endl;
+	}
+
+	// make-h-transducer
+	HTransducerConfig hcfg;
+	hcfg.transition_scale = transition_scale;
+	std::vector<int32> disambig_tid;
+	fst::VectorFst<fst::StdArc> *ha_fst = GetHTransducer(
+		ilabels,
+		in.ctx_dep,
+		in.trans_model,
+		hcfg,
+		&disambig_tid);
+
+	// fsttablecompose
+	VectorFst<StdArc> hclga_fst;
+	TableComposeOptions hclga_table_opts;
+	TableCompose(*ha_fst, clg_fst, &hclga_fst, hclga_table_opts);
+	delete ha_fst;
+
+	// fstdeterminizestar --use-log=true
+	ArcSort(&hclga_fst, ILabelCompare<StdArc>());
+	DeterminizeStarInLog(&hclga_fst, kDelta, &debug_location, max_states);
+
+	// fstrmsymbols
+	RemoveSomeInputSymbols(disambig_tid, &hclga_fst);
+
+	// fstrmepslocal
+	RemoveEpsLocal(&hclga_fst);
+
+	// fstminimizeencoded
+	MinimizeEncoded(&hclga_fst, kDelta);
+
+	// fstisstochastic
+	if (!IsStochasticFst(hclga_fst, 0.01, &min, &max)) {
+		std::cerr << "[info]: HCLGa is not stochastic." << std::endl;
+	}
+
+	VectorFst<StdArc> hclg_fst = hclga_fst;
+
+	// add-self-loops
+	std::vector<int32> null_disambig_syms;
+	AddSelfLoops(in.trans_model,
+                 null_disambig_syms,
+                 self_loop_scale,
+                 true,
+		 true,
+                 &hclg_fst);
+
+    // fstisstochastic
+	if (transition_scale == 1.0 &&
+		self_loop_scale == 1.0 &&
+		!IsStochasticFst(hclg_fst, 0.01, &min, &max)) {
+		std::cerr << "[info]: final HCLG is not stochastic." << std::endl;
+	}
+
+    if (!hclg_fst.Write(out_filename)) {
+		KALDI_WARN << "error writing FST to " << out_filename;
+		return false;
+    }
+	return true;
+}
+
+// Serve "compile" requests on stdin until "stop" or EOF.  Each request is
+// three lines (the command, the grammar path and the output path) and is
+// answered with "ok" or "error".
+int Serve(const StaticInputs &in) {
+	std::string cmd, grammar_fst_filename, out_filename;
+	while (std::getline(std::cin, cmd)) {
+		if (cmd == "stop") {
+			break;
 		}
-		TableComposeOptions table_opts;
-		VectorFst<StdArc> lg_fst;
-		TableCompose(*lang_disambig_fst, grammar_fst, &lg_fst, table_opts);
-		delete lang_disambig_fst;
-
-		// fstdeterminizestar --use-log
-		ArcSort(&lg_fst, ILabelCompare<StdArc>());
-		int max_states = -1;
-		bool debug_location = false;
-		DeterminizeStarInLog(&lg_fst, kDelta, &debug_location, max_states);
-
-		// fstminimizeencoded
-		MinimizeEncoded(&lg_fst, kDelta);
-
-		// fstarcsort --sort_type=ilabel
-		ArcSort(&lg_fst, ILabelCompare<StdArc>());
-
-		// fstisstochastic
-		StdArc::Weight min, max;
-		if (!IsStochasticFst(lg_fst, 0.01, &min, &max)) {
-			std::cerr << "[info]: LG not stochastic." << std::endl;
+		else if (cmd == "compile") {
+			std::getline(std::cin, grammar_fst_filename);
+			std::getline(std::cin, out_filename);
+			bool ok = false;
+			try {
+				ok = MakeGraph(in, grammar_fst_filename, out_filename);
+			} catch(const std::exception &e) {
+				std::cerr << e.what();
+			}
+			std::cout << (ok ? "ok" : "error") << std::endl;
 		}
-
-		// fstcomposecontext
-		std::vector<int32> disambig_symbols;
-		ReadIntegerVectorSimple(disambig_phones_filename, &disambig_symbols);
-		if (disambig_symbols.empty()) {
-			KALDI_WARN << "Disambiguation symbols list is empty; this likely "
-				<< "indicates an error in data preparation.";
+		else {
+			std::cerr << "unknown command " << cmd << std::endl;
 		}
-		std::vector<std::vector<int32> > ilabels;
-		VectorFst<StdArc> clg_fst;
-		ComposeContext(disambig_symbols, N, P, &lg_fst, &clg_fst, &ilabels);
+	}
+	return 0;
+}
 
-		// fstarcsort --sort_type=ilabel
-		ArcSort(&clg_fst, ILabelCompare<StdArc>());
+int main(int argc, char *argv[]) {
+	try {
+		const char *usage = "Usage: ./mkgraph [options] <proto-dir> <grammar-fst> <out-fst>\n"
+			"   or: ./mkgraph --server <proto-dir>\n";
 
-		// fstisstochastic
-		if (!IsStochasticFst(clg_fst, 0.01, &min, &max)) {
-			std::cerr << "[info]: CLG not stochastic." << std::endl;
+		bool server = false;
+		ParseOptions po(usage);
+		po.Register("server", &server, "Keep the model loaded and compile graphs "
+			"requested on stdin");
+		po.Read(argc, argv);
+		if (po.NumArgs() != (server ? 1 : 3)) {
+			po.PrintUsage();
+			return 1;
 		}
 
-		// make-h-transducer
-		HTransducerConfig hcfg;
-		hcfg.transition_scale = transition_scale;
-		ContextDependency ctx_dep;
-		ReadKaldiObject(tree_filename, &ctx_dep);
-		TransitionModel trans_model;
-		ReadKaldiObject(model_filename, &trans_model);
-		std::vector<int32> disambig_tid;
-		fst::VectorFst<fst::StdArc> *ha_fst = GetHTransducer(
-			ilabels,
-			ctx_dep,
-			trans_model,
-			hcfg,
-			&disambig_tid);
-
-		// fsttablecompose
-		VectorFst<StdArc> hclga_fst;
-		TableComposeOptions hclga_table_opts;
-		TableCompose(*ha_fst, clg_fst, &hclga_fst, hclga_table_opts);
-
-		// fstdeterminizestar --use-log=true
-		ArcSort(&hclga_fst, ILabelCompare<StdArc>());
-		DeterminizeStarInLog(&hclga_fst, kDelta, &debug_location, max_states);
-
-		// fstrmsymbols
-		RemoveSomeInputSymbols(disambig_tid, &hclga_fst);
-
-		// fstrmepslocal
-		RemoveEpsLocal(&hclga_fst);
-
-		// fstminimizeencoded
-		MinimizeEncoded(&hclga_fst, kDelta);
-
-		// fstisstochastic
-		if (!IsStochasticFst(hclga_fst, 0.01, &min, &max)) {
-			std::cerr << "[info]: HCLGa is not stochastic." << std::endl;
+		StaticInputs in;
+		if (!LoadStaticInputs(po.GetArg(1), &in)) {
+			return 1;
 		}
 
-		VectorFst<StdArc> hclg_fst = hclga_fst;
-
-		// add-self-loops
-		std::vector<int32> null_disambig_syms;
-		AddSelfLoops(trans_model,
-	                 null_disambig_syms,
-	                 self_loop_scale,
-	                 true,
-			 true,
-	                 &hclg_fst);
-
-	    // fstisstochastic
-		if (transition_scale == 1.0 &&
-			self_loop_scale == 1.0 &&
-			!IsStochasticFst(hclg_fst, 0.01, &min, &max)) {
-			std::cerr << "[info]: final HCLG is not stochastic." << std::endl;
+		if (server) {
+			return Serve(in);
 		}
 
-	    if (!hclg_fst.Write(out_filename)) {
-			KALDI_ERR << "error writing FST to " << out_filename;
-	    }
+		if (!MakeGraph(in, po.GetArg(2), po.GetArg(3))) {
+			return 1;
+		}
 	} catch(const std::exception &e) {
 		std::cerr << e.what();
 		return -1;
@@ -1,6 +1,29 @@
 from .__version__ import __version__
-from .resources import Resources
-from .forced_aligner import ForcedAligner
-from .full_transcriber import FullTranscriber
-from .resample import resample, resampled
-from .transcription import Transcription
+
+import importlib
+
+# (imported up front: the function has the name of its module, so binding it
+# late would be undone by any later import of the module)
+from .resample import resample, resampled, streamed
+
+# The submodules are only imported once something is used from them, so
+# that scripts and worker processes that need little of gentle start fast
+_EXPORTS = {
+    'Resources': 'resources',
+    'ForcedAligner': 'forced_aligner',
+    'FullTranscriber': 'full_transcriber',
+    'HierarchicalAligner': 'hierarchical',
+    'Transcription': 'transcription',
+}
+
+__all__ = ['__version__', 'resample', 'resampled', 'streamed'] + sorted(_EXPORTS)
+
+def __getattr__(name):
+    if name in _EXPORTS:
+        value = getattr(importlib.import_module('.' + _EXPORTS[name], __name__), name)
+        globals()[name] = value
+        return value
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
@@ -0,0 +1,221 @@
+'''A compact binary format for alignments, for corpus tools that read
+them far more often than they're written.  An AlignmentFile reads one
+through mmap, decoding only the words asked for: word `i`, or the words
+in a stretch of time.
+
+Layout (all little-endian):
+
+    HEADER                     magic, version, counts, the transcript
+    WORD * nwords              fixed-width word records
+    PHONE * nphones            phones, word by word
+    TIME * ntimes              (start, latest end so far, word index) of
+                               each word that has times, by start time
+    uint64 * (nstrings + 1)    offsets of the strings in...
+    bytes                      ...the UTF-8 string table
+
+Words, aligned words and phones refer to the string table by index (-1
+for None); each distinct string is stored once.
+'''
+import bisect
+import mmap
+import struct
+
+from gentle.transcription import CASES, Transcription, Word, WordColumns
+
+MAGIC = b'GNTL'
+VERSION = 1
+
+# magic, version, nwords, nphones, ntimes, nstrings, transcript
+HEADER = struct.Struct('<4sIIIIIi')
+# case, word, alignedWord, startOffset, endOffset, start, duration, end,
+# first phone, number of phones (-1: no phones at all)
+WORD = struct.Struct('<b3xiiqqdddIi')
+# phone, duration
+PHONE = struct.Struct('<id')
+# start, latest end of the words so far, word index
+TIME = struct.Struct('<ddI')
+OFFSET = struct.Struct('<Q')
+
+_CASE_CODES = {case: code for code, case in enumerate(CASES)}
+_NO_TIME = float('nan')
+_NO_OFFSET = -1
+
+def write(transcription, fh):
+    '''Writes `transcription` to the binary file `fh`'''
+    strings = {}
+    def string_idx(s):
+        if s is None:
+            return -1
+        return strings.setdefault(s, len(strings))
+
+    transcript = string_idx(transcription.transcript)
+    words = bytearray()
+    phones = bytearray()
+    times = []
+    nphones = 0
+    for i, wd in enumerate(transcription.words or []):
+        first_phone = nphones
+        if wd.phones is not None:
+            for ph in wd.phones:
+                phones += PHONE.pack(string_idx(ph['phone']), ph['duration'])
+            nphones += len(wd.phones)
+        words += WORD.pack(
+            _CASE_CODES[wd.case],
+            string_idx(wd.word), string_idx(wd.alignedWord),
+            _NO_OFFSET if wd.startOffset is None else wd.startOffset,
+            _NO_OFFSET if wd.endOffset is None else wd.endOffset,
+            _NO_TIME if wd.start is None else wd.start,
+            _NO_TIME if wd.duration is None else wd.duration,
+            _NO_TIME if wd.end is None else wd.end,
+            first_phone, -1 if wd.phones is None else len(wd.phones))
+        if wd.start is not None:
+            times.append((wd.start, wd.end, i))
+
+    times.sort()
+    latest = float('-inf')
+    time_index = bytearray()
+    for start, end, i in times:
+        latest = max(latest, end)
+        time_index += TIME.pack(start, latest, i)
+
+    fh.write(HEADER.pack(MAGIC, VERSION, len(words) // WORD.size, nphones, len(times), len(strings), transcript))
+    fh.write(words)
+    fh.write(phones)
+    fh.write(time_index)
+    encoded = [s.encode('utf-8') for s in strings] # in index order
+    pos = 0
+    for s in encoded:
+        fh.write(OFFSET.pack(pos))
+        pos += len(s)
+    fh.write(OFFSET.pack(pos))
+    for s in encoded:
+        fh.write(s)
+
+class _Records():
+    '''Field `field` of `count` records at `offset` of a buffer, as a
+    read-only sequence (for bisect)'''
+
+    def __init__(self, buf, offset, count, record, field):
+        self.buf = buf
+        self.offset = offset
+        self.count = count
+        self.record = record
+        self.field = field
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        return self.record.unpack_from(self.buf, self.offset + i * self.record.size)[self.field]
+
+class AlignmentFile():
+    '''Reads an alignment written by `write`, a word at a time, through a
+    memory map.  Works as a read-only sequence of Words.'''
+
+    def __init__(self, path):
+        with open(path, 'rb') as fh:
+            self._mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.nwords, self.nphones, self.ntimes, self.nstrings, self._transcript = \
+            HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC or version != VERSION:
+            self._mm.close()
+            raise ValueError("%s is not a version %d alignment file" % (path, VERSION))
+        self._words = HEADER.size
+        self._phones = self._words + self.nwords * WORD.size
+        self._times = self._phones + self.nphones * PHONE.size
+        self._offsets = self._times + self.ntimes * TIME.size
+        self._strings = self._offsets + (self.nstrings + 1) * OFFSET.size
+        self._cache = {}
+
+    def close(self):
+        self._mm.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def string(self, idx):
+        if idx < 0:
+            return None
+        s = self._cache.get(idx)
+        if s is None:
+            start, = OFFSET.unpack_from(self._mm, self._offsets + idx * OFFSET.size)
+            end, = OFFSET.unpack_from(self._mm, self._offsets + (idx + 1) * OFFSET.size)
+            # short strings (words, phones) repeat: keep them decoded
+            s = self._mm[self._strings + start:self._strings + end].decode('utf-8')
+            if end - start < 64:
+                self._cache[idx] = s
+        return s
+
+    @property
+    def transcript(self):
+        return self.string(self._transcript)
+
+    def __len__(self):
+        return self.nwords
+
+    def fields(self, i):
+        '''The Word arguments of word `i`'''
+        if not 0 <= i < self.nwords:
+            raise IndexError(i)
+        case, word, aligned, start_offset, end_offset, start, duration, end, first_phone, nphones = \
+            WORD.unpack_from(self._mm, self._words + i * WORD.size)
+        phones = None
+        if nphones >= 0:
+            phones = []
+            for j in range(first_phone, first_phone + nphones):
+                phone, phone_duration = PHONE.unpack_from(self._mm, self._phones + j * PHONE.size)
+                phones.append({'phone': self.string(phone), 'duration': phone_duration})
+        return {
+            'case': CASES[case],
+            'startOffset': None if start_offset == _NO_OFFSET else start_offset,
+            'endOffset': None if end_offset == _NO_OFFSET else end_offset,
+            'word': self.string(word),
+            'alignedWord': self.string(aligned),
+            'phones': phones,
+            'start': None if start != start else start,
+            'duration': None if duration != duration else duration,
+            'end': None if end != end else end,
+        }
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(self.nwords))]
+        if i < 0:
+            i += self.nwords
+        return Word(**self.fields(i))
+
+    def __iter__(self):
+        for i in range(self.nwords):
+            yield self[i]
+
+    def indices_between(self, start_t, end_t):
+        '''Indices of the words that overlap [start_t, end_t), in order'''
+        starts = _Records(self._mm, self._times, self.ntimes, TIME, 0)
+        latest = _Records(self._mm, self._times, self.ntimes, TIME, 1)
+        # words starting before end_t, past the last one that ends by start_t
+        lo = bisect.bisect_right(latest, start_t)
+        hi = bisect.bisect_left(starts, end_t)
+        out = []
+        for j in range(lo, hi):
+            i = TIME.unpack_from(self._mm, self._times + j * TIME.size)[2]
+            end = WORD.unpack_from(self._mm, self._words + i * WORD.size)[7]
+            if end > start_t:
+                out.append(i)
+        out.sort()
+        return out
+
+    def between(self, start_t, end_t):
+        '''The words that overlap [start_t, end_t), in order'''
+        return [self[i] for i in self.indices_between(start_t, end_t)]
+
+    def to_transcription(self, columnar=False):
+        if columnar:
+            words = WordColumns()
+            for i in range(self.nwords):
+                words.add(**self.fields(i))
+        else:
+            words = list(self)
+        return Transcription(transcript=self.transcript, words=words)
@@ -0,0 +1,58 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+
+def _jsonable(obj):
+    if isinstance(obj, (set, frozenset)):
+        return sorted(obj)
+    return repr(obj)
+
+class Checkpoint():
+    '''Chunk results of a job, saved as soon as each chunk is done so that
+    a restarted job only has to decode the chunks it hadn't finished.
+
+    Results are filed under a key for whatever they depend on (the
+    decoding graph, the audio, the chunk plan: see `key`), and looked up
+    by the same key, so that results from a different graph or plan are
+    never picked up by mistake.'''
+
+    def __init__(self, checkpoint_dir):
+        self.checkpoint_dir = checkpoint_dir
+        if not os.path.exists(checkpoint_dir):
+            os.makedirs(checkpoint_dir)
+
+    @staticmethod
+    def key(*parts):
+        h = hashlib.sha1()
+        for part in parts:
+            h.update(json.dumps(part, sort_keys=True, default=_jsonable).encode('utf-8'))
+            h.update(b'\n')
+        return h.hexdigest()
+
+    def _path(self, key, name):
+        return os.path.join(self.checkpoint_dir, '%s-%s.json' % (key[:16], name))
+
+    def load(self, key, name):
+        '''Returns what was saved for chunk `name` under `key`, or None'''
+        try:
+            with open(self._path(key, name)) as fh:
+                saved = json.load(fh)
+        except (IOError, ValueError):
+            return None
+        if saved.get('key') != key:
+            return None
+        return saved['result']
+
+    def save(self, key, name, result):
+        path = self._path(key, name)
+        tmp_path = '%s.%d.tmp' % (path, threading.get_ident())
+        with open(tmp_path, 'w') as fh:
+            json.dump({'key': key, 'result': result}, fh)
+        # a crash mid-write leaves the old checkpoint (or none)
+        os.replace(tmp_path, path)
+
+    def clear(self):
+        '''Removes all the checkpoints, once the job has finished'''
+        shutil.rmtree(self.checkpoint_dir, ignore_errors=True)
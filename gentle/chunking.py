@@ -0,0 +1,109 @@
+import math
+import operator
+
+class ChunkPlan():
+    '''Where `MultiThreadedTranscriber` cuts the audio: a list of
+    (start, end) times in seconds that cover the whole file without
+    overlapping'''
+
+    def __init__(self, chunks, duration):
+        self.chunks = chunks
+        self.duration = duration
+
+    @property
+    def decoded_t(self):
+        return sum(end - start for start, end in self.chunks)
+
+    def saved_t(self, chunk_len=20, overlap_t=2):
+        '''Seconds of audio that the fixed `chunk_len` windows overlapping
+        by `overlap_t` would have decoded on top of this plan'''
+        step = chunk_len - overlap_t
+        n_chunks = int(math.ceil(self.duration / float(step)))
+        fixed_t = sum(min(chunk_len, self.duration - i * step) for i in range(n_chunks))
+        return fixed_t - self.decoded_t
+
+def frame_energies(pcm, start_t, duration, frame_t=0.01):
+    '''Mean square amplitude of each `frame_t`-second frame of a region of
+    a pcm.PCMBuffer'''
+    samples = pcm.frames(start_t, duration).cast('h')
+    step = max(int(frame_t * pcm.rate), 1)
+    mul = operator.mul
+    energies = []
+    for i in range(0, len(samples) - step + 1, step):
+        frame = samples[i:i + step]
+        energies.append(sum(map(mul, frame, frame)) / step)
+    return energies
+
+def find_pause(pcm, start_t, end_t, target_t, pause_t=0.2, frame_t=0.01):
+    '''Returns the time in the middle of the quietest `pause_t`-second
+    stretch between `start_t` and `end_t`, preferring the one closest to
+    `target_t` among equally quiet ones'''
+    energies = frame_energies(pcm, start_t, end_t - start_t, frame_t)
+    width = max(int(pause_t / frame_t), 1)
+    if len(energies) < width:
+        return target_t
+
+    # running sum of the energy over `width` frames
+    windows = []
+    window = sum(energies[:width])
+    for i in range(len(energies) - width + 1):
+        if i > 0:
+            window += energies[i + width - 1] - energies[i - 1]
+        windows.append((start_t + (i + width / 2.0) * frame_t, window))
+
+    # "equally quiet": within a factor of two of the quietest (with a
+    # floor, for digital silence)
+    quiet = 2 * min(w for _, w in windows) + width
+    return min((abs(t - target_t), t) for t, w in windows if w <= quiet)[1]
+
+def plan_chunks(pcm, chunk_len=20, min_len=10, max_len=30, pause_t=0.2):
+    '''Cuts a pcm.PCMBuffer into chunks of `min_len` to `max_len` seconds,
+    at the quietest point near every `chunk_len` seconds, so that the cuts
+    fall between words and the chunks don't need to overlap'''
+    chunks = list(iter_chunks(pcm, chunk_len, min_len, max_len, pause_t))
+    return ChunkPlan(chunks, pcm.duration)
+
+def iter_chunks(pcm, chunk_len=20, min_len=10, max_len=30, pause_t=0.2):
+    '''Yields the chunks of `plan_chunks` one by one, each as soon as
+    there's enough of a pcm.StreamedPCM to place its end'''
+    max_len = max(max_len, 2 * min_len)
+
+    start = 0
+    while True:
+        # Until the end of the audio is known, a cut can be placed once
+        # there's `min_len` past the furthest it could be (a frame or two
+        # more, against rounding: less means the audio is complete)
+        needed_t = start + max_len + min_len
+        pcm.wait(int(needed_t * pcm.rate) + 2)
+        if pcm.duration < needed_t:
+            break
+        end = find_pause(pcm, start + min_len, start + max_len, start + chunk_len, pause_t)
+        yield (start, end)
+        start = end
+
+    # The audio is complete
+    duration = pcm.duration
+    while duration - start > max_len:
+        # leave at least `min_len` for the chunk after this one
+        end = find_pause(pcm,
+                         start + min_len,
+                         min(start + max_len, duration - min_len),
+                         start + chunk_len,
+                         pause_t)
+        yield (start, end)
+        start = end
+    if duration > start:
+        yield (start, duration)
+
+def iter_windows(pcm, chunk_len=20, overlap_t=2):
+    '''Yields fixed `chunk_len` windows overlapping by `overlap_t`, each
+    as soon as a pcm.StreamedPCM has the audio of it'''
+    step = chunk_len - overlap_t
+    i = 0
+    while True:
+        start = i * step
+        pcm.wait(int((start + chunk_len) * pcm.rate) + 1)
+        if pcm.duration <= start:
+            break
+        yield (start, start + chunk_len)
+        i += 1
@@ -0,0 +1,416 @@
+'''Word-level diff with the same output as difflib.SequenceMatcher
+(`get_opcodes`), for the long token sequences `diff_align` compares.
+
+By default the opcodes are SequenceMatcher(None, a, b)'s own, bit for
+bit: the same recursive longest-matching-block search, with the same tie
+breaking and the same autojunk rule for "popular" tokens.  Only the way
+each longest block is found differs.  difflib scans every pair of
+positions where a token of `a` occurs in `b`, which is quadratic in
+practice for long transcripts.  Here the tokens are interned to integers
+and each block is found with a suffix automaton of the `b` side, in time
+linear in the lengths of the two sides.
+
+With `fast=True`, a different algorithm: the sequences are split at
+"anchors" -- tokens that occur exactly once on each side of a gap, in the
+same order (as in patience diff) -- and the gaps without any are diffed
+with Myers' O(ND) algorithm, using the linear-space "middle snake"
+refinement.  There's no junk heuristic: frequent words like "the" are
+matched like any other.  The opcodes have the same form as difflib's (the
+same tuples and tags, tiling both sequences in order, 'equal' runs
+merged), but where there are several ways to line the sequences up, or
+difflib would have junked a frequent word, the one chosen can differ.
+'''
+import bisect
+import difflib
+
+# Longest edit script looked for in a gap with no anchors.  Beyond that
+# (e.g. lots of noise, or the wrong transcript) the gap is matched with
+# difflib instead (see `_fallback_blocks`) rather than spending O(D^2)
+# time on it.
+MAX_EDITS = 2000
+
+# Longest stretch of a gap handed to difflib at a time
+FALLBACK_WINDOW = 5000
+
+# Steps per token to build and run a suffix automaton, relative to a step
+# of difflib's scan (see `_difflib_blocks`)
+AUTOMATON_COST = 2
+
+def intern(a, b):
+    '''Maps the tokens of `a` and `b` to small integers, the same token
+    to the same integer'''
+    codes = {}
+    a = [codes.setdefault(tok, len(codes)) for tok in a]
+    b = [codes.setdefault(tok, len(codes)) for tok in b]
+    return a, b
+
+def _middle_snake(a, a0, a1, b, b0, b1, max_edits=MAX_EDITS):
+    '''Finds the middle snake of a shortest edit script from a[a0:a1] to
+    b[b0:b1].  Returns (x, y, u, v, d): the snake runs from (x, y) to (u, v)
+    (relative to a0, b0) and `d` is the length of the edit script.  Returns
+    None if the script is longer than `max_edits`.'''
+    n = a1 - a0
+    m = b1 - b0
+    delta = n - m
+    odd = delta & 1
+    dmax = (n + m + 1) // 2
+    if dmax > max_edits // 2 + 1:
+        dmax = max_edits // 2 + 1
+    off = dmax + 1
+    vf = [0] * (2 * off + 1) # furthest x along each diagonal, forward
+    vb = [0] * (2 * off + 1) # ...and backward, from the ends
+    for d in range(dmax + 1):
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and vf[off + k - 1] < vf[off + k + 1]):
+                x = vf[off + k + 1]
+            else:
+                x = vf[off + k - 1] + 1
+            y = x - k
+            x0, y0 = x, y
+            while x < n and y < m and a[a0 + x] == b[b0 + y]:
+                x += 1
+                y += 1
+            vf[off + k] = x
+            if odd and -(d - 1) <= delta - k <= d - 1 and x + vb[off + delta - k] >= n:
+                return x0, y0, x, y, 2 * d - 1
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and vb[off + k - 1] < vb[off + k + 1]):
+                x = vb[off + k + 1]
+            else:
+                x = vb[off + k - 1] + 1
+            y = x - k
+            x0, y0 = x, y
+            while x < n and y < m and a[a1 - 1 - x] == b[b1 - 1 - y]:
+                x += 1
+                y += 1
+            vb[off + k] = x
+            if not odd and -d <= delta - k <= d and x + vf[off + delta - k] >= n:
+                return n - x, m - y, n - x0, m - y0, 2 * d
+    return None
+
+def _anchors(a, a0, a1, b, b0, b1, runs=True):
+    '''Returns the (i, j) positions of tokens that occur exactly once in
+    both a[a0:a1] and b[b0:b1] (and, with `runs`, are followed by the same
+    token), as the longest list in which i and j are both increasing'''
+    counts = {}
+    for i in range(a0, a1):
+        tok = a[i]
+        counts[tok] = (counts[tok][0] + 1, i) if tok in counts else (1, i)
+    pairs = []
+    seen = {}
+    for j in range(b0, b1):
+        tok = b[j]
+        if tok in counts and counts[tok][0] == 1:
+            seen[tok] = j if tok not in seen else None
+    for tok, j in seen.items():
+        if j is None:
+            continue
+        # A lone rare word is often a misrecognition that happens to match
+        # a word elsewhere; only anchor on ones followed by a match
+        i = counts[tok][1]
+        if not runs or (i + 1 < a1 and j + 1 < b1 and a[i + 1] == b[j + 1]):
+            pairs.append((i, j))
+    if not pairs:
+        return pairs
+    pairs.sort()
+
+    # longest increasing subsequence of the js (patience sorting)
+    tails = []    # smallest j ending an increasing run of each length
+    tail_idx = []
+    prev = [None] * len(pairs)
+    for idx, (_, j) in enumerate(pairs):
+        pos = bisect.bisect_left(tails, j)
+        if pos == len(tails):
+            tails.append(j)
+            tail_idx.append(idx)
+        else:
+            tails[pos] = j
+            tail_idx[pos] = idx
+        prev[idx] = tail_idx[pos - 1] if pos > 0 else None
+    out = []
+    idx = tail_idx[-1]
+    while idx is not None:
+        out.append(pairs[idx])
+        idx = prev[idx]
+    out.reverse()
+    return out
+
+def _fallback_blocks(a, a0, a1, b, b0, b1, window=FALLBACK_WINDOW):
+    '''Matching blocks of a gap too far apart for Myers, from
+    SequenceMatcher (without autojunk).  Long gaps are cut into as many
+    windows of at most `window` tokens, at the same fraction of the way
+    through each side, so that the time it takes stays bounded.'''
+    n = a1 - a0
+    m = b1 - b0
+    pieces = max(1, -(-max(n, m) // window))
+    blocks = []
+    for p in range(pieces):
+        i0, i1 = a0 + n * p // pieces, a0 + n * (p + 1) // pieces
+        j0, j1 = b0 + m * p // pieces, b0 + m * (p + 1) // pieces
+        matcher = difflib.SequenceMatcher(None, a[i0:i1], b[j0:j1], autojunk=False)
+        for i, j, size in matcher.get_matching_blocks()[:-1]:
+            blocks.append((i0 + i, j0 + j, size))
+    return blocks
+
+def _popular(b):
+    '''Positions of each token of `b`, without the "popular" ones that
+    SequenceMatcher's autojunk leaves out (tokens making up more than 1% of
+    a sequence of at least 200)'''
+    b2j = {}
+    for j, tok in enumerate(b):
+        b2j.setdefault(tok, []).append(j)
+    if len(b) >= 200:
+        ntest = len(b) // 100 + 1
+        for tok in [tok for tok, idx in b2j.items() if len(idx) > ntest]:
+            del b2j[tok]
+    return b2j
+
+def _scan_core(a, alo, ahi, blo, bhi, b2j):
+    '''The longest match, as SequenceMatcher.find_longest_match looks for
+    it (before extending it): through every position in b[blo:bhi] of
+    every token of a[alo:ahi]'''
+    besti, bestj, bestsize = alo, blo, 0
+    j2len = {} # length of the match ending at each j, for the previous i
+    for i in range(alo, ahi):
+        js = b2j.get(a[i])
+        if not js:
+            j2len = {}
+            continue
+        lo = bisect.bisect_left(js, blo) if js[0] < blo else 0
+        hi = bisect.bisect_left(js, bhi, lo) if js[-1] >= bhi else len(js)
+        get = j2len.get
+        newj2len = {}
+        for j in js[lo:hi]:
+            k = newj2len[j] = get(j - 1, 0) + 1
+            if k > bestsize:
+                besti, bestj, bestsize = i - k + 1, j - k + 1, k
+        j2len = newj2len
+    return besti, bestj, bestsize
+
+def _automaton_core(a, alo, ahi, b, blo, bhi, b2j):
+    '''The same as `_scan_core`, from a suffix automaton of b[blo:bhi]'''
+    nxt = [{}]
+    link = [-1]
+    length = [0]
+    first = [0] # where the strings of a state first end in b
+    last = 0
+    for p in range(blo, bhi):
+        c = b[p]
+        if c not in b2j:
+            # a popular token can't start or continue a match
+            c = ~p
+        cur = len(nxt)
+        nxt.append({})
+        link.append(0)
+        length.append(length[last] + 1)
+        first.append(p)
+        v = last
+        while v != -1 and c not in nxt[v]:
+            nxt[v][c] = cur
+            v = link[v]
+        if v != -1:
+            q = nxt[v][c]
+            if length[v] + 1 == length[q]:
+                link[cur] = q
+            else:
+                clone = len(nxt)
+                nxt.append(dict(nxt[q]))
+                link.append(link[q])
+                length.append(length[v] + 1)
+                first.append(first[q])
+                while v != -1 and nxt[v].get(c) == q:
+                    nxt[v][c] = clone
+                    v = link[v]
+                link[q] = clone
+                link[cur] = clone
+        last = cur
+
+    # The longest match ending at each i: the first longest one wins, at
+    # the first place it occurs in b
+    besti, bestj, bestsize = alo, blo, 0
+    v = size = 0
+    for i in range(alo, ahi):
+        c = a[i]
+        if c not in b2j:
+            v = size = 0
+            continue
+        while v and c not in nxt[v]:
+            v = link[v]
+            size = length[v]
+        if c in nxt[v]:
+            v = nxt[v][c]
+            size += 1
+            if size > bestsize:
+                besti, bestj, bestsize = i - size + 1, first[v] - size + 1, size
+        else:
+            size = 0
+    return besti, bestj, bestsize
+
+def _difflib_blocks(a, b):
+    '''SequenceMatcher.get_matching_blocks, before adjacent runs are merged'''
+    b2j = _popular(b)
+    # cells[i]: how many (i, j) pairs of matching tokens are before i
+    cells = [0]
+    for tok in a:
+        cells.append(cells[-1] + len(b2j.get(tok, ())))
+
+    matches = []
+    queue = [(0, len(a), 0, len(b))]
+    while queue:
+        alo, ahi, blo, bhi = queue.pop()
+        # Scanning costs about a step per pair of matching tokens (of which
+        # those in b[blo:bhi] are a share), the automaton a few per token
+        npairs = (cells[ahi] - cells[alo]) * (bhi - blo) // max(len(b), 1)
+        if npairs > AUTOMATON_COST * (ahi - alo + bhi - blo):
+            i, j, k = _automaton_core(a, alo, ahi, b, blo, bhi, b2j)
+        else:
+            i, j, k = _scan_core(a, alo, ahi, blo, bhi, b2j)
+        # ...then the match is extended over any (popular) tokens around it
+        while i > alo and j > blo and a[i - 1] == b[j - 1]:
+            i, j, k = i - 1, j - 1, k + 1
+        while i + k < ahi and j + k < bhi and a[i + k] == b[j + k]:
+            k += 1
+        if k:
+            matches.append((i, j, k))
+            if alo < i and blo < j:
+                queue.append((alo, i, blo, j))
+            if i + k < ahi and j + k < bhi:
+                queue.append((i + k, ahi, j + k, bhi))
+    return matches
+
+def _fast_blocks(a, b):
+    '''Matching blocks from anchors and Myers (see above), before adjacent
+    runs are merged'''
+    matches = [] # (i, j, n), in no particular order
+    stack = [(0, len(a), 0, len(b), True)]
+    while stack:
+        a0, a1, b0, b1, use_anchors = stack.pop()
+
+        # common prefix and suffix
+        n = 0
+        while a0 + n < a1 and b0 + n < b1 and a[a0 + n] == b[b0 + n]:
+            n += 1
+        if n:
+            matches.append((a0, b0, n))
+            a0 += n
+            b0 += n
+        n = 0
+        while a1 - n > a0 and b1 - n > b0 and a[a1 - 1 - n] == b[b1 - 1 - n]:
+            n += 1
+        if n:
+            matches.append((a1 - n, b1 - n, n))
+            a1 -= n
+            b1 -= n
+        if a0 == a1 or b0 == b1:
+            continue
+
+        anchors = []
+        if use_anchors:
+            anchors = _anchors(a, a0, a1, b, b0, b1)
+            if not anchors and (a1 - a0) + (b1 - b0) > MAX_EDITS:
+                # too long for Myers: make do with lone matches
+                anchors = _anchors(a, a0, a1, b, b0, b1, runs=False)
+        if anchors:
+            for i, j in anchors:
+                stack.append((a0, i, b0, j, True))
+                a0, b0 = i, j
+            stack.append((a0, a1, b0, b1, True))
+            continue
+
+        # no anchors: Myers, splitting at the middle snake.  (With the
+        # prefix and suffix trimmed, the edit script has at least 2 steps
+        # and each half has fewer.)
+        snake = _middle_snake(a, a0, a1, b, b0, b1)
+        if snake is None:
+            matches.extend(_fallback_blocks(a, a0, a1, b, b0, b1))
+            continue
+        x, y, u, v, _ = snake
+        if u > x:
+            matches.append((a0 + x, b0 + y, u - x))
+        stack.append((a0, a0 + x, b0, b0 + y, False))
+        stack.append((a0 + u, a1, b0 + v, b1, False))
+    return matches
+
+def matching_blocks(a, b, fast=False):
+    '''Like SequenceMatcher.get_matching_blocks: a list of (i, j, n) such
+    that a[i:i+n] == b[j:j+n], in increasing order of i and j, ending with
+    (len(a), len(b), 0)'''
+    a, b = intern(a, b)
+    matches = _fast_blocks(a, b) if fast else _difflib_blocks(a, b)
+
+    # merge adjacent runs, as SequenceMatcher does
+    matches.sort()
+    blocks = []
+    for i, j, n in matches:
+        if blocks and blocks[-1][0] + blocks[-1][2] == i and blocks[-1][1] + blocks[-1][2] == j:
+            blocks[-1] = (blocks[-1][0], blocks[-1][1], blocks[-1][2] + n)
+        else:
+            blocks.append((i, j, n))
+    blocks.append((len(a), len(b), 0))
+    return blocks
+
+def get_opcodes(a, b, fast=False):
+    '''Like SequenceMatcher.get_opcodes: (tag, i1, i2, j1, j2) tuples
+    describing how to turn `a` into `b` (see above for how they compare)'''
+    i = j = 0
+    opcodes = []
+    for ai, bj, size in matching_blocks(a, b, fast):
+        tag = ''
+        if i < ai and j < bj:
+            tag = 'replace'
+        elif i < ai:
+            tag = 'delete'
+        elif j < bj:
+            tag = 'insert'
+        if tag:
+            opcodes.append((tag, i, ai, j, bj))
+        i, j = ai + size, bj + size
+        if size:
+            opcodes.append(('equal', ai, i, bj, j))
+    return opcodes
+
+if __name__=='__main__':
+    # Benchmark against difflib on a long, noisy synthetic transcript
+    import random
+    import sys
+    import time
+
+    nwords = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    rng = random.Random(0)
+
+    # Zipf-ish vocabulary: lots of repeated function words
+    vocab = ['w%d' % i for i in range(5000)]
+    weights = [1.0 / (i + 1) for i in range(len(vocab))]
+    reference = rng.choices(vocab, weights, k=nwords)
+
+    # ~10% substitutions, deletions and insertions
+    hypothesis = []
+    for word in reference:
+        r = rng.random()
+        if r < 0.04:
+            hypothesis.append(rng.choice(vocab))
+        elif r < 0.07:
+            pass
+        elif r < 0.1:
+            hypothesis.extend([word, rng.choice(vocab)])
+        else:
+            hypothesis.append(word)
+
+    def matched(opcodes):
+        return sum(i2 - i1 for tag, i1, i2, _, _ in opcodes if tag == 'equal')
+
+    t0 = time.time()
+    fast_opcodes = get_opcodes(hypothesis, reference, fast=True)
+    t1 = time.time()
+    print('fast:    %.2fs, %d of %d words matched' % (t1 - t0, matched(fast_opcodes), nwords))
+
+    t0 = time.time()
+    opcodes = get_opcodes(hypothesis, reference)
+    t1 = time.time()
+    print('default: %.2fs, %d of %d words matched' % (t1 - t0, matched(opcodes), nwords))
+
+    t0 = time.time()
+    expected = difflib.SequenceMatcher(a=hypothesis, b=reference).get_opcodes()
+    t1 = time.time()
+    print('difflib: %.2fs, %d of %d words matched (%s)' % (t1 - t0, matched(expected), nwords,
+                                                          'same' if opcodes == expected else 'DIFFERENT'))
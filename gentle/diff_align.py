@@ -1,8 +1,8 @@
-import difflib
 import json
 import os
 import sys
 
+from gentle import diff
 from gentle import metasentence
 from gentle import language_model
 from gentle import standard_kaldi
@@ -73,17 +73,17 @@ def align(alignment, ms, **kwargs):
                 word=display_word))
     return out
 
-def word_diff(a, b):
+def word_diff(a, b, fast=False):
     '''Like difflib.SequenceMatcher but it only compares one word
     at a time. Returns an iterator whose elements are like
-    (operation, index in a, index in b)'''
-    matcher = difflib.SequenceMatcher(a=a, b=b)
-    for op, a_idx, _, b_idx, _ in by_word(matcher.get_opcodes()):
+    (operation, index in a, index in b).  (With `fast`, not quite
+    difflib's; see gentle.diff.)'''
+    for op, a_idx, _, b_idx, _ in by_word(diff.get_opcodes(a, b, fast)):
         yield (op, a_idx, b_idx)
 
 def by_word(opcodes):
-    '''Take difflib.SequenceMatcher.get_opcodes() output and
-    return an equivalent opcode sequence that only modifies
+    '''Take difflib.SequenceMatcher.get_opcodes() (or diff.get_opcodes())
+    output and return an equivalent opcode sequence that only modifies
     one word at a time'''
     for op, s1, e1, s2, e2 in opcodes:
         if op == 'delete':
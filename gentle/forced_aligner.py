@@ -1,31 +1,83 @@
+import os
+
 from gentle import diff_align
 from gentle import kaldi_queue
 from gentle import language_model
 from gentle import metasentence
 from gentle import multipass
+from gentle.checkpoint import Checkpoint
+from gentle.pcm import PCMBuffer
 from gentle.transcriber import MultiThreadedTranscriber
 from gentle.transcription import Transcription
 
 class ForcedAligner():
 
-    def __init__(self, resources, transcript, nthreads=4, **kwargs):
+    def __init__(self, resources, transcript, nthreads=4, pool=None, graph_cache=None, mkgraph=None, realign_budget=None, **kwargs):
         self.kwargs = kwargs
         self.nthreads = nthreads
+        # Seconds the second pass may take (see multipass.realign)
+        self.realign_budget = realign_budget
         self.transcript = transcript
         self.resources = resources
+        if pool is None:
+            # Workers of our own, kept loaded for the second pass.  The
+            # first pass starts on the first one ready and takes on the
+            # others as they finish loading (see KaldiPool.checkout).
+            pool = kaldi_queue.KaldiPool(resources, nthreads=nthreads)
+            self._own_pool = True
+        else:
+            self._own_pool = False
+        self.pool = pool
+        self.graph_cache = graph_cache
+        self.mkgraph = mkgraph
         self.ms = metasentence.MetaSentence(transcript, resources.vocab)
         ks = self.ms.get_kaldi_sequence()
-        gen_hclg_filename = language_model.make_bigram_language_model(ks, resources.proto_langdir, **kwargs)
-        self.queue = kaldi_queue.build(resources, hclg_path=gen_hclg_filename, nthreads=nthreads)
-        self.mtt = MultiThreadedTranscriber(self.queue, nthreads=nthreads)
-
-    def transcribe(self, wavfile, progress_cb=None, logging=None):
-        words, duration = self.mtt.transcribe(wavfile, progress_cb=progress_cb)
-
-        # Clear queue (would this be gc'ed?)
-        for i in range(self.nthreads):
-            k = self.queue.get()
-            k.stop()
+        # Identifies the graph in checkpoints, which outlive its file
+        self.graph_key = Checkpoint.key(ks, kwargs)
+        gen_hclg_filename = language_model.make_bigram_language_model(ks, resources.proto_langdir, cache=graph_cache, mkgraph=mkgraph, **kwargs)
+        self.hclg_path = gen_hclg_filename
+        # Graphs from the cache are owned by it (and pinned for us until
+        # the first pass is done); anything else is ours to remove
+        self._held_hclg = True
+
+    def _release_hclg(self):
+        if not self._held_hclg:
+            return
+        self._held_hclg = False
+        if self.graph_cache is not None:
+            self.graph_cache.unpin(self.hclg_path)
+        else:
+            os.unlink(self.hclg_path)
+
+    def _first_pass(self, wavfile, progress_cb, checkpoint):
+        try:
+            # Warm workers (possibly shared with other jobs): only the
+            # (small) graph has to be loaded
+            pcm = PCMBuffer.open(wavfile)
+            # (the length of audio that's still being resampled isn't known)
+            duration = pcm.duration if pcm.complete else None
+            queue = self.pool.checkout(self.hclg_path, nthreads=self.nthreads, duration=duration)
+            try:
+                mtt = MultiThreadedTranscriber(queue, nthreads=self.nthreads)
+                return mtt.transcribe(pcm, progress_cb=progress_cb,
+                                      checkpoint=checkpoint, graph_key=self.graph_key)
+            finally:
+                self.pool.checkin(queue)
+        finally:
+            # By now every worker has read the graph
+            self._release_hclg()
+
+    def transcribe(self, wavfile, progress_cb=None, logging=None, checkpoint=None):
+        '''With a checkpoint.Checkpoint, picks up where an interrupted
+        transcription of the same audio left off'''
+        try:
+            return self._transcribe(wavfile, progress_cb, logging, checkpoint)
+        finally:
+            if self._own_pool:
+                self.pool.stop()
+
+    def _transcribe(self, wavfile, progress_cb, logging, checkpoint):
+        words, duration = self._first_pass(wavfile, progress_cb, checkpoint)
 
         # Align words
         words = diff_align.align(words, self.ms, **self.kwargs)
@@ -37,7 +89,7 @@ class ForcedAligner():
         if progress_cb is not None:
             progress_cb({'status': 'ALIGNING'})
 
-        words = multipass.realign(wavfile, words, self.ms, resources=self.resources, nthreads=self.nthreads, progress_cb=progress_cb)
+        words = multipass.realign(wavfile, words, self.ms, resources=self.resources, nthreads=self.nthreads, progress_cb=progress_cb, pool=self.pool, graph_cache=self.graph_cache, mkgraph=self.mkgraph, checkpoint=checkpoint, budget=self.realign_budget)
 
         if logging is not None:
             logging.info("after 2nd pass: %d unaligned words (of %d)" % (len([X for X in words if X.not_found_in_audio()]), len(words)))
@@ -87,6 +139,31 @@ class AdjacencyOptimizer():
     def __init__(self, words, duration):
         self.words = words
         self.duration = duration
+        # For each position i (up to len(words)), the index of the last
+        # aligned word before i (or -1), and of the first one at or after
+        # i (or len(words)); kept up to date as words are swapped
+        self._prev = [-1] * (len(words) + 1)
+        self._next = [len(words)] * (len(words) + 1)
+        self._update_index(0, len(words))
+
+    def _update_index(self, lo, hi):
+        '''Updates the prev/next indices after words in [lo, hi) changed'''
+        last = self._prev[lo]
+        for i in range(lo + 1, len(self.words) + 1):
+            if self.words[i - 1].success():
+                last = i - 1
+            # past hi, nothing changes once we're back in step
+            if i > hi and self._prev[i] == last:
+                break
+            self._prev[i] = last
+
+        first = self._next[hi]
+        for i in range(hi - 1, -1, -1):
+            if self.words[i].success():
+                first = i
+            if i < lo and self._next[i] == first:
+                break
+            self._next[i] = first
 
     def out_of_audio_sequence(self, i):
         j = i
@@ -95,16 +172,12 @@ class AdjacencyOptimizer():
         return None if j == i else j
 
     def tend(self, i):
-        for word in reversed(self.words[:i]):
-            if word.success():
-                return word.end
-        return 0
+        prev = self._prev[i]
+        return self.words[prev].end if prev >= 0 else 0
 
     def tstart(self, i):
-        for word in self.words[i:]:
-            if word.success():
-                return word.start
-        return self.duration
+        nxt = self._next[i]
+        return self.words[nxt].start if nxt < len(self.words) else self.duration
 
     def find_subseq(self, i, j, p, n):
         for k in range(i, j-n+1):
@@ -130,18 +203,19 @@ class AdjacencyOptimizer():
             if q > len(self.words): return False
             opp_gap = self.tstart(q) - self.tend(q)
 
-        # is there a matching subsequence?
-        k = self.find_subseq(i, j, p, n)
-        if k is None: return False
-
         # if the opposite gap isn't bigger than the sequence gap, no benefit to
-        # potential swap
+        # potential swap (checked first: it's cheaper)
         seq_gap = self.tstart(j) - self.tend(i)
         if opp_gap <= seq_gap: return False
 
+        # is there a matching subsequence?
+        k = self.find_subseq(i, j, p, n)
+        if k is None: return False
+
         # swap subsequences at p and k
         for m in range(0, n):
             self.words[k+m].swap_alignment(self.words[p+m])
+        self._update_index(min(k, p), max(k, p) + n)
 
         return True
 
@@ -169,3 +243,53 @@ class AdjacencyOptimizer():
                 i = j # skip past this sequence
 
         return self.words
+
+if __name__=='__main__':
+    # Benchmark on a long synthetic alignment with many short gaps
+    import copy
+    import random
+    import sys
+    import time
+
+    from gentle.transcription import Word
+
+    nwords = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    rng = random.Random(0)
+
+    words = []
+    t = 0
+    while len(words) < nwords:
+        # a few aligned words, then a gap of up to 8 missed ones
+        for _ in range(rng.randint(1, 6)):
+            words.append(Word(case=Word.SUCCESS, word=rng.choice('abcd'), start=t, end=t + 0.3))
+            t += 0.3 + rng.random() * 0.2
+        for _ in range(rng.randint(1, 8)):
+            words.append(Word(case=Word.NOT_FOUND_IN_AUDIO, word=rng.choice('abcd')))
+        t += rng.random() * 2
+    ndone = sum(wd.success() for wd in words)
+
+    class ScanningOptimizer(AdjacencyOptimizer):
+        '''Looks for the neighbouring aligned words by scanning, as before'''
+        def tend(self, i):
+            for word in reversed(self.words[:i]):
+                if word.success():
+                    return word.end
+            return 0
+
+        def tstart(self, i):
+            for word in self.words[i:]:
+                if word.success():
+                    return word.start
+            return self.duration
+
+    reference = copy.deepcopy(words)
+    t0 = time.time()
+    out = AdjacencyOptimizer(words, t).optimize()
+    t1 = time.time()
+    print('indexed:  %.2fs for %d words (%d aligned)' % (t1 - t0, len(words), ndone))
+
+    t0 = time.time()
+    expected = ScanningOptimizer(reference, t).optimize()
+    t1 = time.time()
+    print('scanning: %.2fs' % (t1 - t0))
+    print('same output: %s' % ([wd.as_dict() for wd in out] == [wd.as_dict() for wd in expected]))
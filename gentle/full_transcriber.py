@@ -7,19 +7,31 @@ from gentle.transcription import Transcription
 
 class FullTranscriber():
 
-    def __init__(self, resources, nthreads=2):
+    def __init__(self, resources, nthreads=2, slots_per_process=1):
         self.available = False
         if nthreads <= 0: return
         if not os.path.exists(resources.full_hclg_path): return
 
-        queue = kaldi_queue.build(resources, nthreads=nthreads)
+        queue = kaldi_queue.build(resources, nthreads=nthreads, slots_per_process=slots_per_process)
         self.mtt = MultiThreadedTranscriber(queue, nthreads=nthreads)
+        self.graph_key = resources.full_hclg_path
         self.available = True
 
-    def transcribe(self, wavfile, progress_cb=None, logging=None):
-        words, duration = self.mtt.transcribe(wavfile, progress_cb=progress_cb)
+    def stats(self):
+        '''Worker restart counts (see `kaldi_queue.Supervisor`)'''
+        if not self.available:
+            return {}
+        return self.mtt.kaldi_queue.supervisor.stats()
+
+    def transcribe(self, wavfile, progress_cb=None, logging=None, checkpoint=None):
+        words, duration = self.mtt.transcribe(wavfile, progress_cb=progress_cb,
+                                              checkpoint=checkpoint, graph_key=self.graph_key)
         return self.make_transcription_alignment(words)
 
+    def transcribe_stream(self, wavfile, increment=0.5):
+        '''Yields words as they are recognized, for low-latency captioning'''
+        return self.mtt.transcribe_stream(wavfile, increment=increment)
+
     @staticmethod
     def make_transcription_alignment(trans):
         # Spoof the `diff_align` output format
@@ -0,0 +1,147 @@
+import os
+
+from collections import Counter
+from multiprocessing.pool import ThreadPool as Pool
+
+from gentle import diff_align
+from gentle import language_model
+from gentle import metasentence
+from gentle.forced_aligner import ForcedAligner
+from gentle.pcm import PCMBuffer
+from gentle.scheduler import DecoderScheduler
+from gentle.transcriber import MultiThreadedTranscriber
+from gentle.transcription import Transcription
+
+def find_cuts(alignment, ms, segment_len=120, anchor_len=3, max_gap=0.5):
+    '''Picks places to split a transcript and its audio into independent
+    segments of about `segment_len` seconds, given a rough `alignment`
+    from diff_align (one Word per token of `ms`).
+
+    A segment ends after an anchor: `anchor_len` consecutive words that
+    were all recognized, back to back (no more than `max_gap` seconds
+    apart), and that occur in this order only once in the transcript.
+    Returns a list of (token index, time) cut points: the segment before a
+    cut ends with that token, at that time.'''
+    seq = ms.get_kaldi_sequence()
+    counts = Counter(tuple(seq[i:i + anchor_len]) for i in range(len(seq) - anchor_len + 1))
+
+    cuts = []
+    last_t = 0
+    for i in range(len(alignment) - anchor_len):
+        run = alignment[i:i + anchor_len]
+        if not all(wd.success() for wd in run):
+            continue
+        if any(b.start - a.end > max_gap for a, b in zip(run, run[1:])):
+            continue
+        if counts[tuple(seq[i:i + anchor_len])] != 1:
+            continue
+
+        last = run[-1]
+        if last.end - last_t < segment_len:
+            continue
+        # cut in the pause before the next word, if we know where it is
+        nxt = alignment[i + anchor_len]
+        cut_t = (last.end + nxt.start) / 2 if nxt.success() and nxt.start > last.end else last.end
+        cuts.append((i + anchor_len - 1, cut_t))
+        last_t = cut_t
+    return cuts
+
+class HierarchicalAligner():
+    '''Aligns book-length transcripts without ever building a graph for,
+    or diffing against, the whole thing.
+
+    A first pass with the full language model gives a rough alignment to
+    find anchors in (see `find_cuts`); the transcript and audio are then
+    cut at the anchors into segments of about `segment_len` seconds, and
+    each segment is aligned independently by a ForcedAligner with its own
+    small graph.  Segments run in parallel, `nthreads` at a time, sharing
+    the decoders of `pool` (a scheduler.DecoderScheduler).'''
+
+    def __init__(self, resources, transcript, nthreads=4, pool=None, graph_cache=None, mkgraph=None, segment_len=120, **kwargs):
+        self.resources = resources
+        self.transcript = transcript
+        self.nthreads = nthreads
+        self.pool = pool
+        self.graph_cache = graph_cache
+        self.mkgraph = mkgraph
+        self.segment_len = segment_len
+        self.kwargs = kwargs
+        self.ms = metasentence.MetaSentence(transcript, resources.vocab)
+
+    def transcribe(self, wavfile, progress_cb=None, logging=None, checkpoint=None):
+        # Every segment's graphs are compiled by the same warm m3 servers
+        mkgraph = self.mkgraph
+        if mkgraph is None:
+            mkgraph = language_model.MkgraphServer(self.resources.proto_langdir, nprocs=self.nthreads)
+        try:
+            return self._transcribe(wavfile, progress_cb, logging, checkpoint, mkgraph)
+        finally:
+            if self.mkgraph is None:
+                mkgraph.stop()
+
+    def _transcribe(self, wavfile, progress_cb, logging, checkpoint, mkgraph):
+        if not os.path.exists(self.resources.full_hclg_path):
+            # no first pass, no anchors
+            aligner = ForcedAligner(self.resources, self.transcript, nthreads=self.nthreads, pool=self.pool,
+                                    graph_cache=self.graph_cache, mkgraph=mkgraph, **self.kwargs)
+            return aligner.transcribe(wavfile, progress_cb=progress_cb, logging=logging, checkpoint=checkpoint)
+
+        pool = self.pool
+        if pool is None:
+            pool = DecoderScheduler(self.resources, nslots=self.nthreads)
+        try:
+            with PCMBuffer.open(wavfile) as pcm:
+                # First pass (as the audio is resampled, if it's streamed)
+                job = pool.checkout(self.resources.full_hclg_path, nthreads=self.nthreads,
+                                    duration=pcm.duration if pcm.complete else None)
+                try:
+                    mtt = MultiThreadedTranscriber(job, nthreads=self.nthreads)
+                    words, duration = mtt.transcribe(pcm, progress_cb=progress_cb, checkpoint=checkpoint,
+                                                   graph_key=self.resources.full_hclg_path)
+                finally:
+                    pool.checkin(job)
+                cuts = find_cuts(diff_align.align(words, self.ms), self.ms, self.segment_len)
+                segments = self._segments(cuts, duration)
+                if logging is not None:
+                    logging.info("aligning %d segments" % len(segments))
+                if progress_cb is not None:
+                    progress_cb({'status': 'ALIGNING'})
+
+                done = []
+                def align_segment(segment):
+                    text_start, text_end, start_t, end_t = segment
+                    aligner = ForcedAligner(self.resources, self.ms.raw_sentence[text_start:text_end],
+                                            nthreads=1, pool=pool, graph_cache=self.graph_cache,
+                                            mkgraph=mkgraph, **self.kwargs)
+                    # (the segment's audio is read where it is)
+                    with pcm.view(start_t, end_t - start_t) as seg_pcm:
+                        result = aligner.transcribe(seg_pcm, checkpoint=checkpoint)
+
+                    done.append(segment)
+                    if progress_cb is not None:
+                        progress_cb({'percent': len(done) / float(len(segments))})
+                    return [wd.shift(time=start_t, offset=text_start) for wd in result.words]
+
+                workers = Pool(min(self.nthreads, len(segments)))
+                try:
+                    results = workers.map(align_segment, segments, chunksize=1)
+                finally:
+                    workers.close()
+        finally:
+            if self.pool is None:
+                pool.stop()
+
+        return Transcription(words=[wd for words in results for wd in words], transcript=self.transcript)
+
+    def _segments(self, cuts, duration):
+        '''(text start, text end, start time, end time) of the segments
+        between `cuts`'''
+        offsets = self.ms.get_text_offsets()
+        segments = []
+        text_start, start_t = 0, 0
+        for tok_idx, cut_t in cuts:
+            text_end = offsets[tok_idx][1]
+            segments.append((text_start, text_end, start_t, cut_t))
+            text_start, start_t = text_end, cut_t
+        segments.append((text_start, len(self.ms.raw_sentence), start_t, duration))
+        return segments
@@ -1,15 +1,279 @@
-from queue import Queue
+import logging
+import threading
+import time
+
+from queue import Queue, Empty
 from gentle import standard_kaldi
 
-def build(resources, nthreads=4, hclg_path=None):
+# Seconds a k3 process may take to load its models
+STARTUP_TIMEOUT = 300
+
+def spawn(resources, nthreads=4, hclg_path=None, slots_per_process=1):
+    '''Starts `nthreads` decoders, packed `slots_per_process` to a k3
+    process so that they share one copy of the acoustic model.  The
+    processes load in parallel; this doesn't wait for them.'''
+    workers = []
+    while len(workers) < nthreads:
+        nslots = min(slots_per_process, nthreads - len(workers))
+        if nslots == 1:
+            workers.append(standard_kaldi.Kaldi(
+                resources.nnet_gpu_path,
+                hclg_path,
+                resources.proto_langdir)
+            )
+        else:
+            workers.extend(standard_kaldi.Kaldi.spawn_slots(
+                nslots,
+                resources.nnet_gpu_path,
+                hclg_path,
+                resources.proto_langdir)
+            )
+    return workers
+
+class Supervisor():
+    '''Replaces k3 workers that die or hang.  A replacement is a fresh
+    single-decoder process without a graph (the graph the failed worker
+    had may well be gone by now): the queue it joins loads the one it
+    needs (see `KaldiQueue.get`).  If workers keep failing (`max_failures`
+    within `window` seconds) the circuit opens: failed workers are dropped
+    instead of respawned, so a broken install or a poisonous graph doesn't
+    turn into a fork loop.'''
+
+    def __init__(self, resources, max_failures=5, window=300):
+        self.resources = resources
+        self.max_failures = max_failures
+        self.window = window
+        self.restarts = 0
+        self.dropped = 0
+        self._failures = [] # (time, pid) of recent failures
+        self._lock = threading.Lock()
+
+    def _recent(self):
+        now = time.time()
+        self._failures = [(t, pid) for t, pid in self._failures if t > now - self.window]
+        return self._failures
+
+    def failed(self, pid=None):
+        '''Records the failure of a worker (of k3 process `pid`).  The
+        decoders sharing a process fail together, and count once.'''
+        with self._lock:
+            if pid is not None and pid in [p for _, p in self._recent()]:
+                return
+            self._failures.append((time.time(), pid))
+
+    @property
+    def circuit_open(self):
+        with self._lock:
+            return len(self._recent()) >= self.max_failures
+
+    def respawn(self):
+        '''Returns a new worker, or None if the circuit is open.  The worker
+        still has to load (see `Kaldi.wait_ready`).'''
+        if self.circuit_open:
+            with self._lock:
+                self.dropped += 1
+            return None
+        with self._lock:
+            self.restarts += 1
+        return self._spawn()
+
+    def _spawn(self):
+        return spawn(self.resources, 1)[0]
+
+    def stats(self):
+        with self._lock:
+            recent = len(self._recent())
+            return {
+                'restarts': self.restarts,
+                'dropped': self.dropped,
+                'recent_failures': recent,
+                'circuit_open': recent >= self.max_failures,
+            }
+
+class KaldiQueue(Queue):
+    '''A queue of decoders that fills up as they finish loading, so work
+    can start on the first one that's ready while the rest warm up.
+    Workers that don't report ready within `startup_timeout` seconds, or
+    that fail while in use (see `replace`), are killed and respawned by the
+    `supervisor`, or dropped if there isn't one.  With `hclg_path`, `get`
+    loads that graph into workers that don't have it yet.'''
+
+    def __init__(self, workers, startup_timeout=STARTUP_TIMEOUT, supervisor=None, ready=False, hclg_path=None, on_drop=None):
+        Queue.__init__(self)
+        self.size = len(workers) # workers that are, or will be, in the queue
+        self.startup_timeout = startup_timeout
+        self.supervisor = supervisor
+        self.hclg_path = hclg_path
+        # called when a worker is dropped, for whoever else counts it
+        self.on_drop = on_drop
+        self._size_lock = threading.Lock()
+        for k in workers:
+            if ready:
+                self.put(k)
+            else:
+                self._watch(k)
+
+    def _watch(self, k):
+        t = threading.Thread(target=self._wait_ready, args=(k,))
+        t.daemon = True
+        t.start()
+
+    def _wait_ready(self, k):
+        try:
+            k.wait_ready(self.startup_timeout)
+        except standard_kaldi.KaldiError as e:
+            logging.error("k3 worker failed to start: %s", e)
+            self.replace(k)
+            return
+        self.put(k)
+
+    def replace(self, k):
+        '''Kills a worker that has failed and queues a replacement for it
+        once it has loaded.  The caller must not put `k` back.'''
+        k.kill()
+        new_k = None
+        if self.supervisor is not None:
+            self.supervisor.failed(k.pid)
+            new_k = self.supervisor.respawn()
+        if new_k is not None:
+            self._watch(new_k)
+            return
+        logging.error("dropping k3 worker")
+        self.drop()
+        if self.on_drop is not None:
+            self.on_drop()
+
+    def drop(self):
+        '''Counts one worker less'''
+        with self._size_lock:
+            self.size -= 1
+        Queue.put(self, None) # wake up anyone waiting on the dropped worker
+
+    def get(self, block=True, timeout=None):
+        while True:
+            k = Queue.get(self, block, timeout)
+            if k is not None and k.alive():
+                if self._load_graph(k):
+                    return k
+            elif k is not None:
+                # died while idle
+                self.replace(k)
+            elif self.size == 0:
+                raise RuntimeError("No k3 worker could be started")
+
+    def _load_graph(self, k):
+        if self.hclg_path is None:
+            return True
+        try:
+            ok = k.load_graph(self.hclg_path)
+        except standard_kaldi.KaldiError:
+            self.replace(k)
+            return False
+        if not ok:
+            self.put(k)
+            raise RuntimeError("Unable to load decoding graph %s" % self.hclg_path)
+        return True
+
+    def stop(self):
+        '''Stops every worker, waiting for the ones that are still loading'''
+        stopped = 0
+        while stopped < self.size:
+            k = Queue.get(self)
+            if k is not None:
+                k.stop()
+                stopped += 1
+
+def build(resources, nthreads=4, hclg_path=None, slots_per_process=1, startup_timeout=STARTUP_TIMEOUT):
 
     if hclg_path is None: hclg_path = resources.full_hclg_path
 
-    kaldi_queue = Queue()
-    for i in range(nthreads):
-        kaldi_queue.put(standard_kaldi.Kaldi(
-            resources.nnet_gpu_path,
-            hclg_path,
-            resources.proto_langdir)
-        )
-    return kaldi_queue
+    return KaldiQueue(spawn(resources, nthreads, hclg_path, slots_per_process),
+                      startup_timeout=startup_timeout,
+                      supervisor=Supervisor(resources),
+                      hclg_path=hclg_path)
+
+class _IdleQueue(KaldiQueue):
+    '''The idle workers of a KaldiPool.  A worker that becomes free (it
+    has finished loading, or was checked in) goes to a job that's short of
+    workers first, if there is one.'''
+
+    def __init__(self, pool, workers, **kwargs):
+        self.pool = pool
+        KaldiQueue.__init__(self, workers, **kwargs)
+
+    def put(self, k, block=True, timeout=None):
+        if not self.pool._lend(k):
+            KaldiQueue.put(self, k, block, timeout)
+
+class KaldiPool():
+    '''A long-lived set of k3 workers that keep the acoustic model loaded
+    between jobs.  A job checks out workers, switches them to its own
+    decoding graph, and checks them back in when it's done.'''
+
+    def __init__(self, resources, nthreads=4, slots_per_process=1, startup_timeout=STARTUP_TIMEOUT):
+        self.resources = resources
+        self.nthreads = nthreads
+        self.supervisor = Supervisor(resources)
+        self._lock = threading.Lock()
+        self._short = {} # checked-out queues: how many more workers they can take
+        self._idle = _IdleQueue(self, spawn(resources, nthreads, None, slots_per_process),
+                                startup_timeout=startup_timeout,
+                                supervisor=self.supervisor)
+
+    def checkout(self, hclg_path, nthreads=4, duration=None):
+        '''Returns a queue of up to `nthreads` workers that load `hclg_path`
+        as they're used.  Blocks until at least one worker is idle; workers
+        that become free later (say, once they've warmed up) join the queue
+        until the job has `nthreads` or is checked in.  (`duration` is for
+        compatibility with scheduler.DecoderScheduler.)'''
+        k = self._idle.get()
+        # replacements for workers that fail during the job go back to
+        # the pool at checkin, like the others
+        kaldi_queue = KaldiQueue([k], self._idle.startup_timeout,
+                                 supervisor=self.supervisor, ready=True, hclg_path=hclg_path,
+                                 on_drop=self._idle.drop)
+        if nthreads > 1:
+            with self._lock:
+                self._short[kaldi_queue] = nthreads - 1
+            while True:
+                try:
+                    k = self._idle.get_nowait()
+                except Empty:
+                    break
+                if not self._lend(k):
+                    self._idle.put(k)
+                    break
+        return kaldi_queue
+
+    def _lend(self, k):
+        '''Gives a free worker to the first job that's short of workers.
+        Returns whether there was one.'''
+        with self._lock:
+            if not self._short:
+                return False
+            kaldi_queue = next(iter(self._short))
+            self._short[kaldi_queue] -= 1
+            if self._short[kaldi_queue] == 0:
+                del self._short[kaldi_queue]
+            with kaldi_queue._size_lock:
+                kaldi_queue.size += 1
+        kaldi_queue.put(k)
+        return True
+
+    def checkin(self, kaldi_queue):
+        '''Returns all the workers in a queue from `checkout` to the pool,
+        waiting for any replacements that are still loading'''
+        with self._lock:
+            self._short.pop(kaldi_queue, None)
+        returned = 0
+        while returned < kaldi_queue.size:
+            k = Queue.get(kaldi_queue)
+            if k is not None:
+                self._idle.put(k)
+                returned += 1
+
+    def stats(self):
+        return self.supervisor.stats()
+
+    def stop(self):
+        self._idle.stop()
@@ -1,10 +1,17 @@
+import array
+import hashlib
 import logging
 import math
 import os
+import select
 import shutil
+import struct
 import subprocess
 import sys
 import tempfile
+import threading
+
+from queue import Queue
 
 from .util.paths import get_binary
 from .metasentence import MetaSentence
@@ -12,13 +19,19 @@ from .resources import Resources
 
 MKGRAPH_PATH = get_binary("ext/m3")
 
+# Seconds an m3 server may take to compile a graph before giving up on it
+COMPILE_TIMEOUT = 600
+
 # [oov] no longer in words.txt
 OOV_TERM = '<unk>'
 
-def make_bigram_lm_fst(word_sequences, **kwargs):
+def bigram_lm_arcs(word_sequences, **kwargs):
     '''
-    Use the given token sequence to make a bigram language model
-    in OpenFST plain text format.
+    Use the given token sequence to make a bigram language model.
+
+    Yields the arcs of the grammar as (from_id, to_id, word, weight)
+    tuples, followed by (final_id, None, None, None) for the final state.
+    The first arc leaves the start state.
 
     When the "conservative" flag is set, an [oov] is interleaved
     between successive words.
@@ -75,49 +88,357 @@ def make_bigram_lm_fst(word_sequences, **kwargs):
         node_ids[word] = node_id
         return node_id
 
-    output = ""
     for from_word in sorted(bigrams.keys()):
         from_id = get_node_id(from_word)
 
         successors = bigrams[from_word]
         if len(successors) > 0:
-            weight = -math.log(1.0 / len(successors))
+            # Rounded like the text format, so both encodings give the same graph
+            weight = float('%f' % -math.log(1.0 / len(successors)))
         else:
             weight = 0
 
         for to_word in sorted(successors):
-            to_id = get_node_id(to_word)
-            output += '%d    %d    %s    %s    %f' % (from_id, to_id, to_word, to_word, weight)
-            output += "\n"
+            yield (from_id, get_node_id(to_word), to_word, weight)
 
-    output += "%d    0\n" % (len(node_ids))
+    yield (len(node_ids), None, None, None)
 
-    return output.encode()
+def make_bigram_lm_fst(word_sequences, **kwargs):
+    '''
+    Make a bigram language model (see `bigram_lm_arcs`) in OpenFST plain
+    text format.
+    '''
+    lines = []
+    for from_id, to_id, word, weight in bigram_lm_arcs(word_sequences, **kwargs):
+        if to_id is None:
+            lines.append('%d    0\n' % (from_id))
+        else:
+            lines.append('%d    %d    %s    %s    %f\n' % (from_id, to_id, word, word, weight))
+
+    return ''.join(lines).encode()
 
-def make_bigram_language_model(kaldi_seq, proto_langdir, **kwargs):
+# Magic number of the binary grammar format read by m3
+BINARY_GRAMMAR_MAGIC = b'GBG1'
+
+def write_bigram_lm_binary(word_sequences, fh, **kwargs):
+    '''
+    Write a bigram language model (see `bigram_lm_arcs`) to `fh` in the
+    compact binary format that m3 reads directly, skipping the text FST
+    round-trip.  All integers are in native byte order:
+
+        magic            4 bytes, "GBG1"
+        num_words        uint32
+        num_arcs         uint32
+        final_state      uint32
+        words            num_words NUL-terminated UTF-8 strings
+        from_states      int32[num_arcs]
+        to_states        int32[num_arcs]
+        labels           int32[num_arcs], indexes into `words`
+        weights          float32[num_arcs]
+
+    States are numbered as in the text format; the start state is the
+    source of the first arc.
+    '''
+    word_ids = {}
+    words = []
+    from_states = array.array('i')
+    to_states = array.array('i')
+    labels = array.array('i')
+    weights = array.array('f')
+    final_state = 0
+
+    for from_id, to_id, word, weight in bigram_lm_arcs(word_sequences, **kwargs):
+        if to_id is None:
+            final_state = from_id
+            continue
+        label = word_ids.get(word)
+        if label is None:
+            label = word_ids[word] = len(words)
+            words.append(word)
+        from_states.append(from_id)
+        to_states.append(to_id)
+        labels.append(label)
+        weights.append(weight)
+
+    fh.write(BINARY_GRAMMAR_MAGIC)
+    fh.write(struct.pack('=III', len(words), len(labels), final_state))
+    for word in words:
+        fh.write(word.encode('utf-8'))
+        fh.write(b'\0')
+    for column in (from_states, to_states, labels, weights):
+        column.tofile(fh)
+
+# Inputs that m3 reads from `proto_langdir`; a change to any of them
+# invalidates cached graphs
+MKGRAPH_INPUTS = [
+    'langdir/L.fst',
+    'langdir/L_disambig.fst',
+    'langdir/phones/disambig.int',
+    'tdnn_7b_chain_online/final.mdl',
+    'tdnn_7b_chain_online/tree',
+    'tdnn_7b_chain_online/graph_pp/words.txt',
+]
+
+class GraphCache():
+    '''On-disk cache of generated HCLG graphs, keyed by a hash of the
+    token sequence, the language model options and the model files they
+    were built from.  The least-recently-used graphs are evicted once the
+    cache grows beyond `max_bytes`.
+
+    Graphs returned by the cache belong to it: callers must not remove
+    them.  Decoders read a graph whenever they switch to it, so `get` and
+    `put` return graphs already pinned (pinned graphs aren't evicted), and
+    the caller `unpin`s them once its job is done with them.
+    '''
+
+    def __init__(self, cache_dir, max_bytes=512 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._fingerprints = {}
+        self._pins = {} # path: number of jobs using it
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+    def _fingerprint(self, path):
+        '''Content hash of a model file, recomputed only when it changes'''
+        try:
+            st = os.stat(path)
+        except OSError:
+            return 'missing'
+        stamp = (st.st_size, st.st_mtime_ns)
+        cached = self._fingerprints.get(path)
+        if cached is not None and cached[0] == stamp:
+            return cached[1]
+        h = hashlib.sha1()
+        with open(path, 'rb') as fh:
+            for block in iter(lambda: fh.read(1 << 20), b''):
+                h.update(block)
+        digest = h.hexdigest()
+        self._fingerprints[path] = (stamp, digest)
+        return digest
+
+    def key(self, kaldi_seq, proto_langdir, **kwargs):
+        conservative = kwargs['conservative'] if 'conservative' in kwargs else False
+        disfluency = kwargs['disfluency'] if 'disfluency' in kwargs else False
+        disfluencies = kwargs['disfluencies'] if 'disfluencies' in kwargs else []
+
+        h = hashlib.sha1()
+        for name in MKGRAPH_INPUTS:
+            h.update(('%s %s\n' % (name, self._fingerprint(os.path.join(proto_langdir, name)))).encode())
+        h.update(('conservative=%s disfluency=%s\n' % (bool(conservative), bool(disfluency))).encode())
+        if disfluency:
+            h.update(('disfluencies=%s\n' % ' '.join(sorted(disfluencies))).encode())
+
+        if len(kaldi_seq) == 0 or type(kaldi_seq[0]) != list:
+            kaldi_seq = [kaldi_seq]
+        for seq in kaldi_seq:
+            h.update(b'\n')
+            h.update(' '.join(seq).encode('utf-8'))
+        return h.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + '_HCLG.fst')
+
+    def get(self, key):
+        '''Returns the path of a cached graph, pinned, or None'''
+        path = self._path(key)
+        with self._lock:
+            if os.path.exists(path):
+                os.utime(path) # mark as recently used
+                self.hits += 1
+                self._pin(path)
+                return path
+            self.misses += 1
+            return None
+
+    def put(self, key, hclg_filename):
+        '''Moves a freshly generated graph into the cache and returns its
+        new path, pinned'''
+        path = self._path(key)
+        tmp_path = '%s.%d.%d.tmp' % (path, os.getpid(), threading.get_ident())
+        shutil.move(hclg_filename, tmp_path)
+        with self._lock:
+            os.replace(tmp_path, path)
+            self._pin(path)
+            self._evict()
+        return path
+
+    def _pin(self, path):
+        self._pins[path] = self._pins.get(path, 0) + 1
+
+    def pin(self, path):
+        '''Keeps the graph at `path` from being evicted until `unpin`'''
+        with self._lock:
+            self._pin(path)
+
+    def unpin(self, path):
+        with self._lock:
+            n = self._pins.pop(path, 0) - 1
+            if n > 0:
+                self._pins[path] = n
+
+    def _evict(self):
+        entries = []
+        total = 0
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith('_HCLG.fst'):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+            total += st.st_size
+
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            if path in self._pins:
+                continue
+            try:
+                os.unlink(path)
+            except OSError:
+                continue
+            total -= size
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
+
+class MkgraphServer():
+    '''A set of long-running `m3 --server` processes that keep the lexicon,
+    tree and acoustic model loaded, so that each graph only pays for its
+    own compilation.  Up to `nprocs` graphs are compiled concurrently.
+
+    A process that dies, or doesn't answer within `timeout` seconds, is
+    replaced by a fresh one; the compilation it was doing fails.'''
+
+    def __init__(self, proto_langdir, nprocs=2, timeout=COMPILE_TIMEOUT):
+        self.proto_langdir = proto_langdir
+        self.timeout = timeout
+        self._procs = []
+        self._lock = threading.Lock()
+        self._idle = Queue()
+        for i in range(nprocs):
+            p = self._spawn()
+            self._procs.append(p)
+            self._idle.put(p)
+
+    def _spawn(self):
+        with open(os.devnull, 'wb') as devnull:
+            return subprocess.Popen([MKGRAPH_PATH, '--server', self.proto_langdir],
+                                    stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                    stderr=devnull, bufsize=0)
+
+    def _replace(self, p):
+        if p.poll() is None:
+            p.kill()
+        p.wait()
+        for pipe in (p.stdin, p.stdout):
+            try:
+                pipe.close()
+            except IOError:
+                pass
+        new_p = self._spawn()
+        with self._lock:
+            self._procs[self._procs.index(p)] = new_p
+        return new_p
+
+    def _request(self, p, grammar_filename, hclg_filename):
+        p.stdin.write(('compile\n%s\n%s\n' % (grammar_filename, hclg_filename)).encode())
+        p.stdin.flush()
+        readable, _, _ = select.select([p.stdout], [], [], self.timeout)
+        if not readable:
+            raise IOError('no reply within %ds' % self.timeout)
+        line = p.stdout.readline()
+        if not line:
+            raise IOError('exited with %s' % p.wait())
+        return line.strip().decode()
+
+    def compile(self, grammar_filename, hclg_filename):
+        '''Compiles a grammar FST into an HCLG graph, blocking until a
+        server process is available'''
+        p = self._idle.get()
+        try:
+            if p.poll() is not None:
+                logging.error("m3 server exited with %d: restarting it", p.returncode)
+                p = self._replace(p)
+            try:
+                status = self._request(p, grammar_filename, hclg_filename)
+            except (IOError, ValueError) as e:
+                # (maybe the grammar's fault, so it isn't retried)
+                logging.error("m3 server failed: %s", e)
+                p = self._replace(p)
+                raise RuntimeError("m3 failed while compiling %s: %s" % (grammar_filename, e))
+        finally:
+            self._idle.put(p)
+        if status != 'ok':
+            raise RuntimeError("m3 could not compile %s" % grammar_filename)
+
+    def stop(self):
+        for p in self._procs:
+            try:
+                if p.poll() is None:
+                    p.stdin.write(b'stop\n')
+                p.stdin.close()
+            except IOError:
+                pass # already gone
+            p.stdout.close()
+            try:
+                p.wait(self.timeout)
+            except subprocess.TimeoutExpired:
+                p.kill()
+                p.wait()
+        self._procs = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+def make_bigram_language_model(kaldi_seq, proto_langdir, cache=None, mkgraph=None, **kwargs):
     """Generates a language model to fit the text.
 
     Returns the filename of the generated language model FST.
-    The caller is resposible for removing the generated file.
+    The caller is resposible for removing the generated file, unless
+    it came from `cache` (a GraphCache): then it's pinned in the cache,
+    and the caller `unpin`s it instead.
+
+    When `mkgraph` (an MkgraphServer) is given, the graph is compiled by
+    one of its warm processes instead of a fresh m3.
 
     `proto_langdir` is a path to a directory containing prototype model data
     `kaldi_seq` is a list of words within kaldi's vocabulary.
     """
 
-    # Generate a textual FST
-    txt_fst = make_bigram_lm_fst(kaldi_seq, **kwargs)
-    txt_fst_file = tempfile.NamedTemporaryFile(delete=False)
-    txt_fst_file.write(txt_fst)
-    txt_fst_file.close()
+    if cache is not None:
+        key = cache.key(kaldi_seq, proto_langdir, **kwargs)
+        hclg_filename = cache.get(key)
+        if hclg_filename is not None:
+            return hclg_filename
+        return cache.put(key, make_bigram_language_model(kaldi_seq, proto_langdir, mkgraph=mkgraph, **kwargs))
+
+    # Generate the grammar FST
+    grammar_file = tempfile.NamedTemporaryFile(delete=False)
+    write_bigram_lm_binary(kaldi_seq, grammar_file, **kwargs)
+    grammar_file.close()
 
     hclg_filename = tempfile.mktemp(suffix='_HCLG.fst')
     try:
-        devnull = open(os.devnull, 'wb')
-        subprocess.check_output([MKGRAPH_PATH,
-                        proto_langdir,
-                        txt_fst_file.name,
-                        hclg_filename],
-                        stderr=devnull)
+        if mkgraph is not None:
+            mkgraph.compile(grammar_file.name, hclg_filename)
+        else:
+            devnull = open(os.devnull, 'wb')
+            subprocess.check_output([MKGRAPH_PATH,
+                            proto_langdir,
+                            grammar_file.name,
+                            hclg_filename],
+                            stderr=devnull)
     except Exception as e:
         try:
             os.unlink(hclg_filename)
@@ -125,7 +446,7 @@ def make_bigram_language_model(kaldi_seq, proto_langdir, **kwargs):
             pass
         raise e
     finally:
-        os.unlink(txt_fst_file.name)
+        os.unlink(grammar_file.name)
 
     return hclg_filename
 
@@ -1,4 +1,6 @@
 # coding=utf-8
+import array
+import bisect
 import re
 
 # [oov] no longer in words.txt
@@ -25,39 +27,92 @@ def kaldi_normalize(word, vocab):
 class MetaSentence:
     """Maintain two parallel representations of a sentence: one for
     Kaldi's benefit, and the other in human-legible form.
+
+    The tokens are kept in parallel arrays (text offsets, and ids into a
+    table of the distinct Kaldi tokens), built in one pass over the text.
+    Slicing a MetaSentence by token, or taking the tokens `between` two
+    text offsets, gives a sub-sentence that shares those arrays: it has
+    the same tokens and offsets as a MetaSentence of just that part of the
+    text would, without tokenizing it again.
     """
 
     def __init__(self, sentence, vocab):
-        self.raw_sentence = sentence
-
         if type(sentence) == bytes:
-            self.raw_sentence = sentence.decode('utf-8')
+            sentence = sentence.decode('utf-8')
         self.vocab = vocab
+        self._text = sentence
+        self._raw = sentence
+        self._offset = 0 # of our text in self._text
 
         self._tokenize()
+        self._lo = 0
+        self._hi = len(self._tokens)
 
     def _tokenize(self):
-        self._seq = []
-        for m in re.finditer(r'(\w|\’\w|\'\w)+', self.raw_sentence, re.UNICODE):
+        self._starts = array.array('i') # as unicode codepoint offsets
+        self._ends = array.array('i')
+        self._tokens = array.array('i')
+        self._names = []
+        token_ids = {}
+        word_ids = {} # each distinct word is only normalized once
+        for m in re.finditer(r'(\w|\’\w|\'\w)+', self._text, re.UNICODE):
             start, end = m.span()
             word = m.group()
-            token = kaldi_normalize(word, self.vocab)
-            self._seq.append({
-                "start": start, # as unicode codepoint offset
-                "end": end, # as unicode codepoint offset
-                "token": token,
-            })
+            token_id = word_ids.get(word)
+            if token_id is None:
+                token = kaldi_normalize(word, self.vocab)
+                token_id = token_ids.setdefault(token, len(token_ids))
+                if token_id == len(self._names):
+                    self._names.append(token)
+                word_ids[word] = token_id
+            self._starts.append(start)
+            self._ends.append(end)
+            self._tokens.append(token_id)
+
+    def _sub(self, lo, hi):
+        sub = MetaSentence.__new__(MetaSentence)
+        sub.__dict__.update(self.__dict__)
+        sub._lo, sub._hi = lo, hi
+        sub._offset = self._starts[lo] if lo < hi else 0
+        sub._raw = None
+        return sub
+
+    @property
+    def raw_sentence(self):
+        if self._raw is None:
+            if self._lo < self._hi:
+                self._raw = self._text[self._offset:self._ends[self._hi - 1]]
+            else:
+                self._raw = ''
+        return self._raw
+
+    def __len__(self):
+        return self._hi - self._lo
+
+    def __getitem__(self, idx):
+        '''The sub-sentence of tokens `idx` (a slice)'''
+        lo, hi, step = idx.indices(len(self))
+        if step != 1:
+            raise ValueError("MetaSentence slices must be contiguous")
+        return self._sub(self._lo + lo, self._lo + max(lo, hi))
+
+    def between(self, start_offset, end_offset):
+        '''The sub-sentence of the tokens within text offsets
+        [start_offset, end_offset)'''
+        lo = bisect.bisect_left(self._starts, self._offset + start_offset, self._lo, self._hi)
+        hi = bisect.bisect_right(self._ends, self._offset + end_offset, self._lo, self._hi)
+        return self._sub(lo, max(lo, hi))
 
     def get_kaldi_sequence(self):
-        return [x["token"] for x in self._seq]
+        names = self._names
+        return [names[x] for x in self._tokens[self._lo:self._hi]]
 
     def get_display_sequence(self):
-        display_sequence = []
-        for x in self._seq:
-            start, end = x["start"], x["end"]
-            word = self.raw_sentence[start:end]
-            display_sequence.append(word)
-        return display_sequence
+        text = self._text
+        return [text[start:end] for start, end in
+                zip(self._starts[self._lo:self._hi], self._ends[self._lo:self._hi])]
 
     def get_text_offsets(self):
-        return [(x["start"], x["end"]) for x in self._seq]
+        offset = self._offset
+        return [(start - offset, end - offset) for start, end in
+                zip(self._starts[self._lo:self._hi], self._ends[self._lo:self._hi])]
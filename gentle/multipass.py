@@ -1,28 +1,39 @@
 import logging
 from multiprocessing.pool import ThreadPool as Pool
 import os
-import wave
+import subprocess
+import threading
+import time
 
 from gentle import standard_kaldi
-from gentle import metasentence
+from gentle import kaldi_queue
 from gentle import language_model
 from gentle import diff_align
 from gentle import transcription
+from gentle.checkpoint import Checkpoint
+from gentle.pcm import PCMBuffer
 
 def prepare_multipass(alignment):
     to_realign = []
     last_aligned_word = None
     cur_unaligned_words = []
+    cur_start_idx = None
 
     for wd_idx,wd in enumerate(alignment):
         if wd.not_found_in_audio():
+            if len(cur_unaligned_words) == 0:
+                cur_start_idx = wd_idx
             cur_unaligned_words.append(wd)
+            cur_end_idx = wd_idx + 1
         elif wd.success():
             if len(cur_unaligned_words) > 0:
                 to_realign.append({
                     "start": last_aligned_word,
                     "end": wd,
-                    "words": cur_unaligned_words})
+                    "words": cur_unaligned_words,
+                    # the slice of `alignment` to replace
+                    "start_idx": cur_start_idx,
+                    "end_idx": cur_end_idx})
                 cur_unaligned_words = []
 
             last_aligned_word = wd
@@ -31,76 +42,200 @@ def prepare_multipass(alignment):
         to_realign.append({
             "start": last_aligned_word,
             "end": None,
-            "words": cur_unaligned_words})
+            "words": cur_unaligned_words,
+            "start_idx": cur_start_idx,
+            "end_idx": cur_end_idx})
 
     return to_realign
     
-def realign(wavfile, alignment, ms, resources, nthreads=4, progress_cb=None):
+def region_times(chunk, duration):
+    '''Start and end time of the audio between the words around a region'''
+    start_t = 0 if chunk["start"] is None else chunk["start"].end
+    end_t = duration if chunk["end"] is None else chunk["end"].start
+    return start_t, end_t
+
+def realign(wavfile, alignment, ms, resources, nthreads=4, progress_cb=None, pool=None, graph_cache=None, mkgraph=None, checkpoint=None,
+            min_duration=0.75, max_duration=60, budget=None, max_audio=None):
+    '''Second pass: decodes each stretch of audio where words weren't
+    found with a graph of just those words, and splices the results in.
+
+    Decoders come from `pool` (a kaldi_queue.KaldiPool or a
+    scheduler.DecoderScheduler), switching graphs between regions; without
+    one, a pool is started for the duration of the call.
+
+    Regions of `min_duration` to `max_duration` seconds are realigned,
+    longest first, until `budget` seconds have passed or `max_audio`
+    seconds of audio have been decoded; the words of the regions left
+    over stay not-found-in-audio.  `progress_cb` is told how many seconds
+    of audio are left to do ("remaining").'''
     to_realign = prepare_multipass(alignment)
     realignments = []
 
-    def realign(chunk):
-        wav_obj = wave.open(wavfile, 'rb')
-
-        if chunk["start"] is None:
-            start_t = 0
-        else:
-            start_t = chunk["start"].end
+    if len(to_realign) == 0:
+        return alignment
 
-        if chunk["end"] is None:
-            end_t = wav_obj.getnframes() / float(wav_obj.getframerate())
-        else:
-            end_t = chunk["end"].start
+    # Workers read the regions straight from the (memory-mapped) file,
+    # all of which is needed to place them
+    pcm = PCMBuffer.open(wavfile)
+    pcm.wait_complete()
 
+    # Longest first, so that the pool isn't left waiting on a long region
+    # at the end
+    order = []
+    for idx, chunk in enumerate(to_realign):
+        start_t, end_t = region_times(chunk, pcm.duration)
         duration = end_t - start_t
         # XXX: the minimum length seems bigger now (?)
-        if duration < 0.75 or duration > 60:
+        if duration < min_duration or duration > max_duration:
             logging.debug("cannot realign %d words with duration %f" % (len(chunk['words']), duration))
-            return
+            continue
+        order.append((duration, idx))
+    order.sort(key=lambda x: -x[0])
+
+    if len(order) == 0:
+        if pcm is not wavfile:
+            pcm.close()
+        return alignment
+
+    deadline = time.time() + budget if budget is not None else None
+    lock = threading.Lock()
+    work = {'remaining': sum(duration for duration, _ in order), 'started': 0.0, 'skipped': 0}
+
+    def within_budget(duration):
+        '''Claims `duration` seconds of the budget, if there's any left'''
+        with lock:
+            if (deadline is not None and time.time() > deadline) or \
+               (max_audio is not None and work['started'] + duration > max_audio):
+                work['skipped'] += 1
+                return False
+            work['started'] += duration
+            return True
+
+    def report(duration):
+        with lock:
+            work['remaining'] -= duration
+            remaining = work['remaining']
+        realignments.append(duration)
+        if progress_cb is not None:
+            progress_cb({"percent": len(realignments) / float(len(order)),
+                         "remaining": remaining})
+
+    # Compile the per-region graphs with warm m3 servers rather than one
+    # m3 process per region.  Servers and decoders of our own (when none
+    # are given) are started once a region needs them.
+    own = {}
+    own_lock = threading.Lock()
+    def started(name, start):
+        with own_lock:
+            if name not in own:
+                own[name] = start()
+            return own[name]
+
+    def get_mkgraph():
+        if mkgraph is not None:
+            return mkgraph
+        return started('mkgraph', lambda: language_model.MkgraphServer(resources.proto_langdir, nprocs=min(nthreads, len(order))))
+
+    def get_pool():
+        if pool is not None:
+            return pool
+        return started('pool', lambda: kaldi_queue.KaldiPool(resources, nthreads=min(nthreads, len(order))))
+
+    def decode(hclg_path, start_t, duration):
+        pool = get_pool()
+        queue = pool.checkout(hclg_path, nthreads=1, duration=duration)
+        try:
+            k = queue.get()
+            try:
+                offset, nsamples = pcm.region(start_t, duration)
+                if not k.push_region(pcm.path, offset, nsamples):
+                    raise standard_kaldi.KaldiError('cannot read %d samples at %d of %s' % (nsamples, offset, pcm.path))
+                result = k.get_final()
+            except standard_kaldi.KaldiError:
+                queue.replace(k)
+                raise
+            queue.put(k)
+            return result
+        finally:
+            pool.checkin(queue)
+
+    def realign(chunk):
+        start_t, end_t = region_times(chunk, pcm.duration)
+        duration = end_t - start_t
+        if not within_budget(duration):
+            report(duration)
+            return None
 
         # Create a language model
         offset_offset = chunk['words'][0].startOffset
-        chunk_len = chunk['words'][-1].endOffset - offset_offset
-        chunk_transcript = ms.raw_sentence[offset_offset:offset_offset+chunk_len].encode("utf-8")
-        chunk_ms = metasentence.MetaSentence(chunk_transcript, resources.vocab)
+        chunk_ms = ms.between(offset_offset, chunk['words'][-1].endOffset)
+        chunk_transcript = chunk_ms.raw_sentence
         chunk_ks = chunk_ms.get_kaldi_sequence()
 
-        chunk_gen_hclg_filename = language_model.make_bigram_language_model(chunk_ks, resources.proto_langdir)
-        k = standard_kaldi.Kaldi(
-            resources.nnet_gpu_path,
-            chunk_gen_hclg_filename,
-            resources.proto_langdir)
-
-        wav_obj = wave.open(wavfile, 'rb')
-        wav_obj.setpos(int(start_t * wav_obj.getframerate()))
-        buf = wav_obj.readframes(int(duration * wav_obj.getframerate()))
-
-        k.push_chunk(buf)
-        ret = [transcription.Word(**wd) for wd in k.get_final()]
-        k.stop()
+        # A region is identified by its time span and transcript
+        region_key = None
+        result = None
+        if checkpoint is not None:
+            region_key = Checkpoint.key('realign', start_t, end_t, chunk_transcript)
+            result = checkpoint.load(region_key, 'region')
+
+        if result is None:
+            chunk_gen_hclg_filename = None
+            try:
+                chunk_gen_hclg_filename = language_model.make_bigram_language_model(chunk_ks, resources.proto_langdir, cache=graph_cache, mkgraph=get_mkgraph())
+                result = decode(chunk_gen_hclg_filename, start_t, duration)
+            except (standard_kaldi.KaldiError, RuntimeError, OSError, subprocess.CalledProcessError) as e:
+                # keep what the first pass found
+                logging.warning("cannot realign %d words: %s" % (len(chunk['words']), e))
+                report(duration)
+                return None
+            finally:
+                if chunk_gen_hclg_filename is not None:
+                    # (a cached graph is pinned until we're done with it)
+                    if graph_cache is not None:
+                        graph_cache.unpin(chunk_gen_hclg_filename)
+                    else:
+                        os.unlink(chunk_gen_hclg_filename)
+            if checkpoint is not None:
+                checkpoint.save(region_key, 'region', result)
+
+        ret = [transcription.Word(**wd) for wd in result]
 
         word_alignment = diff_align.align(ret, chunk_ms)
 
         for wd in word_alignment:
             wd.shift(time=start_t, offset=offset_offset)
 
-        # "chunk" should be replaced by "words"
-        realignments.append({"chunk": chunk, "words": word_alignment})
-
-        if progress_cb is not None:
-            progress_cb({"percent": len(realignments) / float(len(to_realign))})
-
-    pool = Pool(nthreads)
-    pool.map(realign, to_realign)
-    pool.close()
-
-    # Sub in the replacements
-    o_words = alignment
-    for ret in realignments:
-        st_idx = o_words.index(ret["chunk"]["words"][0])
-        end_idx= o_words.index(ret["chunk"]["words"][-1])+1
-        #logging.debug('splice in: "%s' % (str(ret["words"])))
-        #logging.debug('splice out: "%s' % (str(o_words[st_idx:end_idx])))
-        o_words = o_words[:st_idx] + ret["words"] + o_words[end_idx:]
+        report(duration)
+        return word_alignment
+
+    def realign_idx(idx):
+        return idx, realign(to_realign[idx])
+
+    results = [None] * len(to_realign)
+    threads = Pool(nthreads)
+    try:
+        for idx, words in threads.imap_unordered(realign_idx, [idx for _, idx in order]):
+            results[idx] = words
+    finally:
+        threads.close()
+        for server in own.values():
+            server.stop()
+        if pcm is not wavfile:
+            pcm.close()
+
+    if work['skipped']:
+        logging.warning("out of time: %d regions left unaligned" % work['skipped'])
+
+    # Sub in the replacements (the regions are in order)
+    o_words = []
+    idx = 0
+    for chunk, words in zip(to_realign, results):
+        if words is None:
+            continue
+        o_words.extend(alignment[idx:chunk["start_idx"]])
+        o_words.extend(words)
+        idx = chunk["end_idx"]
+    o_words.extend(alignment[idx:])
 
     return o_words
@@ -0,0 +1,154 @@
+import mmap
+import os
+import struct
+import threading
+
+class PCMBuffer():
+    '''16-bit mono PCM audio in a file (a WAV file from `resample`, or raw
+    samples), memory-mapped once and shared by everyone working on it.
+
+    Decoder workers are handed (offset, nsamples) regions of the file
+    rather than copies of the audio.'''
+
+    # all of the audio is there (see StreamedPCM)
+    complete = True
+
+    def __init__(self, path, rate=8000, data_offset=0, nframes=None):
+        self.path = os.path.abspath(path)
+        self.rate = rate
+        self.data_offset = data_offset
+        if nframes is None:
+            nframes = (os.path.getsize(path) - data_offset) // 2
+        self.nframes = nframes
+        self._mmap = None
+
+    @classmethod
+    def from_wavfile(cls, wavfile):
+        '''Locates the sample data of a 16-bit mono WAV file'''
+        with open(wavfile, 'rb') as fh:
+            riff, _, wave_id = struct.unpack('<4sI4s', fh.read(12))
+            if riff != b'RIFF' or wave_id != b'WAVE':
+                raise ValueError("Not a WAV file: %s" % wavfile)
+
+            rate = None
+            while True:
+                header = fh.read(8)
+                if len(header) < 8:
+                    raise ValueError("No data chunk in %s" % wavfile)
+                chunk_id, chunk_size = struct.unpack('<4sI', header)
+                if chunk_id == b'fmt ':
+                    fmt = fh.read(chunk_size)
+                    _, nchannels, rate, _, _, bits = struct.unpack('<HHIIHH', fmt[:16])
+                    if nchannels != 1 or bits != 16:
+                        raise ValueError("Expected 16-bit mono audio in %s" % wavfile)
+                    fh.seek(chunk_size % 2, os.SEEK_CUR)
+                elif chunk_id == b'data':
+                    data_offset = fh.tell()
+                    break
+                else:
+                    fh.seek(chunk_size + chunk_size % 2, os.SEEK_CUR)
+
+        # Streamed WAV headers don't always have a usable data size
+        nframes = min(chunk_size, os.path.getsize(wavfile) - data_offset) // 2
+        return cls(wavfile, rate=rate or 8000, data_offset=data_offset, nframes=nframes)
+
+    @classmethod
+    def open(cls, audio):
+        '''`audio` if it's a PCMBuffer already, else the PCMBuffer of the
+        WAV file at that path'''
+        if isinstance(audio, PCMBuffer):
+            return audio
+        return cls.from_wavfile(audio)
+
+    def view(self, start_t, duration):
+        '''A PCMBuffer of a region of this one: the same file, without
+        copying anything'''
+        offset, nsamples = self.region(start_t, duration)
+        return PCMBuffer(self.path, self.rate, data_offset=offset, nframes=nsamples)
+
+    def wait(self, nframes):
+        '''Returns the number of frames, once there are at least `nframes`
+        or the audio is complete'''
+        return self.nframes
+
+    def wait_complete(self):
+        return self.nframes
+
+    @property
+    def duration(self):
+        return self.nframes / float(self.rate)
+
+    def region(self, start_t, duration):
+        '''Returns (byte offset, number of samples) of the audio starting at
+        `start_t` seconds, clipped to the end of the buffer'''
+        start = min(max(int(start_t * self.rate), 0), self.nframes)
+        end = min(start + int(duration * self.rate), self.nframes)
+        return self.data_offset + 2 * start, end - start
+
+    def frames(self, start_t, duration):
+        '''Returns the samples of a region as a read-only memoryview of the
+        mapped file (no copy)'''
+        offset, nsamples = self.region(start_t, duration)
+        if nsamples == 0:
+            return memoryview(b'')
+        if self._mmap is None or len(self._mmap) < offset + 2 * nsamples:
+            # (re)map a file that has grown (see StreamedPCM): the old map
+            # stays valid for views already handed out
+            self._map()
+        return memoryview(self._mmap)[offset:offset + 2 * nsamples]
+
+    def _map(self):
+        with open(self.path, 'rb') as fh:
+            self._mmap = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class StreamedPCM(PCMBuffer):
+    '''Raw PCM in a file that is still being written (by
+    `resample.streamed`): `nframes` grows as the writer calls `extend`,
+    until it calls `finish`.  Readers `wait` for the frames they need;
+    regions and frames already written are valid as they are.'''
+
+    def __init__(self, path, rate=8000):
+        PCMBuffer.__init__(self, path, rate, data_offset=0, nframes=0)
+        self.complete = False
+        self.error = None
+        self._cond = threading.Condition()
+
+    def extend(self, nframes):
+        '''Writer: the first `nframes` frames are in the file'''
+        with self._cond:
+            self.nframes = nframes
+            self._cond.notify_all()
+
+    def finish(self, error=None):
+        '''Writer: there's no more audio (or there was an `error`)'''
+        with self._cond:
+            self.complete = True
+            self.error = error
+            self._cond.notify_all()
+
+    def wait(self, nframes):
+        with self._cond:
+            while not self.complete and self.nframes < nframes:
+                self._cond.wait()
+            if self.error is not None:
+                raise RuntimeError(self.error)
+            return self.nframes
+
+    def wait_complete(self):
+        with self._cond:
+            while not self.complete:
+                self._cond.wait()
+            if self.error is not None:
+                raise RuntimeError(self.error)
+            return self.nframes
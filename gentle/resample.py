@@ -1,10 +1,12 @@
 import os
 import subprocess
 import tempfile
+import threading
 
 from contextlib import contextmanager
 
 
+from .pcm import StreamedPCM
 from .util.paths import get_binary
 
 FFMPEG = get_binary("ffmpeg")
@@ -16,6 +18,12 @@ def resample(infile, outfile, offset=None, duration=None):
     '''
     Use FFMPEG to convert a media file to a wav file sampled at 8K
     '''
+    return subprocess.call(_ffmpeg_cmd(infile, offset, duration, [
+        '-acodec', 'pcm_s16le',
+        outfile
+    ]))
+
+def _ffmpeg_cmd(infile, offset, duration, output):
     if offset is None:
         offset = []
     else:
@@ -25,7 +33,7 @@ def resample(infile, outfile, offset=None, duration=None):
     else:
         duration = ['-t', str(duration)]
 
-    cmd = [
+    return [
         FFMPEG,
         '-loglevel', 'panic',
         '-y',
@@ -33,10 +41,49 @@ def resample(infile, outfile, offset=None, duration=None):
         '-i', infile,
     ] + duration + [
         '-ac', '1', '-ar', '8000',
-        '-acodec', 'pcm_s16le',
-        outfile
-    ]
-    return subprocess.call(cmd)
+    ] + output
+
+def resample_stream(infile, outfile, offset=None, duration=None, block_size=65536):
+    '''
+    Like `resample`, but ffmpeg's raw 8K samples are read from a pipe and
+    appended to `outfile` as they come.  Returns a pcm.StreamedPCM of
+    `outfile` straight away, which grows until ffmpeg is done: decoding
+    the start of the audio needn't wait for the rest to be converted.
+    '''
+    if not os.path.isfile(infile):
+        raise IOError("Not a file: %s" % infile)
+
+    proc = subprocess.Popen(_ffmpeg_cmd(infile, offset, duration, [
+        '-f', 's16le',
+        'pipe:1'
+    ]), stdout=subprocess.PIPE)
+    out = open(outfile, 'wb')
+    pcm = StreamedPCM(outfile)
+    pcm.process = proc
+
+    def pump():
+        error = None
+        try:
+            nbytes = 0
+            while True:
+                block = proc.stdout.read1(block_size)
+                if not block:
+                    break
+                out.write(block)
+                out.flush()
+                nbytes += len(block)
+                pcm.extend(nbytes // 2)
+            if proc.wait() != 0:
+                error = "Unable to resample/encode '%s'" % infile
+        except (IOError, ValueError) as e:
+            error = "Unable to resample/encode '%s': %s" % (infile, e)
+        finally:
+            out.close()
+            proc.stdout.close()
+            pcm.finish(error)
+
+    threading.Thread(target=pump, daemon=True).start()
+    return pcm
 
 @contextmanager
 def resampled(infile, offset=None, duration=None):
@@ -44,3 +91,20 @@ def resampled(infile, offset=None, duration=None):
         if resample(infile, fp.name, offset, duration) != 0:
             raise RuntimeError("Unable to resample/encode '%s'" % infile)
         yield fp.name
+
+@contextmanager
+def streamed(infile, offset=None, duration=None):
+    '''Yields the pcm.StreamedPCM of `infile` being resampled (see
+    `resample_stream`), which works anywhere a resampled WAV file does'''
+    with tempfile.NamedTemporaryFile(suffix='.raw') as fp:
+        pcm = resample_stream(infile, fp.name, offset, duration)
+        try:
+            yield pcm
+        finally:
+            if pcm.process.poll() is None:
+                pcm.process.kill()
+            try:
+                pcm.wait_complete()
+            except RuntimeError:
+                pass # killed, or already raised to the reader
+            pcm.close()
@@ -2,7 +2,7 @@ import logging
 import os
 
 from .util.paths import get_resource, ENV_VAR
-from . import metasentence
+from . import vocabulary
 
 class Resources():
 
@@ -19,7 +19,13 @@ class Resources():
         require_dir(self.proto_langdir)
         require_dir(self.nnet_gpu_path)
 
-        with open(os.path.join(self.proto_langdir, "langdir", "words.txt")) as fh:
-            self.vocab = metasentence.load_vocabulary(fh)
+        self._vocab = None
+
+    @property
+    def vocab(self):
+        '''The words Kaldi knows, loaded on first use (see gentle.vocabulary)'''
+        if self._vocab is None:
+            self._vocab = vocabulary.load(os.path.join(self.proto_langdir, "langdir", "words.txt"))
+        return self._vocab
 
 
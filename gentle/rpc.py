@@ -1,18 +1,28 @@
+import select
+
 class RPCProtocol(object):
     '''RPCProtocol is the wire protocol we use to communicate with the
     standard_kaldi subprocess. It's a mixed text/binary protocol
-    because we need to send binary audio chunks, but text is simpler.'''
+    because we need to send binary audio chunks, but text is simpler.
+
+    The pipes are binary (unbuffered) file objects.'''
 
     def __init__(self, send_pipe, recv_pipe):
-        '''Initializes the RPCProtocol and reads from recv_pipe until the startup
-        message is received.'''
+        '''Initializes the RPCProtocol.  Doesn't wait for startup: see
+        wait_loaded.'''
         self.send_pipe = send_pipe
         self.recv_pipe = recv_pipe
 
-        # don't wait for startup
-        # body, _ = self._read_reply()
-        # if body != 'loaded':
-        #     raise RuntimeError('unexpected message from standard_kaldi on load')
+    def wait_loaded(self, timeout=None):
+        '''Reads from recv_pipe until the startup message is received.
+        Throws an IOError if nothing arrives within `timeout` seconds.'''
+        if timeout is not None:
+            readable, _, _ = select.select([self.recv_pipe], [], [], timeout)
+            if not readable:
+                raise IOError("Timed out waiting for standard_kaldi to load")
+        body, _ = self.read_reply()
+        if body != b'loaded':
+            raise RuntimeError('unexpected message from standard_kaldi on load')
 
     def do(self, method, *args, **kwargs):
         '''Performs the method requested and returns the response body.
@@ -20,7 +30,7 @@ class RPCProtocol(object):
         body. Throws an RPCError when the RPC returns an error.'''
         body = kwargs.get('body', None)
         self._write_request(method, args, body)
-        return self._read_reply()
+        return self.read_reply()
 
     def _write_request(self, method, args, body):
         '''Writes a request to the stream.
@@ -33,17 +43,29 @@ class RPCProtocol(object):
         for arg in args:
             data += ' ' + arg
         data += '\n'
+        data = data.encode()
         if body:
             data += body
 
         try:
-            self.send_pipe.write('%d\n' % len(data))
+            self.send_pipe.write(b'%d\n' % len(data))
             self.send_pipe.write(data)
-            self.send_pipe.write('\n')
+            self.send_pipe.write(b'\n')
         except IOError as _:
             raise IOError("Lost connection with standard_kaldi subprocess")
 
-    def _read_reply(self):
+    def _read_exactly(self, size):
+        '''Reads `size` bytes, looping over short reads from the pipe'''
+        chunks = []
+        while size > 0:
+            chunk = self.recv_pipe.read(size)
+            if not chunk:
+                raise IOError("Lost connection with standard_kaldi subprocess")
+            chunks.append(chunk)
+            size -= len(chunk)
+        return b''.join(chunks)
+
+    def read_reply(self):
         '''Reads a reply from the stream.
         Reply format:
         MSG_SIZE\n
@@ -52,12 +74,11 @@ class RPCProtocol(object):
         '''
         try:
             msg_size = int(self.recv_pipe.readline())
-            data = self.recv_pipe.read(msg_size)
-            self.recv_pipe.read(1) # trailing newline
+            data = self._read_exactly(msg_size + 1)[:-1] # trailing newline
 
-            status_str, body = data.split('\n', 1)
+            status_str, body = data.split(b'\n', 1)
             status = int(status_str)
-        except IOError as _:
+        except (IOError, ValueError) as _:
             raise IOError("Lost connection with standard_kaldi subprocess")
 
         if status < 200 or status >= 300:
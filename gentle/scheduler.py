@@ -0,0 +1,162 @@
+import logging
+import threading
+
+from queue import Queue, Empty
+from gentle import kaldi_queue
+from gentle import standard_kaldi
+
+# How the scheduler picks between jobs waiting for a decoder:
+#   fair: the job using the fewest decoders right now
+#   sjf:  the job with the least audio (shortest job first)
+POLICIES = ('fair', 'sjf')
+
+class Job():
+    '''A job's share of a `DecoderScheduler`.  Works like a
+    kaldi_queue.KaldiQueue: `get` a decoder (with the job's graph loaded)
+    for each chunk and `put` it back straight after, so that the scheduler
+    can hand it to whichever job should go next.'''
+
+    def __init__(self, scheduler, hclg_path, duration, seq):
+        self.scheduler = scheduler
+        self.hclg_path = hclg_path
+        self.duration = duration
+        self.seq = seq
+        self.held = 0    # decoders in use by the job
+        self.waiting = 0 # threads of the job blocked in `get`
+        self._granted = Queue()
+
+    def get(self):
+        while True:
+            k = self.scheduler._request(self)
+            try:
+                ok = k.load_graph(self.hclg_path)
+            except standard_kaldi.KaldiError:
+                self.replace(k)
+                continue
+            if not ok:
+                self.put(k)
+                raise RuntimeError("Unable to load decoding graph %s" % self.hclg_path)
+            return k
+
+    def put(self, k):
+        self.scheduler._release(self, k)
+
+    def replace(self, k):
+        '''Hands back a decoder that has failed (see `KaldiQueue.replace`)'''
+        self.scheduler._release(self, k, failed=True)
+
+class DecoderScheduler():
+    '''A fixed budget of `nslots` decoders shared by every job in the
+    process, so that concurrent jobs queue for decoders instead of each
+    starting their own.  Decoders are granted one chunk at a time; within a
+    job, whichever thread is free takes the next chunk.  Between jobs, the
+    `policy` decides (see POLICIES), and a decoder that already has a
+    job's graph loaded goes to that job when it's a tie.
+
+    Has the same checkout/checkin interface as kaldi_queue.KaldiPool.'''
+
+    def __init__(self, resources, nslots=4, slots_per_process=1, policy='fair',
+                 startup_timeout=kaldi_queue.STARTUP_TIMEOUT):
+        if policy not in POLICIES:
+            raise ValueError("Unknown scheduling policy: %s" % policy)
+        self.nslots = nslots
+        self.policy = policy
+        self.supervisor = kaldi_queue.Supervisor(resources)
+        self._idle = kaldi_queue.KaldiQueue(
+            kaldi_queue.spawn(resources, nslots, None, slots_per_process),
+            startup_timeout=startup_timeout,
+            supervisor=self.supervisor)
+
+        self._cond = threading.Condition()
+        self._jobs = []
+        self._seq = 0
+        self._error = None
+        self._stopping = False
+        self._thread = threading.Thread(target=self._dispatch)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def checkout(self, hclg_path, nthreads=4, duration=None):
+        '''Registers a job that decodes with `hclg_path`.  `duration` is the
+        length of its audio in seconds, for the `sjf` policy.  The job gets
+        decoders as it asks for them, up to one per thread (`nthreads`).'''
+        with self._cond:
+            self._seq += 1
+            job = Job(self, hclg_path, duration, self._seq)
+            self._jobs.append(job)
+        return job
+
+    def checkin(self, job):
+        with self._cond:
+            self._jobs.remove(job)
+
+    def _request(self, job):
+        with self._cond:
+            if self._error is not None:
+                raise RuntimeError(self._error)
+            job.waiting += 1
+            self._cond.notify_all()
+        k = job._granted.get()
+        if k is None:
+            raise RuntimeError(self._error)
+        return k
+
+    def _release(self, job, k, failed=False):
+        with self._cond:
+            job.held -= 1
+        if failed:
+            self._idle.replace(k)
+        else:
+            self._idle.put(k)
+
+    def _priority(self, job, k):
+        reload = k.hclg_path != job.hclg_path
+        duration = job.duration if job.duration is not None else float('inf')
+        if self.policy == 'sjf':
+            return (duration, job.held, reload, job.seq)
+        return (job.held, reload, duration, job.seq)
+
+    def _dispatch(self):
+        while not self._stopping:
+            try:
+                k = self._idle.get(timeout=1)
+            except Empty:
+                continue
+            except RuntimeError as e:
+                logging.error("decoder scheduler: %s", e)
+                with self._cond:
+                    self._error = str(e)
+                    for job in self._jobs:
+                        for _ in range(job.waiting):
+                            job._granted.put(None)
+                        job.waiting = 0
+                return
+
+            with self._cond:
+                while not self._stopping and not any(job.waiting for job in self._jobs):
+                    self._cond.wait()
+                if self._stopping:
+                    self._idle.put(k)
+                    return
+                job = min((job for job in self._jobs if job.waiting),
+                          key=lambda job: self._priority(job, k))
+                job.waiting -= 1
+                job.held += 1
+                job._granted.put(k)
+
+    def stats(self):
+        stats = self.supervisor.stats()
+        with self._cond:
+            stats['jobs'] = [{'duration': job.duration,
+                              'decoders': job.held,
+                              'waiting': job.waiting} for job in self._jobs]
+        stats['slots'] = self._idle.size
+        return stats
+
+    def stop(self):
+        '''Stops every decoder, once the jobs have handed them back'''
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        self._thread.join()
+        self._idle.stop()
@@ -1,7 +1,11 @@
+import array
+import select
+import struct
 import subprocess
 import os
 import logging
 
+from .rpc import RPCProtocol, RPCError
 from .util.paths import get_binary
 
 EXECUTABLE_PATH = get_binary("ext/k3")
@@ -9,24 +13,161 @@ logger = logging.getLogger(__name__)
 
 STDERR = subprocess.DEVNULL
 
+# Seconds to wait for k3 to answer a single command before giving up on it
+CALL_TIMEOUT = 300
+
+def _command(nnet_dir, hclg_path, extra_args=()):
+    cmd = [EXECUTABLE_PATH] + list(extra_args)
+
+    if nnet_dir is not None:
+        cmd.append(nnet_dir)
+        # Without a graph, k3 only loads the acoustic model and
+        # waits for `load_graph`
+        if hclg_path is not None:
+            cmd.append(hclg_path)
+
+    if hclg_path is not None and not os.path.exists(hclg_path):
+        logger.error('hclg_path does not exist: %s', hclg_path)
+    return cmd
+
+class KaldiError(IOError):
+    '''A k3 process failed to start, hung, or exited'''
+
 class Kaldi:
     def __init__(self, nnet_dir=None, hclg_path=None, proto_langdir=None):
-        cmd = [EXECUTABLE_PATH]
-        
-        if nnet_dir is not None:
-            cmd.append(nnet_dir)
-            cmd.append(hclg_path)
+        p = subprocess.Popen(_command(nnet_dir, hclg_path),
+                             stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                             stderr=STDERR, bufsize=0)
+        self._attach(p, p.stdin, p.stdout, hclg_path)
 
-        if not os.path.exists(hclg_path):
-            logger.error('hclg_path does not exist: %s', hclg_path)
-        self._p = subprocess.Popen(cmd,
-                                   stdin=subprocess.PIPE, stdout=subprocess.PIPE,
-                                   stderr=STDERR, bufsize=0)
+    def _attach(self, p, stdin, stdout, hclg_path, siblings=None):
+        self._p = p
+        self._stdin = stdin
+        self._stdout = stdout
+        self.hclg_path = hclg_path
+        self._rpc = RPCProtocol(stdin, stdout)
+        # handles on the same k3 process (see `spawn_slots`)
+        self._siblings = siblings if siblings is not None else [self]
         self.finished = False
+        self.timeout = CALL_TIMEOUT
+
+    @classmethod
+    def spawn_slots(cls, nslots, nnet_dir=None, hclg_path=None, proto_langdir=None):
+        '''Starts a single k3 process that runs `nslots` decoders on
+        separate threads, sharing one copy of the acoustic model (and of
+        the graph, while they use the same one).  Returns a Kaldi handle per
+        decoder; each can be used from its own thread.'''
+        child_fds = []
+        parent_fds = []
+        for i in range(nslots):
+            cmd_r, cmd_w = os.pipe()
+            reply_r, reply_w = os.pipe()
+            child_fds.append((cmd_r, reply_w))
+            parent_fds.append((cmd_w, reply_r))
+
+        slot_arg = '--slot-fds=' + ','.join('%d:%d' % fds for fds in child_fds)
+        try:
+            p = subprocess.Popen(_command(nnet_dir, hclg_path, [slot_arg]),
+                                 stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                                 stderr=STDERR, pass_fds=sum(child_fds, ()))
+        finally:
+            for fd in sum(child_fds, ()):
+                os.close(fd)
+
+        slots = []
+        for cmd_w, reply_r in parent_fds:
+            k = cls.__new__(cls)
+            k._attach(p,
+                      os.fdopen(cmd_w, 'wb', buffering=0),
+                      os.fdopen(reply_r, 'rb', buffering=0),
+                      hclg_path, siblings=slots)
+            slots.append(k)
+        return slots
+
+    def wait_ready(self, timeout=None):
+        '''Blocks until k3 has loaded its models (and initial graph)'''
+        try:
+            self._rpc.wait_loaded(timeout)
+        except (IOError, RuntimeError, RPCError) as e:
+            raise KaldiError(str(e))
+
+    def kill(self):
+        '''Stops the k3 process (and any decoders sharing it) without asking'''
+        for k in self._siblings:
+            k.finished = True
+        if self._p.poll() is None:
+            self._p.kill()
+        self._p.wait()
+        for k in self._siblings:
+            for pipe in (k._stdin, k._stdout):
+                try:
+                    pipe.close()
+                except IOError:
+                    pass
+
+    @property
+    def pid(self):
+        '''The k3 process (shared with the decoders of `spawn_slots`)'''
+        return self._p.pid
+
+    def alive(self):
+        '''Whether the decoder can still take commands'''
+        return not self.finished and self._p.poll() is None
+
+    def _fail(self, why):
+        # After a timeout or a short read we can't tell where we are in
+        # the protocol, so the decoder is unusable: kill it
+        logger.error('k3 worker failed: %s', why)
+        self.kill()
+        raise KaldiError(why)
 
     def _cmd(self, c):
-        self._p.stdin.write(("%s\n" % (c)).encode())
-        self._p.stdin.flush()
+        try:
+            self._stdin.write(("%s\n" % (c)).encode())
+            self._stdin.flush()
+        except (IOError, ValueError) as e:
+            self._fail('unable to send "%s": %s' % (c.split(' ')[0], e))
+
+    def _wait_reply(self):
+        '''Waits up to `timeout` seconds for k3 to start replying'''
+        try:
+            readable, _, _ = select.select([self._stdout], [], [], self.timeout)
+        except (IOError, ValueError) as e:
+            self._fail(str(e))
+        if not readable:
+            self._fail('no reply within %ds' % self.timeout)
+
+    def _read_status(self):
+        self._wait_reply()
+        try:
+            line = self._stdout.readline()
+        except (IOError, ValueError) as e:
+            self._fail(str(e))
+        if not line:
+            self._fail('k3 exited (status %s)' % self._p.poll())
+        return line.strip().decode()
+
+    def _read_reply(self):
+        self._wait_reply()
+        try:
+            body, _ = self._rpc.read_reply()
+        except IOError as e:
+            self._fail(str(e))
+        return body
+
+    def load_graph(self, hclg_path):
+        '''Switch the decoder to a different HCLG graph while keeping the
+        acoustic model loaded'''
+        if hclg_path == self.hclg_path:
+            return True
+        if not os.path.exists(hclg_path):
+            logger.error('hclg_path does not exist: %s', hclg_path)
+        self._cmd("load-graph %s" % (hclg_path))
+        status = self._read_status()
+        if status != 'ok':
+            return False
+        self.hclg_path = hclg_path
+        return True
 
     def push_chunk(self, buf):
         # Wait until we're ready
@@ -34,48 +175,146 @@ class Kaldi:
         
         cnt = int(len(buf)/2)
         self._cmd(str(cnt))
-        self._p.stdin.write(buf) #arr.tostring())
-        status = self._p.stdout.readline().strip().decode()
+        self._stdin.write(buf) #arr.tostring())
+        status = self._read_status()
+        return status == 'ok'
+
+    def push_region(self, path, offset, nsamples):
+        '''Like `push_chunk`, but k3 reads `nsamples` 16-bit samples at byte
+        `offset` of `path` itself (see pcm.PCMBuffer.region), so the audio
+        never goes through the pipe'''
+        self._cmd("push-region %d %d %s" % (offset, nsamples, path))
+        status = self._read_status()
         return status == 'ok'
 
     def get_final(self):
-        self._cmd("get-final")
-        words = []
-        while True:
-            line = self._p.stdout.readline().decode()
-            if line.startswith("done"):
-                break
-            parts = line.split(' / ')
-            if line.startswith('word'):
-                wd = {}
-                wd['word'] = parts[0].split(': ')[1]
-                wd['start'] = float(parts[1].split(': ')[1])
-                wd['duration'] = float(parts[2].split(': ')[1])
-                wd['phones'] = []
-                words.append(wd)
-            elif line.startswith('phone'):
-                ph = {}
-                ph['phone'] = parts[0].split(': ')[1]
-                ph['duration'] = float(parts[1].split(': ')[1])
-                words[-1]['phones'].append(ph)
+        self._cmd("get-final-frame")
+        body = self._read_reply()
+        words = result_to_words(decode_result(body))
 
         self._reset()
         return words
 
+    def get_partial(self):
+        '''Returns the current best hypothesis for the audio pushed so far,
+        in the same format as `get_final`, without ending the utterance'''
+        self._cmd("get-partial")
+        body = self._read_reply()
+        return result_to_words(decode_result(body))
+
+    def stream(self, chunks, rate=8000, stable_after=2, margin=0.5):
+        '''Pushes each chunk of `chunks` in turn and yields words as soon as
+        they stabilize, then the rest of the final hypothesis.
+
+        A chunk is either a buffer of 16-bit samples (see `push_chunk`) or a
+        (path, offset, nsamples) region (see `push_region`).  A word is
+        stable once it has been at the same place in `stable_after`
+        consecutive partial hypotheses and ended at least `margin` seconds
+        before the end of the audio pushed so far.'''
+        pushed_t = 0
+        n_emitted = 0
+        last_end = 0
+        history = []
+
+        for chunk in chunks:
+            if isinstance(chunk, tuple):
+                ok = self.push_region(*chunk)
+                pushed_t += chunk[2] / float(rate)
+            else:
+                ok = self.push_chunk(chunk)
+                pushed_t += len(chunk) / 2 / float(rate)
+            if not ok:
+                raise KaldiError('k3 rejected a chunk')
+
+            partial = self.get_partial()
+            history.append([(wd['word'], wd['start']) for wd in partial])
+            history = history[-stable_after:]
+            if len(history) < stable_after:
+                continue
+
+            # only the words past what we've already emitted can stabilize
+            i = n_emitted
+            while i < len(partial) and all(i < len(h) and h[i] == history[-1][i] for h in history):
+                wd = partial[i]
+                if wd['start'] + wd['duration'] > pushed_t - margin:
+                    break
+                last_end = wd['start'] + wd['duration']
+                yield wd
+                i += 1
+            n_emitted = i
+
+        # the final hypothesis may revise unstable words: emit whatever
+        # comes after the last word we've committed to
+        for wd in self.get_final():
+            if wd['start'] >= last_end - 0.01:
+                yield wd
+
     def _reset(self):
         self._cmd("reset")
 
     def stop(self):
         if not self.finished:
             self.finished = True
-            self._cmd("stop")
-            self._p.stdin.close()
-            self._p.stdout.close()
-            self._p.wait()
+            try:
+                self._stdin.write(b"stop\n")
+            except (IOError, ValueError):
+                pass # already gone
+            for pipe in (self._stdin, self._stdout):
+                try:
+                    pipe.close()
+                except IOError:
+                    pass
+            # the process exits once all of its decoders have stopped
+            if all(k.finished for k in self._siblings):
+                self._p.wait()
 
     def __del__(self):
         self.stop()
 
+def decode_result(body):
+    '''Decodes a get-final-frame reply from k3 into compact arrays:
+    word start/duration (in seconds), the number of phones per word, phone
+    durations, and the word and phone labels'''
+    n_words, n_phones, frame_shift = struct.unpack_from('=IIf', body)
+    pos = struct.calcsize('=IIf')
+
+    columns = []
+    for n in (n_words, n_words, n_words, n_phones):
+        column = array.array('i')
+        column.frombytes(body[pos:pos + n * column.itemsize])
+        pos += n * column.itemsize
+        columns.append(column)
+    word_start, word_length, word_nphones, phone_length = columns
+
+    labels = body[pos:].decode().split('\0')
+    return {
+        'start': array.array('d', (round(x * frame_shift, 6) for x in word_start)),
+        'duration': array.array('d', (round(x * frame_shift, 6) for x in word_length)),
+        'nphones': word_nphones,
+        'phone_duration': array.array('d', (round(x * frame_shift, 6) for x in phone_length)),
+        'words': labels[:n_words],
+        'phones': labels[n_words:n_words + n_phones],
+    }
+
+def result_to_words(result):
+    '''Converts `decode_result` arrays to the per-word dicts returned by
+    `Kaldi.get_final`'''
+    words = []
+    phone_idx = 0
+    phones = result['phones']
+    phone_duration = result['phone_duration']
+    for i, word in enumerate(result['words']):
+        end_idx = phone_idx + result['nphones'][i]
+        words.append({
+            'word': word,
+            'start': result['start'][i],
+            'duration': result['duration'][i],
+            'phones': [{'phone': phones[j], 'duration': phone_duration[j]}
+                       for j in range(phone_idx, end_idx)],
+        })
+        phone_idx = end_idx
+    return words
+
 if __name__=='__main__':
     import numm3
     import sys
@@ -83,6 +322,7 @@ if __name__=='__main__':
     infile = sys.argv[1]
     
     k = Kaldi()
+    k.wait_ready()
 
     buf = numm3.sound2np(infile, nchannels=1, R=8000)
     print('loaded_buf', len(buf))
@@ -0,0 +1,72 @@
+import array
+import bisect
+
+class _Intervals():
+    '''Time intervals sorted by start, with the latest end so far, so that
+    the ones overlapping a given time or range can be found by bisection'''
+
+    def __init__(self, intervals):
+        # (start, end, item)
+        intervals = sorted(intervals, key=lambda x: x[0])
+        self.starts = array.array('d', [start for start, _, _ in intervals])
+        self.ends = array.array('d', [end for _, end, _ in intervals])
+        self.items = [item for _, _, item in intervals]
+        self.latest = array.array('d')
+        latest = float('-inf')
+        for end in self.ends:
+            latest = max(latest, end)
+            self.latest.append(latest)
+
+    def overlapping(self, start_t, end_t=None):
+        '''Positions of the intervals active at `start_t` (start <= t < end)
+        or, given `end_t`, overlapping [start_t, end_t)'''
+        if end_t is None:
+            hi = bisect.bisect_right(self.starts, start_t)
+        else:
+            hi = bisect.bisect_left(self.starts, end_t)
+        # skip everything that has ended by start_t
+        lo = bisect.bisect_right(self.latest, start_t)
+        return [j for j in range(lo, hi) if self.ends[j] > start_t]
+
+class TimeIndex():
+    '''Finds the words and phones of an alignment that are being spoken at
+    a given time, or within a range of time, by bisection rather than by
+    going through all the words.  Built once per Transcription.'''
+
+    def __init__(self, transcription):
+        self.words = transcription.words or []
+
+        word_intervals = []
+        phone_intervals = []
+        for i, wd in enumerate(self.words):
+            if wd.start is None:
+                continue
+            word_intervals.append((wd.start, wd.end, i))
+            t = wd.start
+            for ph in wd.phones or []:
+                phone_intervals.append((t, t + ph['duration'], (i, ph['phone'])))
+                t += ph['duration']
+        self._words = _Intervals(word_intervals)
+        self._phones = _Intervals(phone_intervals)
+
+    def word_indices(self, start_t, end_t=None):
+        '''Indices of the words active at `start_t`, or overlapping
+        [start_t, end_t), in order'''
+        return sorted(self._words.items[j] for j in self._words.overlapping(start_t, end_t))
+
+    def words_at(self, t, end_t=None):
+        '''The words active at `t` (or overlapping [t, end_t))'''
+        return [self.words[i] for i in self.word_indices(t, end_t)]
+
+    def phones_at(self, t, end_t=None):
+        '''The phones active at `t` (or overlapping [t, end_t)), in order,
+        as dicts of the phone, its start and end, and the index of its word'''
+        phones = []
+        for j in self._phones.overlapping(t, end_t):
+            i, phone = self._phones.items[j]
+            phones.append({'phone': phone,
+                           'start': self._phones.starts[j],
+                           'end': self._phones.ends[j],
+                           'wordIndex': i})
+        phones.sort(key=lambda ph: ph['start'])
+        return phones
@@ -1,58 +1,121 @@
-import math
 import logging
-import wave
 
+from gentle import chunking
 from gentle import transcription
+from gentle.checkpoint import Checkpoint
+from gentle.pcm import PCMBuffer
+from gentle.standard_kaldi import KaldiError
 
 from multiprocessing.pool import ThreadPool as Pool
 
 class MultiThreadedTranscriber:
-    def __init__(self, kaldi_queue, chunk_len=20, overlap_t=2, nthreads=4):
+    def __init__(self, kaldi_queue, chunk_len=20, overlap_t=2, nthreads=4, attempts=2, silence_cuts=True):
         self.chunk_len = chunk_len
         self.overlap_t = overlap_t
         self.nthreads = nthreads
+        self.attempts = attempts
+        # Cut the audio at pauses (see chunking.plan_chunks) rather than
+        # into fixed windows overlapping by `overlap_t`
+        self.silence_cuts = silence_cuts
             
         self.kaldi_queue = kaldi_queue
 
-    def transcribe(self, wavfile, progress_cb=None):
-        wav_obj = wave.open(wavfile, 'rb')
-        duration = wav_obj.getnframes() / float(wav_obj.getframerate())
-        n_chunks = int(math.ceil(duration / float(self.chunk_len - self.overlap_t)))
+    def _decode(self, path, offset, nsamples):
+        '''Decodes a region of `path` on the next free worker.  If the
+        worker dies or hangs it's replaced (see `KaldiQueue.replace`) and
+        the region retried on another one, up to `attempts` times.'''
+        for attempt in range(self.attempts):
+            k = self.kaldi_queue.get()
+            try:
+                if not k.push_region(path, offset, nsamples):
+                    raise KaldiError('cannot read %d samples at %d of %s' % (nsamples, offset, path))
+                ret = k.get_final()
+            except KaldiError as e:
+                self.kaldi_queue.replace(k)
+                if attempt == self.attempts - 1:
+                    raise
+                logging.warning('Retrying chunk at %d: %s' % (offset, e))
+                continue
+            self.kaldi_queue.put(k)
+            return ret
+
+    def transcribe(self, wavfile, progress_cb=None, checkpoint=None, graph_key=None):
+        '''Decodes `wavfile` (or a pcm.PCMBuffer) in chunks.  With a
+        checkpoint.Checkpoint, each chunk's result is saved as it
+        completes, and chunks already saved for the same graph (identified
+        by `graph_key`), audio and chunk plan aren't decoded again.
+
+        Given a pcm.StreamedPCM, chunks are decoded as soon as their audio
+        is there, while the rest is still being resampled.'''
+        # Workers read their chunks straight from the (memory-mapped) file
+        pcm = PCMBuffer.open(wavfile)
+        if checkpoint is not None:
+            # the checkpoint is keyed by the whole chunk plan
+            pcm.wait_complete()
+        if self.silence_cuts:
+            spans = chunking.iter_chunks(pcm, self.chunk_len)
+        else:
+            spans = chunking.iter_windows(pcm, self.chunk_len, self.overlap_t)
+        if checkpoint is not None:
+            spans = list(spans)
+            checkpoint_key = Checkpoint.key('transcribe', graph_key, pcm.nframes, pcm.rate, spans)
 
         chunks = []
-
-
-        def transcribe_chunk(idx):
-            wav_obj = wave.open(wavfile, 'rb')
-            start_t = idx * (self.chunk_len - self.overlap_t)
-            # Seek
-            wav_obj.setpos(int(start_t * wav_obj.getframerate()))
-            # Read frames
-            buf = wav_obj.readframes(int(self.chunk_len * wav_obj.getframerate()))
-
-            if len(buf) < 4000:
+        planned = []
+
+        def plan():
+            for idx, span in enumerate(spans):
+                planned.append(span)
+                yield idx, span
+
+        def transcribe_chunk(task):
+            idx, (start_t, end_t) = task
+            offset, nsamples = pcm.region(start_t, end_t - start_t)
+
+            ret = None
+            if checkpoint is not None:
+                ret = checkpoint.load(checkpoint_key, 'chunk%d' % idx)
+            if ret is not None:
+                logging.info('Resuming from checkpoint %d' % (idx))
+            elif nsamples < 2000:
                 logging.info('Short segment - ignored %d' % (idx))
                 ret = []
             else:
-                k = self.kaldi_queue.get()
-                k.push_chunk(buf)
-                ret = k.get_final()
-                # k.reset() (no longer needed)
-                self.kaldi_queue.put(k)
+                ret = self._decode(pcm.path, offset, nsamples)
+                if checkpoint is not None:
+                    checkpoint.save(checkpoint_key, 'chunk%d' % idx, ret)
 
             chunks.append({"start": start_t, "words": ret})
-            logging.info('%d/%d' % (len(chunks), n_chunks))
+            logging.info('%d/%d' % (len(chunks), len(planned)))
             if progress_cb is not None:
-                progress_cb({"message": ' '.join([X['word'] for X in ret]),
-                             "percent": len(chunks) / float(n_chunks)})
-
+                progress = {"message": ' '.join([X['word'] for X in ret])}
+                # (there's no telling how far along a stream is)
+                if pcm.complete:
+                    progress["percent"] = len(chunks) / float(len(planned))
+                progress_cb(progress)
+
+
+        # One chunk at a time, so that whichever thread is free takes the
+        # next one as soon as it's planned
+        pool = Pool(self.nthreads)
+        try:
+            for _ in pool.imap_unordered(transcribe_chunk, plan()):
+                pass
+        finally:
+            pool.close()
+        duration = pcm.duration
+        if self.silence_cuts:
+            logging.info('Cutting at pauses saves decoding %.1fs of %.1fs',
+                         chunking.ChunkPlan(planned, duration).saved_t(self.chunk_len, self.overlap_t), duration)
 
-        pool = Pool(min(n_chunks, self.nthreads))
-        pool.map(transcribe_chunk, range(n_chunks))
-        pool.close()
-        
         chunks.sort(key=lambda x: x['start'])
 
+        if self.silence_cuts:
+            # The chunks don't overlap and no word straddles a cut
+            words = [transcription.Word(**wd).shift(time=c['start'])
+                     for c in chunks for wd in c['words']]
+            return words, duration
+
         # Combine chunks
         words = []
         for c in chunks:
@@ -89,6 +152,49 @@ class MultiThreadedTranscriber:
 
         return words, duration
 
+    def transcribe_stream(self, wavfile, increment=0.5):
+        '''Yields transcription.Words as soon as they stabilize while the
+        audio is pushed to a single worker `increment` seconds at a time
+        (see `standard_kaldi.Kaldi.stream`).  Successive `chunk_len`
+        windows are decoded as separate utterances, without overlap.'''
+        pcm = PCMBuffer.from_wavfile(wavfile)
+
+        def regions(start_t, end_t):
+            t = start_t
+            while t < end_t:
+                offset, nsamples = pcm.region(t, min(increment, end_t - t))
+                if nsamples == 0:
+                    break
+                yield (pcm.path, offset, nsamples)
+                t += increment
+
+        k = self.kaldi_queue.get()
+        done = False
+        try:
+            start_t = 0
+            while start_t < pcm.duration:
+                end_t = min(start_t + self.chunk_len, pcm.duration)
+                for wd in k.stream(regions(start_t, end_t)):
+                    yield transcription.Word(**wd).shift(time=start_t)
+                start_t = end_t
+            done = True
+        except KaldiError:
+            # words already yielded can't be taken back, so don't retry
+            self.kaldi_queue.replace(k)
+            k = None
+            raise
+        finally:
+            if k is not None and not done:
+                # Stopped mid-utterance (typically because the caller stopped
+                # iterating): end it, or the next job would decode on top of it
+                try:
+                    k.get_final()
+                except KaldiError:
+                    self.kaldi_queue.replace(k)
+                    k = None
+            if k is not None:
+                self.kaldi_queue.put(k)
+
 
 if __name__=='__main__':
     # full transcription
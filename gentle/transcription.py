@@ -1,6 +1,8 @@
+import array
 import csv
 import io
 import json
+import sys
 
 from collections import defaultdict
 
@@ -10,6 +12,10 @@ class Word:
     NOT_FOUND_IN_AUDIO = 'not-found-in-audio'
     NOT_FOUND_IN_TRANSCRIPT = 'not-found-in-transcript'
 
+    # No per-instance __dict__: long alignments have millions of words
+    _fields = ('case', 'startOffset', 'endOffset', 'word', 'alignedWord', 'phones', 'start', 'duration', 'end')
+    __slots__ = _fields
+
     def __init__(self, case=None, startOffset=None, endOffset=None, word=None, alignedWord=None, phones=None, start=None, end=None, duration=None):
         self.case = case
         self.startOffset = startOffset
@@ -33,10 +39,17 @@ class Word:
         return self.case == Word.NOT_FOUND_IN_AUDIO
 
     def as_dict(self, without=None):
-        return { key:val for key, val in self.__dict__.items() if (val is not None) and (key != without)}
+        out = {}
+        for key in Word._fields:
+            val = getattr(self, key)
+            if (val is not None) and (key != without):
+                out[key] = val
+        return out
 
     def __eq__(self, other):
-        return self.__dict__ == other.__dict__
+        if not isinstance(other, Word):
+            return NotImplemented
+        return all(getattr(self, key) == getattr(other, key) for key in Word._fields)
 
     def __ne__(self, other):
         return not self == other
@@ -69,6 +82,241 @@ class Word:
         if self.word != other.word: return False
         return abs(self.start - other.start) / (self.duration + other.duration) < 0.1
 
+# Case codes of WordColumns.case
+CASES = (None, Word.SUCCESS, Word.NOT_FOUND_IN_AUDIO, Word.NOT_FOUND_IN_TRANSCRIPT)
+_CASE_CODES = {case: code for code, case in enumerate(CASES)}
+
+# Stands for None in the numeric columns
+_NO_TIME = float('nan')
+_NO_OFFSET = -1
+
+class WordColumns():
+    '''The words of a transcription, stored column by column in flat arrays
+    rather than as a Word object (and a dict per phone) each: a fraction of
+    the memory for long alignments, and `shift`, `stats` and `select` don't
+    have to touch any objects.
+
+    Works like a list of Words: indexing (or iterating) gives a WordView,
+    which reads and writes its row of the columns.  Each word's phones are
+    the `nphones[i]` entries from `phone_idx[i]` of `phone` and
+    `phone_duration` (`nphones[i]` is -1 when the word has none at all).'''
+
+    def __init__(self):
+        self.case = array.array('b')
+        self.startOffset = array.array('q')
+        self.endOffset = array.array('q')
+        self.word = []
+        self.alignedWord = []
+        self.start = array.array('d')
+        self.duration = array.array('d')
+        self.end = array.array('d')
+        self.phone_idx = array.array('q')
+        self.nphones = array.array('q')
+        self.phone = []
+        self.phone_duration = array.array('d')
+
+    @classmethod
+    def from_words(cls, words):
+        columns = cls()
+        for wd in words:
+            columns.append(wd)
+        return columns
+
+    def append(self, wd):
+        self.add(**wd.as_dict())
+
+    def add(self, case=None, startOffset=None, endOffset=None, word=None, alignedWord=None, phones=None, start=None, end=None, duration=None):
+        '''Appends a word, given the same arguments as Word'''
+        if start is not None:
+            if end is None:
+                end = start + duration
+            elif duration is None:
+                duration = end - start
+        self.case.append(_CASE_CODES[case])
+        self.startOffset.append(_NO_OFFSET if startOffset is None else startOffset)
+        self.endOffset.append(_NO_OFFSET if endOffset is None else endOffset)
+        self.word.append(word if word is None else sys.intern(word))
+        self.alignedWord.append(alignedWord if alignedWord is None else sys.intern(alignedWord))
+        self.start.append(_NO_TIME if start is None else start)
+        self.duration.append(_NO_TIME if duration is None else duration)
+        self.end.append(_NO_TIME if end is None else end)
+        self.phone_idx.append(0)
+        self.nphones.append(-1)
+        self.set_phones(len(self.case) - 1, phones)
+
+    def get(self, i, key):
+        if key == 'case':
+            return CASES[self.case[i]]
+        if key == 'phones':
+            return self.get_phones(i)
+        val = getattr(self, key)[i]
+        if key in ('start', 'duration', 'end'):
+            return None if val != val else val
+        if key in ('startOffset', 'endOffset'):
+            return None if val == _NO_OFFSET else val
+        return val
+
+    def set(self, i, key, val):
+        if key == 'case':
+            self.case[i] = _CASE_CODES[val]
+        elif key == 'phones':
+            self.set_phones(i, val)
+        elif key in ('start', 'duration', 'end'):
+            getattr(self, key)[i] = _NO_TIME if val is None else val
+        elif key in ('startOffset', 'endOffset'):
+            getattr(self, key)[i] = _NO_OFFSET if val is None else val
+        else:
+            getattr(self, key)[i] = val
+
+    def get_phones(self, i):
+        n = self.nphones[i]
+        if n < 0:
+            return None
+        idx = self.phone_idx[i]
+        return [{'phone': self.phone[j], 'duration': self.phone_duration[j]}
+                for j in range(idx, idx + n)]
+
+    def set_phones(self, i, phones):
+        if phones is None:
+            self.nphones[i] = -1
+            return
+        # new phones go at the end; the old ones are just left unused
+        self.phone_idx[i] = len(self.phone)
+        self.nphones[i] = len(phones)
+        for ph in phones:
+            self.phone.append(sys.intern(ph['phone']))
+            self.phone_duration.append(ph['duration'])
+
+    def __len__(self):
+        return len(self.case)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [WordView(self, j) for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return WordView(self, i)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield WordView(self, i)
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def to_words(self):
+        '''Returns the words as a list of (independent) Words'''
+        return [Word(**wd.as_dict()) for wd in self]
+
+    def shift(self, time=None, offset=None):
+        '''Word.shift for every word'''
+        if time is not None:
+            # NaNs stay NaN
+            self.start = array.array('d', [t + time for t in self.start])
+            self.end = array.array('d', [t + time for t in self.end])
+        if offset is not None:
+            self.startOffset = array.array('q', [o if o == _NO_OFFSET else o + offset for o in self.startOffset])
+            self.endOffset = array.array('q', [o if o == _NO_OFFSET else o + offset for o in self.endOffset])
+        return self
+
+    def stats(self):
+        '''Number of words of each case, as in Transcription.stats'''
+        stats = {'total': len(self)}
+        for code, case in enumerate(CASES):
+            n = self.case.count(code)
+            if n:
+                stats[case] = n
+        return stats
+
+    def select(self, *cases):
+        '''Returns a WordColumns of just the words of the given cases'''
+        codes = set(_CASE_CODES[case] for case in cases)
+        out = WordColumns()
+        for i, code in enumerate(self.case):
+            if code in codes:
+                out.add(**self[i].as_dict())
+        return out
+
+class WordView(Word):
+    '''The Word in row `i` of a WordColumns.  Changing its fields changes
+    the columns; `phones` is a copy, so set it to change them.'''
+
+    __slots__ = ('_columns', '_i')
+
+    def __init__(self, columns, i):
+        self._columns = columns
+        self._i = i
+
+    def swap_alignment(self, other):
+        if not isinstance(other, WordView) or other._columns is not self._columns:
+            return Word.swap_alignment(self, other)
+        # swap the phone ranges rather than copying the phones
+        columns, i, j = self._columns, self._i, other._i
+        for col in (columns.case, columns.alignedWord, columns.start, columns.end,
+                    columns.duration, columns.phone_idx, columns.nphones):
+            col[i], col[j] = col[j], col[i]
+
+def _column_property(key):
+    return property(lambda self: self._columns.get(self._i, key),
+                    lambda self, val: self._columns.set(self._i, key, val))
+
+for _key in Word._fields:
+    setattr(WordView, _key, _column_property(_key))
+
+# Where serve.py's view_alignment.html template takes the alignment
+INLINE_JSON = "var INLINE_JSON;"
+
+class _JSONWriter():
+    '''Writes the JSON of a transcription to `fh` a word at a time, just as
+    Transcription.to_json (with the same options) would'''
+
+    def __init__(self, fh, transcript, has_words, indent=None, separators=(',', ': '), script_safe=False):
+        self.fh = fh
+        self.indent = indent
+        self.options = {'sort_keys': True, 'indent': indent, 'separators': separators}
+        self.script_safe = script_safe
+        self.item_sep, self.key_sep = separators
+        self.has_words = has_words
+        self.nwords = 0
+
+        fields = []
+        if transcript:
+            fields.append('"transcript"' + self.key_sep + json.dumps(transcript))
+        if has_words:
+            fields.append('"words"' + self.key_sep + '[')
+        self.empty = not fields
+        if self.empty:
+            self._write('{}')
+            return
+        self._write('{' + (self.item_sep + self._nl(1)).join([self._nl(1) + fields[0]] + fields[1:]))
+
+    def _nl(self, level):
+        return '' if self.indent is None else '\n' + ' ' * (self.indent * level)
+
+    def _write(self, text):
+        if self.script_safe:
+            # keep "</script>" in a word from ending the <script>
+            text = text.replace('</', '<\\/')
+        self.fh.write(text)
+
+    def word(self, wd):
+        text = json.dumps(wd, **self.options)
+        if self.indent is not None:
+            text = text.replace('\n', self._nl(2))
+        self._write((self.item_sep if self.nwords else '') + self._nl(2) + text)
+        self.nwords += 1
+
+    def close(self):
+        if self.has_words:
+            self._write(self._nl(1) + ']')
+        if not self.empty:
+            self._write(self._nl(0) + '}')
+
+def _csv_row(word):
+    return [word.word, word.alignedWord, word.start, word.end]
+
 class Transcription:
 
     def __init__(self, transcript=None, words=None):
@@ -102,18 +350,53 @@ class Transcription:
             container['words'] = [word.as_dict(without="duration") for word in self.words]
         return container
 
+    def columnar(self):
+        '''Returns the same transcription with its words in a WordColumns'''
+        words = self.words
+        if words is not None and not isinstance(words, WordColumns):
+            words = WordColumns.from_words(words)
+        return Transcription(transcript=self.transcript, words=words)
+
     @classmethod
-    def from_json(cls, json_str):
-        return cls._from_jsondata(json.loads(json_str))
+    def from_json(cls, json_str, columnar=False):
+        return cls._from_jsondata(json.loads(json_str), columnar)
 
     @classmethod
-    def from_jsonfile(cls, filename):
+    def from_jsonfile(cls, filename, columnar=False):
         with open(filename) as fh:
-            return cls._from_jsondata(json.load(fh))
+            return cls._from_jsondata(json.load(fh), columnar)
+
+    @classmethod
+    def _from_jsondata(cls, data, columnar=False):
+        if columnar:
+            words = WordColumns()
+            for wd in data['words']:
+                words.add(**wd)
+        else:
+            words = [Word(**wd) for wd in data['words']]
+        return cls(transcript = data['transcript'], words = words)
+
+    def time_index(self):
+        '''A gentle.time_index.TimeIndex of the words, built on first use
+        (so: after the words have stopped changing)'''
+        if getattr(self, '_time_index', None) is None:
+            from gentle.time_index import TimeIndex
+            self._time_index = TimeIndex(self)
+        return self._time_index
+
+    def to_binary(self, fh):
+        '''Writes the transcription to binary file `fh` in the compact format
+        of gentle.alignment_file'''
+        from gentle import alignment_file
+        alignment_file.write(self, fh)
 
     @classmethod
-    def _from_jsondata(cls, data):
-        return cls(transcript = data['transcript'], words = [Word(**wd) for wd in data['words']])
+    def from_binary(cls, filename, columnar=False):
+        '''Reads a file written by `to_binary` (to read just some of the
+        words, use alignment_file.AlignmentFile)'''
+        from gentle.alignment_file import AlignmentFile
+        with AlignmentFile(filename) as af:
+            return af.to_transcription(columnar)
 
     def to_csv(self):
         '''Return a CSV representation of the aligned transcript. Format:
@@ -126,15 +409,42 @@ class Transcription:
         for X in self.words:
             if X.case not in (Word.SUCCESS, Word.NOT_FOUND_IN_AUDIO):
                 continue
-            row = [X.word,
-                X.alignedWord,
-                X.start,
-                X.end
-            ]
-            w.writerow(row)
+            w.writerow(_csv_row(X))
         return buf.getvalue()
 
+    def write(self, json_file=None, csv_file=None, html_file=None, html_template=None):
+        '''Writes the transcription to whichever of these files are given:
+        `json_file` as `to_json(indent=2)`, `csv_file` as `to_csv()`, and
+        `html_file` inlined into `html_template` (see serve.py).  Goes
+        through the words once, writing as it goes, rather than building
+        each output in memory.'''
+        words = self.words or []
+        outputs = []
+        if json_file is not None:
+            outputs.append(_JSONWriter(json_file, self.transcript, len(words) > 0, indent=2))
+        if html_file is not None:
+            head, tail = html_template.split(INLINE_JSON)
+            html_file.write(head + INLINE_JSON[:-1] + '=')
+            outputs.append(_JSONWriter(html_file, self.transcript, len(words) > 0,
+                                       separators=(',', ':'), script_safe=True))
+        csv_writer = csv.writer(csv_file) if csv_file is not None else None
+
+        for word in words:
+            if outputs:
+                wd = word.as_dict(without="duration")
+                for out in outputs:
+                    out.word(wd)
+            if csv_writer is not None and word.case in (Word.SUCCESS, Word.NOT_FOUND_IN_AUDIO):
+                csv_writer.writerow(_csv_row(word))
+
+        for out in outputs:
+            out.close()
+        if html_file is not None:
+            html_file.write(';' + tail)
+
     def stats(self):
+        if isinstance(self.words, WordColumns):
+            return self.words.stats()
         counts = defaultdict(int)
         for word in self.words:
             counts[word.case] += 1
@@ -145,3 +455,42 @@ class Transcription:
         return stats
 
 Transcription.Word = Word
+
+if __name__=='__main__':
+    # Memory use of a long alignment, as Words and as WordColumns
+    import random
+    import sys
+    import time
+    import tracemalloc
+
+    nwords = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    rng = random.Random(0)
+    phones = ['%s_%s' % (ph, pos) for ph in 'aeioubdfgklmnprst' for pos in 'BIE']
+    data = []
+    t = 0
+    for i in range(nwords):
+        n = rng.randint(2, 6)
+        data.append({'case': Word.SUCCESS, 'word': 'w%d' % (i % 5000), 'alignedWord': 'w%d' % (i % 5000),
+                     'startOffset': 5 * i, 'endOffset': 5 * i + 4, 'start': t, 'end': t + 0.05 * n,
+                     'phones': [{'phone': rng.choice(phones), 'duration': 0.05} for _ in range(n)]})
+        t += 0.05 * n + 0.1
+    text = json.dumps({'transcript': '', 'words': data})
+    del data
+
+    for columnar in (False, True):
+        tracemalloc.start()
+        trans = Transcription.from_json(text, columnar=columnar)
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        trans.words[nwords // 2].shift(time=0)
+        t2 = time.time()
+        if columnar:
+            trans.words.shift(time=1, offset=1)
+        else:
+            for wd in trans.words:
+                wd.shift(time=1, offset=1)
+        stats = trans.stats()
+        t3 = time.time()
+        print('%-8s %4.0f MB, shift+stats in %.2fs' % (
+            'columns:' if columnar else 'words:', size / 1e6, t3 - t2))
+        del trans
@@ -0,0 +1,135 @@
+'''The words of Kaldi's vocabulary (words.txt), compiled once into an
+index file next to it that is memory-mapped rather than read: loading
+takes no time whatever the size of the vocabulary, and processes using the
+same vocabulary share its pages.
+
+The index is an open-addressing hash table (crc32, linear probing) of word
+numbers, followed by the words themselves:
+
+    HEADER                      magic, version, byte order, counts
+    uint32 * nslots             word number + 1 (0: empty slot)
+    uint32 * (nwords + 1)       offsets of the words in...
+    bytes                       ...the UTF-8 words
+'''
+import array
+import logging
+import mmap
+import os
+import struct
+import sys
+import zlib
+
+MAGIC = b'GVOC'
+VERSION = 1
+# the arrays are in native byte order
+BYTE_ORDER = {'little': 1, 'big': 2}[sys.byteorder]
+
+# magic, version, byte order, nwords, nslots
+HEADER = struct.Struct('<4sIIII')
+
+def read_words(words_file):
+    '''The words of an OpenFST SymbolTable formatted text file'''
+    return [x.split(' ')[0] for x in words_file if x != '']
+
+def compile_index(words):
+    '''Returns the index (as bytes) of the list of `words`'''
+    words = list(dict.fromkeys(words))
+    encoded = [w.encode('utf-8') for w in words]
+    nslots = 1
+    while nslots < 2 * len(words):
+        nslots *= 2
+    mask = nslots - 1
+
+    slots = array.array('I', bytes(4 * nslots))
+    for n, w in enumerate(encoded):
+        slot = zlib.crc32(w) & mask
+        while slots[slot]:
+            slot = (slot + 1) & mask
+        slots[slot] = n + 1
+
+    offsets = array.array('I', [0])
+    for w in encoded:
+        offsets.append(offsets[-1] + len(w))
+
+    return b''.join([HEADER.pack(MAGIC, VERSION, BYTE_ORDER, len(words), nslots),
+                     slots.tobytes(), offsets.tobytes()] + encoded)
+
+class Vocabulary():
+    '''A set of words backed by an index from `compile_index` (bytes, or
+    a memory map of an index file).  Supports `in`, `len` and iteration.'''
+
+    def __init__(self, buf):
+        magic, version, order, self._nwords, nslots = HEADER.unpack_from(buf, 0)
+        if (magic, version, order) != (MAGIC, VERSION, BYTE_ORDER):
+            raise ValueError("not a version %d vocabulary index" % VERSION)
+        self._buf = buf
+        self._mask = nslots - 1
+        view = memoryview(buf)
+        pos = HEADER.size
+        self._slots = view[pos:pos + 4 * nslots].cast('I')
+        pos += 4 * nslots
+        self._offsets = view[pos:pos + 4 * (self._nwords + 1)].cast('I')
+        self._words = pos + 4 * (self._nwords + 1)
+
+    def _word_bytes(self, n):
+        return self._buf[self._words + self._offsets[n]:self._words + self._offsets[n + 1]]
+
+    def __contains__(self, word):
+        if not isinstance(word, str):
+            return False
+        w = word.encode('utf-8')
+        slot = zlib.crc32(w) & self._mask
+        while True:
+            n = self._slots[slot]
+            if n == 0:
+                return False
+            if self._word_bytes(n - 1) == w:
+                return True
+            slot = (slot + 1) & self._mask
+
+    def __len__(self):
+        return self._nwords
+
+    def __iter__(self):
+        for n in range(self._nwords):
+            yield self._word_bytes(n).decode('utf-8')
+
+def load(words_path, index_path=None):
+    '''Returns the Vocabulary of `words_path` (a words.txt), from its index
+    at `index_path` (by default, next to it).  The index is (re)compiled if
+    it is missing or older than the words; if it can't be saved, the
+    vocabulary is kept in memory instead.'''
+    if index_path is None:
+        index_path = words_path + '.idx'
+    try:
+        if os.path.getmtime(index_path) >= os.path.getmtime(words_path):
+            with open(index_path, 'rb') as fh:
+                mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                return Vocabulary(mm)
+            except ValueError:
+                mm.close()
+                raise
+    except (OSError, ValueError):
+        pass # missing, unreadable or out of date
+
+    with open(words_path) as fh:
+        index = compile_index(read_words(fh))
+    tmp_path = '%s.%d.tmp' % (index_path, os.getpid())
+    try:
+        with open(tmp_path, 'wb') as fh:
+            fh.write(index)
+        os.replace(tmp_path, index_path)
+    except OSError as e:
+        logging.warning("cannot save vocabulary index %s: %s", index_path, e)
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+    return Vocabulary(index)
+
+if __name__=='__main__':
+    # Compile the index of a words.txt (by default, the installed one's)
+    from gentle.util.paths import get_resource
+
+    words_path = sys.argv[1] if len(sys.argv) > 1 else get_resource('exp/langdir/words.txt')
+    vocab = load(words_path)
+    print('%d words in %s.idx' % (len(vocab), words_path))
@@ -68,7 +68,7 @@ def run_gentle(key='103/1241/103_1241_000000_000001'):
         return
         # for k,v in p.items():
         #    logging.debug("%s: %s" % (k, v))
-    with gentle.resampled(audio_file) as wavfile:
+    with gentle.streamed(audio_file) as wavfile:
         # logging.info("starting alignment")
         aligner = gentle.ForcedAligner(resources,
                                        transcript,
@@ -80,6 +80,9 @@ def run_gentle(key='103/1241/103_1241_000000_000001'):
         result_dict = result.to_dict()
         with open(json_file, 'w') as f:
             f.write(json.dumps(result_dict, indent=2))
+        # ...and in the binary format, for gong.dump_phones
+        with open(f'{TRAIN_PATH}/{key}.bin', 'wb') as f:
+            result.to_binary(f)
         return result_dict
 
 
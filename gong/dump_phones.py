@@ -9,6 +9,7 @@ import json
 import glob
 import os
 
+from gentle.alignment_file import AlignmentFile
 from gong.utils import TRAIN_PATH
 from gong.phonemes_preston_blair import phoneme_conversion, phoneme_set
 from collections import defaultdict
@@ -44,6 +45,25 @@ def parse_file(filepath, split_ch=None, ignore=None):
                 yield line
 
 
+def read_phones(filepath):
+    """
+    Yields (word, phone labels) for the words of an alignment that have phones,
+    from the binary alignment next to the JSON file when there is one.
+    """
+    binpath = filepath[:-len('.json')] + '.bin'
+    if os.path.isfile(binpath):
+        with AlignmentFile(binpath) as alignment:
+            for w in alignment:
+                if w.phones:
+                    yield w.word, [p['phone'] for p in w.phones]
+        return
+    with open(filepath) as f:
+        item = json.loads(f.read())
+    for w in item['words']:
+        if w.get('phones'):
+            yield w['word'], [p['phone'] for p in w['phones']]
+
+
 def dump_cmu():
     gentle_phone_dict = dump_phones()
     print("== Parsing CMU...")
@@ -61,30 +81,25 @@ def dump_cmu():
         if not os.path.isfile(filepath):
             continue
         # print("==", filepath)
-        with open(filepath) as f:
-            item = json.loads(f.read())
-            for w in item['words']:
-                if not w.get('phones'):
-                    continue
-                word = w['word'].upper()
-                phones = [p['phone'] for p in w['phones']]
-                if word in cmu_dict:
-                    cmu_phones = cmu_dict[word]
-                    if len(phones) == len(cmu_phones):
-                        print("MATCHED:", word, cmu_phones, phones)
-                        for i in range(len(phones)):
-                            if cmu_phones[i] in d[phones[i]]:
-                                d[phones[i]][cmu_phones[i]] += 1
-                            else:
-                                d[phones[i]][cmu_phones[i]] = 1
-                    else:
-                        is_non_silent = False
-                        for phone in phones:
-                            if phone in gentle_phone_dict:
-                                is_non_silent = True
-                        if is_non_silent:
-                            # print("Mismatched phoneme count", word, cmu_dict[word], phones)
-                            pass
+        for word, phones in read_phones(filepath):
+            word = word.upper()
+            if word in cmu_dict:
+                cmu_phones = cmu_dict[word]
+                if len(phones) == len(cmu_phones):
+                    print("MATCHED:", word, cmu_phones, phones)
+                    for i in range(len(phones)):
+                        if cmu_phones[i] in d[phones[i]]:
+                            d[phones[i]][cmu_phones[i]] += 1
+                        else:
+                            d[phones[i]][cmu_phones[i]] = 1
+                else:
+                    is_non_silent = False
+                    for phone in phones:
+                        if phone in gentle_phone_dict:
+                            is_non_silent = True
+                    if is_non_silent:
+                        # print("Mismatched phoneme count", word, cmu_dict[word], phones)
+                        pass
 
     for k in d.keys():
         d[k] = max(d[k].items(), key=operator.itemgetter(1))[0]
@@ -15,3 +15,6 @@ download_models() {
 
 echo "Downloading models for v$VERSION..." 1>&2
 download_models $VERSION
+
+echo "Indexing the vocabulary..." 1>&2
+python3 -m gentle.vocabulary exp/langdir/words.txt
@@ -9,14 +9,25 @@ import logging
 import multiprocessing
 import os
 import shutil
+import threading
 import uuid
 import wave
 
+from collections import OrderedDict
+
 from gentle.util.paths import get_resource, get_datadir
 from gentle.util.cyst import Insist
+from gentle import language_model
+from gentle import scheduler
+from gentle.checkpoint import Checkpoint
+from gentle.standard_kaldi import KaldiError
 
 import gentle
 
+# A job that keeps crashing the server, being cut short or losing its
+# decoders is resumed this many times before it's marked as failed
+MAX_RESUME_ATTEMPTS = 3
+
 class TranscriptionStatus(Resource):
     def __init__(self, status_dict):
         self.status_dict = status_dict
@@ -26,15 +37,101 @@ class TranscriptionStatus(Resource):
         req.setHeader(b"Content-Type", "application/json")
         return json.dumps(self.status_dict).encode()
 
+class WorkerStatus(Resource):
+    '''Restart counts and circuit-breaker state of the k3 workers'''
+    def __init__(self, transcriber):
+        self.transcriber = transcriber
+        Resource.__init__(self)
+
+    def render_GET(self, req):
+        req.setHeader(b"Content-Type", "application/json")
+        return json.dumps({
+            "alignment": self.transcriber.kaldi_pool.stats(),
+            "transcription": self.transcriber.full_transcriber.stats(),
+        }).encode()
+
+class TranscriptionQuery(Resource):
+    '''The words and phones of a finished alignment that are spoken at time
+    `t`, or between `start` and `end` (in seconds), so that players don't
+    need the whole of align.json.  `level` is "words", "phones" or (by
+    default) both.'''
+    def __init__(self, transcriber, uid):
+        self.transcriber = transcriber
+        self.uid = uid
+        Resource.__init__(self)
+
+    def render_GET(self, req):
+        req.setHeader(b"Content-Type", "application/json")
+        try:
+            if b't' in req.args:
+                start_t, end_t = float(req.args[b't'][0]), None
+            else:
+                start_t, end_t = float(req.args[b'start'][0]), float(req.args[b'end'][0])
+        except (KeyError, ValueError):
+            req.setResponseCode(400)
+            return json.dumps({"error": "expected a time t, or start and end"}).encode()
+        level = req.args.get(b'level', [b'both'])[0].decode()
+        if level not in ('words', 'phones', 'both'):
+            req.setResponseCode(400)
+            return json.dumps({"error": "level must be words, phones or both"}).encode()
+
+        index = self.transcriber.time_index(self.uid)
+        if index is None:
+            req.setResponseCode(404)
+            return json.dumps({"error": "no alignment yet"}).encode()
+
+        out = {}
+        if level in ('words', 'both'):
+            out['words'] = [dict(index.words[i].as_dict(without="duration"), index=i)
+                            for i in index.word_indices(start_t, end_t)]
+        if level in ('phones', 'both'):
+            out['phones'] = index.phones_at(start_t, end_t)
+        return json.dumps(out).encode()
+
 class Transcriber():
-    def __init__(self, data_dir, nthreads=4, ntranscriptionthreads=2):
+    def __init__(self, data_dir, nthreads=4, ntranscriptionthreads=2, slots_per_process=1, policy='fair', realign_budget=None):
         self.data_dir = data_dir
         self.nthreads = nthreads
+        self.realign_budget = realign_budget
+        # Each result's index.html is this, with the alignment inlined
+        with open(get_resource('www/view_alignment.html')) as fh:
+            self.html_template = fh.read()
         self.ntranscriptionthreads = ntranscriptionthreads
         self.resources = gentle.Resources()
-
-        self.full_transcriber = gentle.FullTranscriber(self.resources, nthreads=ntranscriptionthreads)
+        # Retries and re-submissions of a transcript reuse its graph
+        self.graph_cache = language_model.GraphCache(os.path.join(data_dir, 'graph_cache'))
+        # k3 workers shared by all alignment jobs, and kept loaded between
+        # them: concurrent jobs take turns rather than starting more
+        self.kaldi_pool = scheduler.DecoderScheduler(self.resources, nslots=nthreads, slots_per_process=slots_per_process, policy=policy)
+        # Warm m3 processes shared by all jobs
+        self.mkgraph = language_model.MkgraphServer(self.resources.proto_langdir, nprocs=nthreads)
+
+        self.full_transcriber = gentle.FullTranscriber(self.resources, nthreads=ntranscriptionthreads, slots_per_process=slots_per_process)
         self._status_dicts = {}
+        # Time indices of the most recently queried results
+        self._time_indices = OrderedDict()
+        self._time_indices_lock = threading.Lock()
+
+    def time_index(self, uid, cache_size=16):
+        '''A TimeIndex of the alignment of job `uid`, or None if it hasn't
+        finished'''
+        with self._time_indices_lock:
+            if uid in self._time_indices:
+                self._time_indices.move_to_end(uid)
+                return self._time_indices[uid]
+        outdir = self.out_dir(uid)
+        if os.path.exists(os.path.join(outdir, 'align.bin')):
+            result = gentle.Transcription.from_binary(os.path.join(outdir, 'align.bin'), columnar=True)
+        elif os.path.exists(os.path.join(outdir, 'align.json')):
+            result = gentle.Transcription.from_jsonfile(os.path.join(outdir, 'align.json'), columnar=True)
+        else:
+            return None
+        index = result.time_index()
+        with self._time_indices_lock:
+            self._time_indices[uid] = index
+            while len(self._time_indices) > cache_size:
+                self._time_indices.popitem(last=False)
+        return index
 
     def get_status(self, uid):
         return self._status_dicts.setdefault(uid, {})
@@ -49,7 +146,59 @@ class Transcriber():
             uid = uuid.uuid4().hex[:8]
         return uid
 
+    def save_error(self, uid, error):
+        '''Marks job `uid` as failed for good'''
+        status = self.get_status(uid)
+        status['status'] = 'ERROR'
+        status['error'] = error
+        # Save the status so that errors are recovered on restart of the server
+        with open(os.path.join(self.out_dir(uid), 'status.json'), 'w') as jsfile:
+            json.dump(status, jsfile, indent=2)
+
+    def _attempts(self, uid):
+        try:
+            with open(os.path.join(self.out_dir(uid), 'attempts')) as fh:
+                return int(fh.read())
+        except (IOError, ValueError):
+            return 0
+
+    def interrupted_jobs(self):
+        '''Returns (uid, transcript, kwargs) for every job that was cut short
+        (by a crash or a restart) and can be resumed: the ones that still
+        have their upload but no alignment, and haven't been resumed
+        MAX_RESUME_ATTEMPTS times already'''
+        jobs = []
+        trans_dir = os.path.join(self.data_dir, 'transcriptions')
+        if not os.path.isdir(trans_dir):
+            return jobs
+        for uid in sorted(os.listdir(trans_dir)):
+            outdir = self.out_dir(uid)
+            if not os.path.exists(os.path.join(outdir, 'upload')):
+                continue
+            if os.path.exists(os.path.join(outdir, 'align.json')):
+                continue
+            if os.path.exists(os.path.join(outdir, 'status.json')):
+                continue # failed for good
+            if self._attempts(uid) > MAX_RESUME_ATTEMPTS:
+                logging.warning("giving up on transcription %s", uid)
+                self.save_error(uid, 'Transcription was interrupted %d times; giving up.' % self._attempts(uid))
+                continue
+            try:
+                with open(os.path.join(outdir, 'transcript.txt')) as tranfile:
+                    transcript = tranfile.read()
+                with open(os.path.join(outdir, 'options.json')) as optfile:
+                    kwargs = json.load(optfile)
+            except (IOError, ValueError):
+                continue
+            if 'disfluencies' in kwargs:
+                kwargs['disfluencies'] = set(kwargs['disfluencies'])
+            jobs.append((uid, transcript, kwargs))
+        return jobs
+
     def transcribe(self, uid, transcript, audio, async_mode, **kwargs):
+        '''Aligns `audio` (the uploaded file) to `transcript`.  When resuming
+        an interrupted job, `audio` is None and the upload is already on
+        disk.'''
 
         status = self.get_status(uid)
 
@@ -59,25 +208,33 @@ class Transcriber():
         }
 
         outdir = os.path.join(self.data_dir, 'transcriptions', uid)
-
-        tran_path = os.path.join(outdir, 'transcript.txt')
-        with open(tran_path, 'w') as tranfile:
-            tranfile.write(transcript)
-        audio_path = os.path.join(outdir, 'upload')
-        with open(audio_path, 'wb') as wavfile:
-            wavfile.write(audio)
+        # Counted before anything can go wrong (see interrupted_jobs)
+        with open(os.path.join(outdir, 'attempts'), 'w') as fh:
+            fh.write('%d' % (self._attempts(uid) + 1))
+
+        if audio is not None:
+            tran_path = os.path.join(outdir, 'transcript.txt')
+            with open(tran_path, 'w') as tranfile:
+                tranfile.write(transcript)
+            # ...so that the job can be resumed
+            with open(os.path.join(outdir, 'options.json'), 'w') as optfile:
+                json.dump(kwargs, optfile, default=sorted)
+            audio_path = os.path.join(outdir, 'upload')
+            with open(audio_path, 'wb') as wavfile:
+                wavfile.write(audio)
 
         status['status'] = 'ENCODING'
 
         wavfile = os.path.join(outdir, 'a.wav')
-        if gentle.resample(os.path.join(outdir, 'upload'), wavfile) != 0:
-            status['status'] = 'ERROR'
-            status['error'] = "Encoding failed. Make sure that you've uploaded a valid media file."
-            # Save the status so that errors are recovered on restart of the server
+        # Encode under another name first, so that an a.wav left behind by
+        # an interrupted job is always complete
+        tmp_wavfile = os.path.join(outdir, 'a.tmp.wav')
+        if not os.path.exists(wavfile) and gentle.resample(os.path.join(outdir, 'upload'), tmp_wavfile) != 0:
             # XXX: This won't work, because the endpoint will override this file
-            with open(os.path.join(outdir, 'status.json'), 'w') as jsfile:
-                json.dump(status, jsfile, indent=2)
+            self.save_error(uid, "Encoding failed. Make sure that you've uploaded a valid media file.")
             return
+        if not os.path.exists(wavfile):
+            os.replace(tmp_wavfile, wavfile)
 
         #XXX: Maybe we should pass this wave object instead of the
         # file path to align_progress
@@ -90,33 +247,50 @@ class Transcriber():
             for k,v in p.items():
                 status[k] = v
 
-        if len(transcript.strip()) > 0:
-            trans = gentle.ForcedAligner(self.resources, transcript, nthreads=self.nthreads, **kwargs)
-        elif self.full_transcriber.available:
-            trans = self.full_transcriber
-        else:
+        if len(transcript.strip()) == 0 and not self.full_transcriber.available:
             status['status'] = 'ERROR'
             status['error']  = 'No transcript provided and no language model for full transcription'
             return
 
-        output = trans.transcribe(wavfile, progress_cb=on_progress, logging=logging)
-
-        # ...remove the original upload
+        # Finished chunks are saved as they come in, so that the job can be
+        # resumed where it left off
+        checkpoint = Checkpoint(os.path.join(outdir, 'checkpoints'))
+        try:
+            if len(transcript.strip()) > 0:
+                trans = gentle.ForcedAligner(self.resources, transcript, nthreads=self.nthreads, pool=self.kaldi_pool, graph_cache=self.graph_cache, mkgraph=self.mkgraph, realign_budget=self.realign_budget, **kwargs)
+            else:
+                trans = self.full_transcriber
+            output = trans.transcribe(wavfile, progress_cb=on_progress, logging=logging, checkpoint=checkpoint)
+        except (KaldiError, RuntimeError) as e:
+            # A decoder or graph compiler failed, not the job: resume it
+            # (from its checkpoints) like one cut short by a restart
+            if self._attempts(uid) <= MAX_RESUME_ATTEMPTS:
+                logging.warning("transcription %s interrupted (%s), resuming", uid, e)
+                return self.transcribe(uid, transcript, None, async_mode, **kwargs)
+            logging.exception("transcription %s failed", uid)
+            self.save_error(uid, 'Alignment failed: %s' % e)
+            raise
+        except Exception as e:
+            logging.exception("transcription %s failed", uid)
+            self.save_error(uid, 'Alignment failed: %s' % e)
+            raise
+
+        # Save, inlining the alignment into the index.html file
+        with open(os.path.join(outdir, 'align.json'), 'w') as jsfile, \
+             open(os.path.join(outdir, 'align.csv'), 'w') as csvfile, \
+             open(os.path.join(outdir, 'index.html'), 'w') as htmlfile:
+            output.write(json_file=jsfile, csv_file=csvfile, html_file=htmlfile, html_template=self.html_template)
+        # ...and in binary, for time queries (see TranscriptionQuery)
+        with open(os.path.join(outdir, 'align.bin'), 'wb') as binfile:
+            output.to_binary(binfile)
+
+        # ...remove the checkpoints and the original upload
+        checkpoint.clear()
         os.unlink(os.path.join(outdir, 'upload'))
 
-        # Save
-        with open(os.path.join(outdir, 'align.json'), 'w') as jsfile:
-            jsfile.write(output.to_json(indent=2))
-        with open(os.path.join(outdir, 'align.csv'), 'w') as csvfile:
-            csvfile.write(output.to_csv())
-
-        # Inline the alignment into the index.html file.
-        htmltxt = open(get_resource('www/view_alignment.html')).read()
-        htmltxt = htmltxt.replace("var INLINE_JSON;", "var INLINE_JSON=%s;" % (output.to_json()));
-        open(os.path.join(outdir, 'index.html'), 'w').write(htmltxt)
-
         status['status'] = 'OK'
 
+        logging.info('graph cache: %(hits)d hits, %(misses)d misses' % self.graph_cache.stats())
         logging.info('done with transcription.')
 
         return output
@@ -134,6 +308,8 @@ class TranscriptionsController(Resource):
         # Add a Status endpoint to the file
         trans_status = TranscriptionStatus(self.transcriber.get_status(uid))
         trans_ctrl.putChild(b"status.json", trans_status)
+        # ...and one to look up words by time
+        trans_ctrl.putChild(b"query.json", TranscriptionQuery(self.transcriber, uid))
 
         return trans_ctrl
 
@@ -160,7 +336,8 @@ class TranscriptionsController(Resource):
         os.makedirs(outdir)
 
         # Copy over the HTML
-        shutil.copy(get_resource('www/view_alignment.html'), os.path.join(outdir, 'index.html'))
+        with open(os.path.join(outdir, 'index.html'), 'w') as fh:
+            fh.write(self.transcriber.html_template)
 
         result_promise = threads.deferToThreadPool(
             reactor, reactor.getThreadPool(),
@@ -216,7 +393,7 @@ class TranscriptionZipper(Resource):
         else:
             return Resource.getChild(self, path, req)
 
-def serve(port=8765, interface='0.0.0.0', installSignalHandlers=0, nthreads=4, ntranscriptionthreads=2, data_dir=get_datadir('webdata')):
+def serve(port=8765, interface='0.0.0.0', installSignalHandlers=0, nthreads=4, ntranscriptionthreads=2, slots_per_process=1, policy='fair', realign_budget=None, data_dir=get_datadir('webdata')):
     logging.info("SERVE %d, %s, %d", port, interface, installSignalHandlers)
 
     if not os.path.exists(data_dir):
@@ -232,10 +409,19 @@ def serve(port=8765, interface='0.0.0.0', installSignalHandlers=0, nthreads=4, n
     f.putChild(b'status.html', File(get_resource('www/status.html')))
     f.putChild(b'preloader.gif', File(get_resource('www/preloader.gif')))
 
-    trans = Transcriber(data_dir, nthreads=nthreads, ntranscriptionthreads=ntranscriptionthreads)
+    trans = Transcriber(data_dir, nthreads=nthreads, ntranscriptionthreads=ntranscriptionthreads, slots_per_process=slots_per_process, policy=policy, realign_budget=realign_budget)
     trans_ctrl = TranscriptionsController(trans)
+
+    for uid, transcript, kwargs in trans.interrupted_jobs():
+        logging.info("resuming transcription %s", uid)
+        threads.deferToThreadPool(
+            reactor, reactor.getThreadPool(),
+            trans.transcribe,
+            uid, transcript, None, True, **kwargs)
     f.putChild(b'transcriptions', trans_ctrl)
 
+    f.putChild(b'workers.json', WorkerStatus(trans))
+
     trans_zippr = TranscriptionZipper(zip_dir, trans)
     f.putChild(b'zip', trans_zippr)
 
@@ -260,6 +446,12 @@ if __name__=='__main__':
                         help='number of alignment threads')
     parser.add_argument('--ntranscriptionthreads', default=2, type=int,
                         help='number of full-transcription threads (memory intensive)')
+    parser.add_argument('--slots-per-process', default=1, type=int,
+                        help='number of decoders sharing one copy of the acoustic model')
+    parser.add_argument('--policy', default='fair', choices=scheduler.POLICIES,
+                        help='how alignment jobs share decoders: fair share, or shortest job first')
+    parser.add_argument('--realign-budget', default=None, type=float,
+                        help='seconds an alignment job may spend realigning missed words')
     parser.add_argument('--log', default="INFO",
                         help='the log level (DEBUG, INFO, WARNING, ERROR, or CRITICAL)')
 
@@ -271,4 +463,4 @@ if __name__=='__main__':
     logging.info('gentle %s' % (gentle.__version__))
     logging.info('listening at %s:%d\n' % (args.host, args.port))
 
-    serve(args.port, args.host, nthreads=args.nthreads, ntranscriptionthreads=args.ntranscriptionthreads, installSignalHandlers=1)
+    serve(args.port, args.host, nthreads=args.nthreads, ntranscriptionthreads=args.ntranscriptionthreads, slots_per_process=args.slots_per_process, policy=args.policy, realign_budget=args.realign_budget, installSignalHandlers=1)
@@ -0,0 +1,63 @@
+import copy
+import random
+import unittest
+
+def scanning_optimizer():
+    from gentle.forced_aligner import AdjacencyOptimizer
+
+    class ScanningOptimizer(AdjacencyOptimizer):
+        '''Finds the neighbouring aligned words by scanning the word list'''
+        def tend(self, i):
+            for word in reversed(self.words[:i]):
+                if word.success():
+                    return word.end
+            return 0
+
+        def tstart(self, i):
+            for word in self.words[i:]:
+                if word.success():
+                    return word.start
+            return self.duration
+    return ScanningOptimizer
+
+class Adjacency(unittest.TestCase):
+
+    def test_moves_inward(self):
+        from gentle.forced_aligner import AdjacencyOptimizer
+        from gentle.transcription import Word
+
+        # "I really really really want", with the one "really" that was
+        # heard aligned to the first of them, leaving a gap before "want"
+        text = 'i really really really want'.split()
+        times = {0: 0, 1: 3, 4: 4}
+        words = []
+        for i, wd in enumerate(text):
+            if i in times:
+                words.append(Word(case=Word.SUCCESS, word=wd, start=times[i], end=times[i] + 0.5))
+            else:
+                words.append(Word(case=Word.NOT_FOUND_IN_AUDIO, word=wd))
+
+        words = AdjacencyOptimizer(words, 5).optimize()
+        self.assertEqual([i for i, wd in enumerate(words) if wd.success()], [0, 3, 4])
+        self.assertEqual(words[3].start, 3)
+
+    def test_random(self):
+        # same result as looking for the neighbours from scratch each time
+        from gentle.forced_aligner import AdjacencyOptimizer
+        from gentle.transcription import Word
+
+        ScanningOptimizer = scanning_optimizer()
+        rng = random.Random(0)
+        for _ in range(200):
+            words = []
+            t = 0
+            while len(words) < 100:
+                for _ in range(rng.randint(0, 4)):
+                    words.append(Word(case=Word.SUCCESS, word=rng.choice('ab'), start=t, end=t + 0.3))
+                    t += 0.3 + rng.random() * 0.2
+                for _ in range(rng.randint(1, 6)):
+                    words.append(Word(case=Word.NOT_FOUND_IN_AUDIO, word=rng.choice('ab')))
+                t += rng.random() * 3
+            expected = ScanningOptimizer(copy.deepcopy(words), t).optimize()
+            out = AdjacencyOptimizer(words, t).optimize()
+            self.assertEqual([wd.as_dict() for wd in out], [wd.as_dict() for wd in expected])
@@ -0,0 +1,78 @@
+import os
+import shutil
+import tempfile
+import unittest
+import wave
+
+class FakeWorker():
+    def __init__(self):
+        self.decoded = 0
+
+    def push_region(self, path, offset, nsamples):
+        self.decoded += 1
+        return True
+
+    def get_final(self):
+        return [{'word': 'hi', 'start': 1.0, 'duration': 0.5, 'phones': []}]
+
+class FakeQueue():
+    def __init__(self, k):
+        self.k = k
+
+    def get(self):
+        return self.k
+
+    def put(self, k):
+        pass
+
+class Checkpoint(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_save_load(self):
+        from gentle.checkpoint import Checkpoint
+
+        checkpoint = Checkpoint(os.path.join(self.tmpdir, 'checkpoints'))
+        key = Checkpoint.key('graph', {'disfluencies': set(['um', 'uh'])})
+        self.assertEqual(key, Checkpoint.key('graph', {'disfluencies': set(['uh', 'um'])}))
+        self.assertIsNone(checkpoint.load(key, 'chunk0'))
+
+        checkpoint.save(key, 'chunk0', [{'word': 'hi'}])
+        self.assertEqual(checkpoint.load(key, 'chunk0'), [{'word': 'hi'}])
+        self.assertIsNone(checkpoint.load(Checkpoint.key('other graph'), 'chunk0'))
+
+        checkpoint.clear()
+        self.assertFalse(os.path.exists(checkpoint.checkpoint_dir))
+
+    def test_resume(self):
+        from gentle.checkpoint import Checkpoint
+        from gentle.transcriber import MultiThreadedTranscriber
+
+        wavfile = os.path.join(self.tmpdir, 'a.wav')
+        wav = wave.open(wavfile, 'wb')
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(8000)
+        wav.writeframes(b'\0\0' * 8000 * 45)
+        wav.close()
+
+        checkpoint = Checkpoint(os.path.join(self.tmpdir, 'checkpoints'))
+        k = FakeWorker()
+        mtt = MultiThreadedTranscriber(FakeQueue(k), nthreads=1)
+        words, _ = mtt.transcribe(wavfile, checkpoint=checkpoint, graph_key='a')
+        n_chunks = k.decoded
+        self.assertTrue(n_chunks > 1)
+
+        # nothing left to decode for the same graph...
+        resumed, _ = mtt.transcribe(wavfile, checkpoint=checkpoint, graph_key='a')
+        self.assertEqual(k.decoded, n_chunks)
+        self.assertEqual([(w.word, w.start) for w in resumed],
+                         [(w.word, w.start) for w in words])
+
+        # ...but everything for another
+        mtt.transcribe(wavfile, checkpoint=checkpoint, graph_key='b')
+        self.assertEqual(k.decoded, 2 * n_chunks)
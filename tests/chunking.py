@@ -0,0 +1,94 @@
+import array
+import os
+import random
+import shutil
+import tempfile
+import unittest
+import wave
+
+class PlanChunks(unittest.TestCase):
+
+    def setUp(self):
+        # 65s of noise with pauses at 18-18.5s and 41-41.5s
+        rng = random.Random(0)
+        samples = array.array('h', (rng.randint(-3000, 3000) for _ in range(65 * 8000)))
+        for start_t in (18, 41):
+            for i in range(start_t * 8000, start_t * 8000 + 4000):
+                samples[i] = rng.randint(-10, 10)
+
+        self.tmpdir = tempfile.mkdtemp()
+        self.wavfile = os.path.join(self.tmpdir, 'a.wav')
+        wav = wave.open(self.wavfile, 'wb')
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(8000)
+        wav.writeframes(samples.tobytes())
+        wav.close()
+        self.samples = samples
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_cuts_at_pauses(self):
+        from gentle.chunking import plan_chunks
+        from gentle.pcm import PCMBuffer
+
+        with PCMBuffer.from_wavfile(self.wavfile) as pcm:
+            plan = plan_chunks(pcm, chunk_len=20)
+
+        self.assertEqual(len(plan.chunks), 3)
+        self.assertEqual(plan.chunks[0][0], 0)
+        # anywhere in the pauses
+        self.assertTrue(18 < plan.chunks[0][1] < 18.5)
+        self.assertTrue(41 < plan.chunks[1][1] < 41.5)
+        self.assertEqual(plan.chunks[2][1], 65)
+        for (_, end), (start, _) in zip(plan.chunks, plan.chunks[1:]):
+            self.assertEqual(end, start)
+
+        # fixed 20s windows every 18s decode 20+20+20+11s
+        self.assertAlmostEqual(plan.saved_t(20, 2), 6)
+
+    def test_streamed(self):
+        from gentle.chunking import iter_chunks, iter_windows, plan_chunks
+        from gentle.pcm import PCMBuffer, StreamedPCM
+
+        with PCMBuffer.from_wavfile(self.wavfile) as pcm:
+            chunks = plan_chunks(pcm, chunk_len=20).chunks
+
+        # The samples arrive 5s at a time, as they're waited for
+        rawfile = os.path.join(self.tmpdir, 'a.raw')
+        samples = self.samples
+        class FedPCM(StreamedPCM):
+            def wait(self, nframes):
+                with open(rawfile, 'ab') as fh:
+                    while not self.complete and self.nframes < nframes:
+                        fh.write(samples[self.nframes:self.nframes + 5 * 8000].tobytes())
+                        fh.flush()
+                        self.extend(min(self.nframes + 5 * 8000, len(samples)))
+                        if self.nframes == len(samples):
+                            self.finish()
+                return StreamedPCM.wait(self, nframes)
+        pcm = FedPCM(rawfile)
+
+        streamed = []
+        received = []
+        for chunk in iter_chunks(pcm, chunk_len=20):
+            streamed.append(chunk)
+            received.append(pcm.duration)
+
+        self.assertEqual(streamed, chunks)
+        # the first chunk is cut once there's a little over 40s of audio
+        self.assertEqual(received[0], 45)
+
+        self.assertEqual(list(iter_windows(pcm, 20, 2)),
+                         [(0, 20), (18, 38), (36, 56), (54, 74)])
+        pcm.close()
+
+    def test_stream_error(self):
+        from gentle.chunking import iter_chunks
+        from gentle.pcm import StreamedPCM
+
+        pcm = StreamedPCM(os.path.join(self.tmpdir, 'a.raw'))
+        pcm.finish("Unable to resample/encode 'a.mp3'")
+        with self.assertRaises(RuntimeError):
+            list(iter_chunks(pcm))
@@ -0,0 +1,105 @@
+import difflib
+import random
+import unittest
+
+class Diff(unittest.TestCase):
+
+    def check(self, a, b, opcodes=None):
+        from gentle.diff import get_opcodes
+
+        if opcodes is None:
+            opcodes = get_opcodes(a, b, fast=True)
+        # the opcodes turn `a` into `b`...
+        out = []
+        for tag, i1, i2, j1, j2 in opcodes:
+            if tag == 'equal':
+                self.assertEqual(a[i1:i2], b[j1:j2])
+            out.extend(b[j1:j2])
+        self.assertEqual(out, b)
+        # ...and have the form of SequenceMatcher's (see gentle.diff)
+        i = j = 0
+        prev = None
+        for tag, i1, i2, j1, j2 in opcodes:
+            self.assertEqual((i1, j1), (i, j))
+            sides = (i2 > i1, j2 > j1)
+            if tag in ('equal', 'replace'):
+                self.assertEqual(sides, (True, True))
+            else:
+                self.assertEqual(sides, {'delete': (True, False), 'insert': (False, True)}[tag])
+            if prev is not None:
+                # equal and unequal runs alternate
+                self.assertTrue((prev == 'equal') != (tag == 'equal'))
+            i, j, prev = i2, j2, tag
+        self.assertEqual((i, j), (len(a), len(b)))
+
+    def test_like_difflib(self):
+        from gentle.diff import get_opcodes
+
+        a = 'i am sitting in the a room different from the one you are in'.split()
+        b = 'i am sitting in a room different from the one you are in now'.split()
+        for fast in (False, True):
+            self.assertEqual(get_opcodes(a, b, fast), difflib.SequenceMatcher(a=a, b=b).get_opcodes())
+            self.assertEqual(get_opcodes([], b, fast), [('insert', 0, 0, 0, len(b))])
+            self.assertEqual(get_opcodes(a, [], fast), [('delete', 0, len(a), 0, 0)])
+
+    def test_random(self):
+        rng = random.Random(0)
+        for _ in range(500):
+            a = [rng.randint(0, 5) for _ in range(rng.randint(0, 30))]
+            b = [rng.randint(0, 5) for _ in range(rng.randint(0, 30))]
+            self.check(a, b)
+            # (the form is difflib's)
+            self.check(a, b, difflib.SequenceMatcher(a=a, b=b).get_opcodes())
+
+    def test_difflib(self):
+        from unittest import mock
+        from gentle import diff
+        from gentle.diff import get_opcodes
+
+        rng = random.Random(0)
+        for n in range(600):
+            # (either way of finding each longest match)
+            cost = [0, diff.AUTOMATON_COST, 10 ** 9][n % 3]
+            # (long enough for difflib's autojunk)
+            vocab = [str(i) for i in range(rng.randint(1, 150))]
+            b = rng.choices(vocab, k=rng.randint(0, 400))
+            if rng.random() < 0.5:
+                a = rng.choices(vocab, k=rng.randint(0, 400))
+            else:
+                # an edited copy, like a transcript and what was heard
+                a = [wd if rng.random() > 0.2 else rng.choice(vocab) for wd in b]
+            with mock.patch.object(diff, 'AUTOMATON_COST', cost):
+                self.assertEqual(get_opcodes(a, b), difflib.SequenceMatcher(a=a, b=b).get_opcodes())
+
+    def test_far_apart(self):
+        from gentle.diff import get_opcodes
+
+        # A repetitive transcript, 40% misrecognized: no anchors and too
+        # many edits for Myers, so the gap is left to difflib
+        rng = random.Random(1)
+        vocab = ['w%d' % i for i in range(40)]
+        b = rng.choices(vocab, k=6000)
+        a = [wd if rng.random() > 0.4 else rng.choice(vocab) for wd in b]
+        opcodes = get_opcodes(a, b, fast=True)
+        self.check(a, b, opcodes)
+
+        def matched(opcodes):
+            return sum(i2 - i1 for tag, i1, i2, _, _ in opcodes if tag == 'equal')
+        expected = matched(difflib.SequenceMatcher(a=a, b=b, autojunk=False).get_opcodes())
+        self.assertGreaterEqual(matched(opcodes), 0.95 * expected)
+
+    def test_repeated_words(self):
+        from gentle.diff import get_opcodes
+
+        # frequent words are matched like any other
+        a = ['the'] * 300 + ['end']
+        b = ['the'] * 250 + ['end']
+        self.assertEqual(get_opcodes(a, b, fast=True), [('equal', 0, 250, 0, 250),
+                                             ('delete', 250, 300, 250, 250),
+                                             ('equal', 300, 301, 250, 251)])
+
+    def test_by_word(self):
+        from gentle.diff_align import word_diff
+
+        self.assertEqual(list(word_diff(['a', 'x', 'y', 'c'], ['a', 'b', 'c'])),
+                         [('equal', 0, 0), ('replace', 1, 1), ('delete', 2, 2), ('equal', 3, 2)])
@@ -0,0 +1,27 @@
+import unittest
+
+class FindCuts(unittest.TestCase):
+
+    def test_unique_anchors(self):
+        from gentle.hierarchical import find_cuts
+        from gentle.metasentence import MetaSentence
+        from gentle.transcription import Word
+
+        transcript = ' '.join(['the cat sat on the mat'] * 3 + ['a unique phrase here', 'the cat sat on the mat'])
+        ms = MetaSentence(transcript, set(transcript.split()))
+        alignment = [Word(case=Word.SUCCESS, word=tok, start=i * 20.0, duration=0.4)
+                     for i, tok in enumerate(ms.get_kaldi_sequence())]
+        for i in range(len(alignment) - 1):
+            # back to back
+            alignment[i].end = alignment[i + 1].start - 0.1
+
+        # the repeated phrase is no use as an anchor; anything overlapping
+        # the unique one is ("the mat a", then "phrase here the")
+        cuts = find_cuts(alignment, ms, segment_len=60, anchor_len=3)
+        self.assertEqual([i for i, _ in cuts], [18, 22])
+        # in the gap before the next word
+        self.assertAlmostEqual(cuts[0][1], 379.95)
+
+        # but not if one of its words wasn't recognized
+        alignment[18].case = Word.NOT_FOUND_IN_AUDIO
+        self.assertEqual([i for i, _ in find_cuts(alignment, ms, segment_len=60)], [21])
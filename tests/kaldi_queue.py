@@ -0,0 +1,149 @@
+import threading
+import time
+import unittest
+from unittest import mock
+
+class FakeWorker():
+    def __init__(self, hclg_path=None, ok=True, loaded=None, pid=None):
+        self.hclg_path = hclg_path
+        self.pid = pid if pid is not None else id(self)
+        self.ok = ok
+        self.killed = False
+        self.loaded = loaded # an Event to wait for, if not loaded straight away
+
+    def wait_ready(self, timeout=None):
+        from gentle.standard_kaldi import KaldiError
+        if self.loaded is not None:
+            self.loaded.wait()
+        if not self.ok:
+            raise KaldiError('failed to load')
+
+    def load_graph(self, hclg_path):
+        self.hclg_path = hclg_path
+        return True
+
+    def alive(self):
+        return not self.killed
+
+    def kill(self):
+        self.killed = True
+
+    def stop(self):
+        self.killed = True
+
+class Supervision(unittest.TestCase):
+
+    def supervisor(self, ok=True, **kwargs):
+        from gentle.kaldi_queue import Supervisor
+
+        class FakeSupervisor(Supervisor):
+            def _spawn(self):
+                return FakeWorker(ok=ok)
+        return FakeSupervisor(None, **kwargs)
+
+    def test_replace(self):
+        from gentle.kaldi_queue import KaldiQueue
+
+        sup = self.supervisor()
+        q = KaldiQueue([FakeWorker('a.fst')], supervisor=sup, ready=True, hclg_path='a.fst')
+        k = q.get()
+        q.replace(k)
+        self.assertTrue(k.killed)
+        # (the replacement starts without a graph, and loads the queue's)
+        new_k = q.get(timeout=5)
+        self.assertIsNot(new_k, k)
+        self.assertEqual(new_k.hclg_path, 'a.fst')
+        self.assertEqual(sup.stats()['restarts'], 1)
+
+    def test_dead_while_idle(self):
+        from gentle.kaldi_queue import KaldiQueue
+
+        sup = self.supervisor()
+        dead = FakeWorker()
+        dead.killed = True
+        q = KaldiQueue([dead], supervisor=sup, ready=True)
+        self.assertIsNot(q.get(timeout=5), dead)
+
+    def test_circuit_breaker(self):
+        from gentle.kaldi_queue import KaldiQueue
+
+        # replacements never start: give up after `max_failures`
+        sup = self.supervisor(ok=False, max_failures=3)
+        q = KaldiQueue([FakeWorker(ok=False)], supervisor=sup)
+        self.assertRaises(RuntimeError, q.get, timeout=5)
+        stats = sup.stats()
+        self.assertTrue(stats['circuit_open'])
+        self.assertEqual(stats['restarts'], 2)
+        self.assertEqual(stats['dropped'], 1)
+        self.assertEqual(q.size, 0)
+
+    def test_shared_process(self):
+        from gentle.kaldi_queue import KaldiQueue
+
+        # decoders of one k3 process fail together: that's one failure
+        sup = self.supervisor(max_failures=2)
+        q = KaldiQueue([FakeWorker(pid=1), FakeWorker(pid=1)], supervisor=sup, ready=True)
+        q.replace(q.get())
+        q.replace(q.get())
+        stats = sup.stats()
+        self.assertEqual(stats['recent_failures'], 1)
+        self.assertFalse(stats['circuit_open'])
+
+class Pool(unittest.TestCase):
+
+    def pool(self, workers):
+        from gentle import kaldi_queue
+
+        with mock.patch.object(kaldi_queue, 'spawn', return_value=workers):
+            return kaldi_queue.KaldiPool(None, nthreads=len(workers))
+
+    def test_drop_during_job(self):
+        pool = self.pool([FakeWorker(), FakeWorker()])
+        pool.supervisor.max_failures = 1 # no replacements
+
+        queue = pool.checkout('a.fst', nthreads=1)
+        queue.replace(queue.get())
+        pool.checkin(queue)
+        self.assertEqual(pool._idle.size, 1)
+
+        queue = pool.checkout('a.fst', nthreads=1)
+        queue.replace(queue.get())
+        pool.checkin(queue)
+        # nothing left: raise rather than wait
+        self.assertRaises(RuntimeError, pool.checkout, 'a.fst')
+
+        stopper = threading.Thread(target=pool.stop)
+        stopper.start()
+        stopper.join(5)
+        self.assertFalse(stopper.is_alive())
+
+    def test_warming_up(self):
+        # one worker is ready at once, the others once they've loaded
+        loaded = [threading.Event() for _ in range(3)]
+        workers = [FakeWorker()] + [FakeWorker(loaded=e) for e in loaded]
+        pool = self.pool(workers)
+
+        queue = pool.checkout('a.fst', nthreads=3)
+        self.assertEqual(queue.size, 1)
+        k = queue.get(timeout=5)
+        self.assertEqual(k.hclg_path, 'a.fst')
+        for e in loaded:
+            e.set()
+        # the job takes the next two that are ready, up to its 3...
+        deadline = time.time() + 5
+        while queue.size < 3 and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(queue.size, 3)
+        time.sleep(0.05)
+        self.assertEqual(queue.size, 3)
+        # ...and the last one stays in the pool
+        other = pool.checkout('b.fst', nthreads=1)
+        other_k = other.get(timeout=5)
+        self.assertEqual(other_k.hclg_path, 'b.fst')
+
+        queue.put(k)
+        other.put(other_k)
+        pool.checkin(queue)
+        pool.checkin(other)
+        pool.stop()
+        self.assertTrue(all(w.killed for w in workers))
@@ -0,0 +1,172 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+class GraphCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.proto_langdir = os.path.join(self.tmpdir, 'exp')
+        os.makedirs(os.path.join(self.proto_langdir, 'langdir'))
+        with open(os.path.join(self.proto_langdir, 'langdir', 'L.fst'), 'wb') as fh:
+            fh.write(b'lexicon')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def make_graph(self, size):
+        fd, path = tempfile.mkstemp(dir=self.tmpdir, suffix='_HCLG.fst')
+        os.write(fd, b'x' * size)
+        os.close(fd)
+        return path
+
+    def test_key(self):
+        from gentle.language_model import GraphCache
+
+        cache = GraphCache(os.path.join(self.tmpdir, 'cache'))
+        seq = ['i', 'am', 'sitting']
+        key = cache.key(seq, self.proto_langdir)
+
+        self.assertEqual(key, cache.key(list(seq), self.proto_langdir))
+        self.assertEqual(key, cache.key(seq, self.proto_langdir, disfluencies=['uh']))
+        self.assertNotEqual(key, cache.key(seq, self.proto_langdir, conservative=True))
+        self.assertNotEqual(key, cache.key(seq, self.proto_langdir, disfluency=True, disfluencies=['uh']))
+        self.assertNotEqual(key, cache.key(seq[:2], self.proto_langdir))
+
+        with open(os.path.join(self.proto_langdir, 'langdir', 'L.fst'), 'wb') as fh:
+            fh.write(b'another lexicon')
+        self.assertNotEqual(key, cache.key(seq, self.proto_langdir))
+
+    def test_lru(self):
+        from gentle.language_model import GraphCache
+
+        cache = GraphCache(os.path.join(self.tmpdir, 'cache'), max_bytes=250)
+        self.assertIsNone(cache.get('a'))
+        path_a = cache.put('a', self.make_graph(100))
+        path_b = cache.put('b', self.make_graph(100))
+        cache.unpin(path_a)
+        cache.unpin(path_b)
+        os.utime(path_a, (0, 0))
+        os.utime(path_b, (1, 1))
+        self.assertEqual(cache.get('a'), path_a) # now most recently used
+        cache.unpin(path_a)
+
+        cache.unpin(cache.put('c', self.make_graph(100)))
+        self.assertTrue(os.path.exists(path_a))
+        self.assertFalse(os.path.exists(path_b))
+        self.assertEqual(cache.stats(), {'hits': 1, 'misses': 1})
+
+    def test_pin(self):
+        from gentle.language_model import GraphCache
+
+        cache = GraphCache(os.path.join(self.tmpdir, 'cache'), max_bytes=250)
+        # a job has its graph, but hasn't checked out decoders yet...
+        path_a = cache.put('a', self.make_graph(100))
+        os.utime(path_a, (0, 0))
+        # ...when other jobs fill the cache
+        path_b = cache.put('b', self.make_graph(100))
+        cache.unpin(path_b)
+        os.utime(path_b, (1, 1))
+        cache.unpin(cache.put('c', self.make_graph(100)))
+        self.assertTrue(os.path.exists(path_a))
+        self.assertFalse(os.path.exists(path_b))
+
+        # pinned by each job that gets it
+        self.assertEqual(cache.get('a'), path_a)
+        os.utime(path_a, (0, 0))
+        cache.unpin(path_a)
+        cache.unpin(cache.put('d', self.make_graph(100)))
+        self.assertTrue(os.path.exists(path_a))
+
+        cache.unpin(path_a)
+        cache.unpin(cache.put('e', self.make_graph(100)))
+        self.assertFalse(os.path.exists(path_a))
+
+class BinaryGrammar(unittest.TestCase):
+
+    def read_as_text(self, data):
+        import array
+        import struct
+
+        self.assertEqual(data[:4], b'GBG1')
+        num_words, num_arcs, final_state = struct.unpack_from('=III', data, 4)
+        pos = 16
+        words = []
+        for i in range(num_words):
+            end = data.index(b'\0', pos)
+            words.append(data[pos:end].decode('utf-8'))
+            pos = end + 1
+        columns = []
+        for typecode in 'iiif':
+            column = array.array(typecode)
+            column.frombytes(data[pos:pos + num_arcs * column.itemsize])
+            pos += num_arcs * column.itemsize
+            columns.append(column)
+        self.assertEqual(pos, len(data))
+
+        lines = ['%d    %d    %s    %s    %f\n' % (f, t, words[l], words[l], w)
+                 for f, t, l, w in zip(*columns)]
+        lines.append('%d    0\n' % final_state)
+        return ''.join(lines).encode()
+
+    def test_matches_text(self):
+        import io
+        from gentle import language_model
+
+        seq = "i am sitting in a room different from the one you are in now i am".split()
+        for kwargs in [{}, {'conservative': True},
+                       {'disfluency': True, 'disfluencies': set(['uh', 'um'])}]:
+            fh = io.BytesIO()
+            language_model.write_bigram_lm_binary(seq, fh, **kwargs)
+            self.assertEqual(self.read_as_text(fh.getvalue()),
+                             language_model.make_bigram_lm_fst(seq, **kwargs))
+
+# Stands in for `m3 --server`: compiles anything but grammars named
+# "crash" (exits) and "hang" (never answers)
+FAKE_M3 = '''
+import os, sys, time
+while True:
+    cmd = sys.stdin.readline().strip()
+    if cmd != 'compile':
+        break
+    grammar = sys.stdin.readline().strip()
+    hclg = sys.stdin.readline().strip()
+    if os.path.basename(grammar) == 'crash':
+        sys.exit(1)
+    if os.path.basename(grammar) == 'hang':
+        time.sleep(60)
+    sys.stdout.write('ok\\n')
+    sys.stdout.flush()
+'''
+
+class MkgraphServer(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.m3 = os.path.join(self.tmpdir, 'm3')
+        with open(self.m3, 'w') as fh:
+            fh.write('#!%s\n%s' % (sys.executable, FAKE_M3))
+        os.chmod(self.m3, 0o755)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_restart(self):
+        from unittest import mock
+        from gentle import language_model
+
+        with mock.patch.object(language_model, 'MKGRAPH_PATH', self.m3):
+            server = language_model.MkgraphServer(self.tmpdir, nprocs=1, timeout=1)
+            server.compile('a', 'a.fst')
+            # a crash or a hang fails that compilation only...
+            self.assertRaises(RuntimeError, server.compile, 'crash', 'b.fst')
+            server.compile('a', 'a.fst')
+            self.assertRaises(RuntimeError, server.compile, 'hang', 'c.fst')
+            server.compile('a', 'a.fst')
+            # ...and so does dying between compilations
+            server._procs[0].kill()
+            server._procs[0].wait()
+            server.compile('a', 'a.fst')
+            server.stop()
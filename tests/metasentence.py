@@ -0,0 +1,44 @@
+import random
+import unittest
+
+class MetaSentence(unittest.TestCase):
+    vocab = set(['i', 'am', 'sitting', 'in', 'a', 'room', "don't", 'naïve'])
+
+    def test_tokenize(self):
+        from gentle.metasentence import MetaSentence
+
+        ms = MetaSentence(b'I am sitting in a Room, don\xe2\x80\x99t you know -- na\xc3\xafve', self.vocab)
+        self.assertEqual(ms.get_kaldi_sequence(),
+                         ['i', 'am', 'sitting', 'in', 'a', 'room', "don't", '<unk>', '<unk>', 'naïve'])
+        self.assertEqual(ms.get_display_sequence()[5:8], ['Room', 'don’t', 'you'])
+        self.assertEqual(ms.get_text_offsets()[:2], [(0, 1), (2, 4)])
+        self.assertEqual(len(ms), 10)
+
+    def test_slices(self):
+        # a sub-sentence is just like a MetaSentence of its part of the text
+        from gentle.metasentence import MetaSentence
+
+        rng = random.Random(0)
+        words = list(self.vocab) + ['Room', 'you', "'tis", 'x']
+        for _ in range(100):
+            text = ''
+            for _ in range(rng.randint(0, 20)):
+                text += rng.choice(words) + rng.choice([' ', ', ', ' -- ', '\n'])
+            ms = MetaSentence(text, self.vocab)
+            n = len(ms)
+            i = rng.randint(0, n)
+            j = rng.randint(i, n)
+
+            sub = ms[i:j]
+            if i < j:
+                start = ms.get_text_offsets()[i][0]
+                end = ms.get_text_offsets()[j - 1][1]
+                self.assertEqual(sub.raw_sentence, text[start:end])
+                self.assertEqual(ms.between(start, end).get_text_offsets(), sub.get_text_offsets())
+            expected = MetaSentence(sub.raw_sentence, self.vocab)
+            self.assertEqual(len(sub), j - i)
+            self.assertEqual(sub.get_kaldi_sequence(), expected.get_kaldi_sequence())
+            self.assertEqual(sub.get_display_sequence(), expected.get_display_sequence())
+            self.assertEqual(sub.get_text_offsets(), expected.get_text_offsets())
+            # ...and can be sliced in turn
+            self.assertEqual(sub[1:].get_kaldi_sequence(), expected.get_kaldi_sequence()[1:])
@@ -0,0 +1,126 @@
+import os
+import shutil
+import tempfile
+import unittest
+import wave
+from unittest import mock
+
+class FakeWorker():
+    def __init__(self, pool):
+        self.pool = pool
+
+    def push_region(self, path, offset, nsamples):
+        self.pool.regions.append((offset, nsamples))
+        return True
+
+    def get_final(self):
+        # recognizes every word of the graph, half a second each
+        return [{'word': wd, 'start': 0.5 * i, 'duration': 0.5, 'phones': []}
+                for i, wd in enumerate(self.pool.graph.split())]
+
+class FakePool():
+    '''Checkout/checkin like kaldi_queue.KaldiPool; the "graph" is the
+    region's transcript'''
+    def __init__(self):
+        self.regions = []
+
+    def checkout(self, hclg_path, nthreads=4, duration=None):
+        self.graph = hclg_path
+        return self
+
+    def checkin(self, queue):
+        pass
+
+    def get(self):
+        return FakeWorker(self)
+
+    def put(self, k):
+        pass
+
+class Realign(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.wavfile = os.path.join(self.tmpdir, 'a.wav')
+        wav = wave.open(self.wavfile, 'wb')
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(8000)
+        wav.writeframes(b'\0\0' * 8000 * 20)
+        wav.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _align(self, **kwargs):
+        from gentle import multipass
+        from gentle.metasentence import MetaSentence
+        from gentle.transcription import Word
+
+        transcript = 'one two three four five six seven'
+        ms = MetaSentence(transcript, set(transcript.split()))
+        offsets = ms.get_text_offsets()
+        found = {0: (0, 1), 3: (5, 6), 6: (12, 13)}
+        alignment = []
+        for i, wd in enumerate(ms.get_display_sequence()):
+            if i in found:
+                alignment.append(Word(case=Word.SUCCESS, word=wd, start=found[i][0], end=found[i][1],
+                                      startOffset=offsets[i][0], endOffset=offsets[i][1]))
+            else:
+                alignment.append(Word(case=Word.NOT_FOUND_IN_AUDIO, word=wd,
+                                      startOffset=offsets[i][0], endOffset=offsets[i][1]))
+
+        regions = multipass.prepare_multipass(alignment)
+        self.assertEqual([(r['start_idx'], r['end_idx']) for r in regions], [(1, 3), (4, 6)])
+
+        class Resources():
+            vocab = set(transcript.split())
+            proto_langdir = None
+
+        pool = FakePool()
+        progress = []
+        options = {'pool': pool, 'graph_cache': mock.Mock(), 'mkgraph': object()}
+        options.update(kwargs)
+        with mock.patch.object(multipass.language_model, 'make_bigram_language_model',
+                               side_effect=lambda ks, *args, **kwargs: ' '.join(ks)) as make_graph:
+            words = multipass.realign(self.wavfile, alignment, ms, Resources(), nthreads=1,
+                                      progress_cb=progress.append, **options)
+        # every graph from the cache is released
+        self.assertEqual(sorted(c.args[0] for c in options['graph_cache'].unpin.call_args_list),
+                         sorted(' '.join(c.args[0]) for c in make_graph.call_args_list))
+        self.assertEqual([wd.word for wd in words], transcript.split())
+        return words, pool, progress
+
+    def test_splice(self):
+        words, pool, _ = self._align()
+        self.assertTrue(all(wd.success() for wd in words))
+        # two..three in 1-5s, five..six in 6-12s
+        self.assertEqual([(wd.start, wd.end) for wd in words[1:3]], [(1, 1.5), (1.5, 2)])
+        self.assertEqual([(wd.start, wd.end) for wd in words[4:6]], [(6, 6.5), (6.5, 7)])
+        self.assertEqual(sorted(pool.regions), [(44 + 2 * 8000, 4 * 8000), (44 + 2 * 6 * 8000, 6 * 8000)])
+
+    def test_longest_first(self):
+        _, pool, progress = self._align()
+        self.assertEqual(pool.regions, [(44 + 2 * 6 * 8000, 6 * 8000), (44 + 2 * 8000, 4 * 8000)])
+        self.assertEqual(progress, [{'percent': 0.5, 'remaining': 4}, {'percent': 1, 'remaining': 0}])
+
+    def test_budget(self):
+        # only enough for the 6s region; the other is left as it was
+        words, pool, progress = self._align(max_audio=8)
+        self.assertEqual(pool.regions, [(44 + 2 * 6 * 8000, 6 * 8000)])
+        self.assertEqual([wd.success() for wd in words], [True, False, False, True, True, True, True])
+        self.assertEqual(progress[-1]['remaining'], 0)
+
+        words, pool, _ = self._align(budget=0)
+        self.assertEqual(pool.regions, [])
+        self.assertEqual([wd.success() for wd in words], [True, False, False, True, False, False, True])
+
+    def test_nothing_to_realign(self):
+        from gentle import multipass
+
+        # no region is long enough: no m3 or k3 is started
+        with mock.patch.object(multipass.language_model, 'MkgraphServer', side_effect=AssertionError), \
+             mock.patch.object(multipass.kaldi_queue, 'KaldiPool', side_effect=AssertionError):
+            words, pool, progress = self._align(pool=None, mkgraph=None, min_duration=10)
+        self.assertEqual([wd.success() for wd in words], [True, False, False, True, False, False, True])
+        self.assertEqual(progress, [])
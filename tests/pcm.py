@@ -0,0 +1,78 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+import wave
+
+class PCMBuffer(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.wavfile = os.path.join(self.tmpdir, 'a.wav')
+        self.samples = bytes(range(256)) * 125 # 2s at 8kHz
+        wav = wave.open(self.wavfile, 'wb')
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(8000)
+        wav.writeframes(self.samples)
+        wav.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_from_wavfile(self):
+        from gentle.pcm import PCMBuffer
+
+        with PCMBuffer.from_wavfile(self.wavfile) as pcm:
+            self.assertEqual(pcm.duration, 2.0)
+            self.assertEqual(pcm.rate, 8000)
+
+            offset, nsamples = pcm.region(1.5, 1.0)
+            self.assertEqual(nsamples, 4000)
+            with open(self.wavfile, 'rb') as fh:
+                fh.seek(offset)
+                self.assertEqual(fh.read(), self.samples[24000:])
+
+            wav = wave.open(self.wavfile, 'rb')
+            wav.setpos(4000)
+            self.assertEqual(bytes(pcm.frames(0.5, 0.25)), wav.readframes(2000))
+
+    def test_view(self):
+        from gentle.pcm import PCMBuffer
+
+        with PCMBuffer.from_wavfile(self.wavfile) as pcm:
+            with pcm.view(0.5, 1.0) as view:
+                self.assertEqual(view.path, pcm.path)
+                self.assertEqual(view.duration, 1.0)
+                self.assertEqual(bytes(view.frames(0.25, 0.5)), bytes(pcm.frames(0.75, 0.5)))
+            # clipped to the end
+            with pcm.view(1.5, 1.0) as view:
+                self.assertEqual(view.duration, 0.5)
+
+    def test_streamed(self):
+        from gentle.pcm import StreamedPCM
+
+        rawfile = os.path.join(self.tmpdir, 'a.raw')
+        pcm = StreamedPCM(rawfile)
+        def write():
+            with open(rawfile, 'wb') as fh:
+                for start in range(0, len(self.samples), 4000):
+                    fh.write(self.samples[start:start + 4000])
+                    fh.flush()
+                    pcm.extend((start + 4000) // 2)
+            pcm.finish()
+        writer = threading.Thread(target=write)
+        writer.start()
+
+        self.assertGreaterEqual(pcm.wait(4000), 4000)
+        first = pcm.frames(0, 0.5)
+        self.assertEqual(bytes(first), self.samples[:8000])
+        # the file is mapped again as it grows
+        self.assertEqual(pcm.wait_complete(), 16000)
+        self.assertEqual(pcm.duration, 2.0)
+        self.assertEqual(bytes(pcm.frames(1.5, 1.0)), self.samples[24000:])
+        self.assertEqual(bytes(first), self.samples[:8000])
+        writer.join()
+        first.release()
+        pcm.close()
@@ -0,0 +1,76 @@
+import threading
+import time
+import unittest
+from unittest import mock
+
+class FakeWorker():
+    def __init__(self):
+        self.hclg_path = None
+        self.killed = False
+
+    def wait_ready(self, timeout=None):
+        pass
+
+    def alive(self):
+        return not self.killed
+
+    def load_graph(self, hclg_path):
+        self.hclg_path = hclg_path
+        return True
+
+    def stop(self):
+        self.killed = True
+
+class Scheduler(unittest.TestCase):
+
+    def scheduler(self, nslots, policy):
+        from gentle import kaldi_queue
+        from gentle.scheduler import DecoderScheduler
+
+        workers = [FakeWorker() for _ in range(nslots)]
+        with mock.patch.object(kaldi_queue, 'spawn', return_value=workers):
+            return DecoderScheduler(None, nslots=nslots, policy=policy)
+
+    def contend(self, sched, first, jobs):
+        '''Has every job in `jobs` wait for the only decoder while `first`
+        holds it, then returns the order they get it in'''
+        k = first.get()
+        order = []
+        def get(job):
+            k = job.get()
+            order.append(job)
+            job.put(k)
+        threads = [threading.Thread(target=get, args=(job,)) for job in jobs]
+        for t in threads:
+            t.start()
+        while sum(job.waiting for job in jobs) < len(jobs):
+            time.sleep(0.01)
+        first.put(k)
+        for t in threads:
+            t.join(5)
+        return order
+
+    def test_shortest_job_first(self):
+        sched = self.scheduler(1, 'sjf')
+        first = sched.checkout('a.fst', duration=60)
+        long_job = sched.checkout('a.fst', duration=600)
+        short_job = sched.checkout('b.fst', duration=6)
+        self.assertEqual(self.contend(sched, first, [long_job, short_job]),
+                         [short_job, long_job])
+        for job in (first, long_job, short_job):
+            sched.checkin(job)
+        sched.stop()
+
+    def test_graph_affinity(self):
+        sched = self.scheduler(1, 'fair')
+        first = sched.checkout('a.fst')
+        other = sched.checkout('b.fst')
+        same = sched.checkout('a.fst')
+        # equal shares: the decoder already has a.fst loaded
+        self.assertEqual(self.contend(sched, first, [other, same]), [same, other])
+        stats = sched.stats()
+        self.assertEqual(stats['slots'], 1)
+        self.assertEqual([job['decoders'] for job in stats['jobs']], [0, 0, 0])
+        for job in (first, other, same):
+            sched.checkin(job)
+        sched.stop()
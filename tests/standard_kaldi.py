@@ -0,0 +1,89 @@
+import unittest
+
+class ResultFrame(unittest.TestCase):
+
+    def test_decode(self):
+        import struct
+        from gentle.standard_kaldi import decode_result, result_to_words
+
+        body = struct.pack('=IIf', 2, 3, 0.03)
+        body += struct.pack('=2i', 10, 20) # word start
+        body += struct.pack('=2i', 10, 5)  # word length
+        body += struct.pack('=2i', 2, 1)   # phones per word
+        body += struct.pack('=3i', 4, 6, 5)
+        body += b'i\0am\0ay_S\0ay_B\0ae_B\0'
+
+        words = result_to_words(decode_result(body))
+        self.assertEqual([w['word'] for w in words], ['i', 'am'])
+        self.assertEqual(words[1]['start'], 0.6)
+        self.assertEqual(words[1]['duration'], 0.15)
+        self.assertEqual(words[0]['phones'], [
+            {'phone': 'ay_S', 'duration': 0.12},
+            {'phone': 'ay_B', 'duration': 0.18}])
+        self.assertEqual(words[1]['phones'], [{'phone': 'ae_B', 'duration': 0.15}])
+
+    def test_decode_empty(self):
+        import struct
+        from gentle.standard_kaldi import decode_result, result_to_words
+
+        self.assertEqual(result_to_words(decode_result(struct.pack('=IIf', 0, 0, 0.03))), [])
+
+class Protocol(unittest.TestCase):
+
+    def test_read_reply(self):
+        import io
+        from gentle.rpc import RPCProtocol, RPCError
+
+        recv = io.BytesIO(b'9\n200\nbody\n\n5\n500\nx\n')
+        rpc = RPCProtocol(io.BytesIO(), recv)
+        self.assertEqual(rpc.read_reply(), (b'body\n', 200))
+        self.assertRaises(RPCError, rpc.read_reply)
+
+class Stream(unittest.TestCase):
+
+    def make_kaldi(self, partials, final):
+        from gentle.standard_kaldi import Kaldi
+
+        k = Kaldi.__new__(Kaldi)
+        k.finished = True
+        partials = iter(partials)
+        k.push_chunk = lambda buf: True
+        k.get_partial = lambda: next(partials)
+        k.get_final = lambda: final
+        return k
+
+    def test_stable_words(self):
+        def wd(word, start):
+            return {'word': word, 'start': start, 'duration': 0.3, 'phones': []}
+
+        partials = [
+            [wd('i', 0.1)],
+            [wd('i', 0.1), wd('and', 0.5)],
+            [wd('i', 0.1), wd('am', 0.5)],
+            [wd('i', 0.1), wd('am', 0.5), wd('sit', 1.0)],
+        ]
+        final = [wd('i', 0.1), wd('am', 0.5), wd('sitting', 1.0)]
+        k = self.make_kaldi(partials, final)
+
+        chunk = b'\0\0' * 4000 # 0.5s
+        stream = k.stream([chunk] * 4)
+        self.assertEqual(next(stream)['word'], 'i')  # after the 2nd chunk
+        self.assertEqual(next(stream)['word'], 'am') # after the 4th
+        self.assertEqual([w['word'] for w in stream], ['sitting'])
+
+class Deadline(unittest.TestCase):
+
+    def test_hung_worker(self):
+        import subprocess
+        import sys
+        from gentle.standard_kaldi import Kaldi, KaldiError
+
+        p = subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(30)'],
+                             stdin=subprocess.PIPE, stdout=subprocess.PIPE, bufsize=0)
+        k = Kaldi.__new__(Kaldi)
+        k._attach(p, p.stdin, p.stdout, None)
+        k.timeout = 0.1
+        self.assertRaises(KaldiError, k.push_region, '/dev/null', 0, 0)
+        self.assertFalse(k.alive())
+        self.assertIsNotNone(p.poll())
+        k.stop()
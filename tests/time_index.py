@@ -0,0 +1,49 @@
+import random
+import unittest
+
+class TimeIndex(unittest.TestCase):
+
+    def transcription(self):
+        from gentle.transcription import Transcription, Word
+
+        words = [
+            Word(case='success', word='one', start=0.0, end=0.5,
+                 phones=[{'phone': 'w_B', 'duration': 0.2}, {'phone': 'ah_I', 'duration': 0.1}, {'phone': 'n_E', 'duration': 0.2}]),
+            Word(case='not-found-in-audio', word='two'),
+            Word(case='success', word='three', start=1.0, end=2.0, phones=[]),
+            Word(case='success', word='four', start=1.5, end=1.7,
+                 phones=[{'phone': 'f_B', 'duration': 0.1}, {'phone': 'ao_E', 'duration': 0.1}]),
+        ]
+        return Transcription(transcript='one two three four', words=words)
+
+    def test_queries(self):
+        index = self.transcription().time_index()
+        self.assertEqual(index.word_indices(0), [0])
+        self.assertEqual(index.word_indices(0.5), [])
+        self.assertEqual(index.word_indices(1.6), [2, 3])
+        self.assertEqual(index.word_indices(0.4, 1.1), [0, 2])
+        self.assertEqual(index.word_indices(2.0, 3.0), [])
+        self.assertEqual([wd.word for wd in index.words_at(1.8)], ['three'])
+
+        self.assertEqual([ph['phone'] for ph in index.phones_at(0.25)], ['ah_I'])
+        self.assertEqual([(ph['phone'], ph['wordIndex']) for ph in index.phones_at(0.35, 1.55)],
+                         [('n_E', 0), ('f_B', 3)])
+
+    def test_random(self):
+        # same as looking through all the words
+        from gentle.time_index import TimeIndex
+        from gentle.transcription import Transcription, Word
+
+        rng = random.Random(0)
+        words = []
+        for _ in range(300):
+            start = rng.uniform(0, 100)
+            words.append(Word(case='success', word='x', start=start, end=start + rng.uniform(0, 5)))
+        index = TimeIndex(Transcription(words=words))
+        for _ in range(200):
+            t1 = rng.uniform(-5, 105)
+            t2 = t1 + rng.uniform(0, 10)
+            self.assertEqual(index.word_indices(t1),
+                             [i for i, wd in enumerate(words) if wd.start <= t1 < wd.end])
+            self.assertEqual(index.word_indices(t1, t2),
+                             [i for i, wd in enumerate(words) if wd.start < t2 and wd.end > t1])
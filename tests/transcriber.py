@@ -1,5 +1,8 @@
 import os
+import shutil
+import tempfile
 import unittest
+import wave
 
 class Aligner(unittest.TestCase):
     audio = 'examples/data/lucier.mp3'
@@ -34,3 +37,93 @@ class Aligner(unittest.TestCase):
         self.assertEqual(words[0].word, "i")
         self.assertEqual(words[1].word, "am")
         self.assertEqual(words[1].case, Word.SUCCESS)        
+
+class FakeQueue():
+    def __init__(self, k):
+        self.free = [k]
+
+    def get(self):
+        return self.free.pop()
+
+    def put(self, k):
+        self.free.append(k)
+
+class BadRegion():
+    def push_region(self, path, offset, nsamples):
+        return False # as k3 says when it can't read the region
+
+    def get_final(self):
+        return []
+
+class Decode(unittest.TestCase):
+
+    def test_unreadable_region(self):
+        from gentle.standard_kaldi import KaldiError
+        from gentle.transcriber import MultiThreadedTranscriber
+
+        queue = FakeQueue(BadRegion())
+        replaced = []
+        def replace(k):
+            replaced.append(k)
+            queue.put(BadRegion())
+        queue.replace = replace
+        mtt = MultiThreadedTranscriber(queue, nthreads=1, attempts=2)
+
+        # not an empty chunk: an error, once each worker has tried
+        self.assertRaises(KaldiError, mtt._decode, '/nonexistent', 0, 8000)
+        self.assertEqual(len(replaced), 2)
+
+class Stream(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.wavfile = os.path.join(self.tmpdir, 'a.wav')
+        wav = wave.open(self.wavfile, 'wb')
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(8000)
+        wav.writeframes(b'\0\0' * 8000 * 5)
+        wav.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def make_kaldi(self):
+        from gentle.standard_kaldi import Kaldi
+
+        # hears a word in each region pushed since the last utterance ended
+        k = Kaldi.__new__(Kaldi)
+        k.finished = True
+        k.pushed = []
+        def push_region(path, offset, nsamples):
+            k.pushed.append(offset)
+            return True
+        def get_partial():
+            return [{'word': 'w%d' % i, 'start': i * 0.5, 'duration': 0.1, 'phones': []}
+                    for i in range(len(k.pushed))]
+        def get_final():
+            words = get_partial()
+            k.pushed = []
+            return words
+        k.push_region = push_region
+        k.get_partial = get_partial
+        k.get_final = get_final
+        return k
+
+    def test_stop_early(self):
+        from gentle.transcriber import MultiThreadedTranscriber
+
+        k = self.make_kaldi()
+        queue = FakeQueue(k)
+        mtt = MultiThreadedTranscriber(queue, nthreads=1)
+
+        stream = mtt.transcribe_stream(self.wavfile)
+        self.assertEqual(next(stream).word, 'w0')
+        stream.close()
+        # the worker is back, with its utterance ended
+        self.assertEqual(queue.free, [k])
+        self.assertEqual(k.pushed, [])
+
+        # so the next decode starts from scratch
+        words = list(mtt.transcribe_stream(self.wavfile))
+        self.assertEqual([wd.word for wd in words], ['w%d' % i for i in range(10)])
@@ -0,0 +1,114 @@
+import copy
+import pickle
+import unittest
+
+WORDS = [
+    {'case': 'success', 'word': 'hello', 'alignedWord': 'hello', 'startOffset': 0, 'endOffset': 5,
+     'start': 0.5, 'end': 0.9, 'phones': [{'phone': 'hh_B', 'duration': 0.1}, {'phone': 'ah_E', 'duration': 0.3}]},
+    {'case': 'not-found-in-audio', 'word': 'there', 'startOffset': 6, 'endOffset': 11},
+    {'case': 'success', 'word': 'world', 'alignedWord': '<unk>', 'startOffset': 12, 'endOffset': 17,
+     'start': 1.5, 'end': 2.0, 'phones': []},
+]
+
+class Columns(unittest.TestCase):
+
+    def test_slots(self):
+        from gentle.transcription import Word
+
+        wd = Word(**WORDS[0])
+        with self.assertRaises(AttributeError):
+            wd.extra = 1
+        self.assertEqual(copy.deepcopy(wd), wd)
+        self.assertEqual(pickle.loads(pickle.dumps(wd)), wd)
+        self.assertNotEqual(wd, Word(**WORDS[2]))
+
+    def test_view(self):
+        from gentle.transcription import Transcription, Word, WordColumns
+
+        words = [Word(**wd) for wd in WORDS]
+        columns = WordColumns.from_words(words)
+        self.assertEqual(len(columns), 3)
+        self.assertEqual(columns, words)
+        self.assertEqual([wd.as_dict() for wd in columns], [wd.as_dict() for wd in words])
+        self.assertEqual(repr(columns[-1]), repr(words[-1]))
+        self.assertIsNone(columns[1].start)
+        self.assertIsNone(columns[1].phones)
+        self.assertEqual(columns[2].phones, [])
+
+        # writes go to the columns
+        columns[1].start = 1.0
+        self.assertEqual(columns[1].start, 1.0)
+        columns[1].start = None
+        columns[0].swap_alignment(columns[1])
+        columns[1].swap_alignment(columns[0])
+        self.assertEqual(columns.to_words(), words)
+
+        trans = Transcription(transcript='hello there world', words=words)
+        self.assertEqual(trans.columnar().to_json(), trans.to_json())
+        self.assertEqual(trans.columnar().stats(), trans.stats())
+        self.assertEqual(Transcription.from_json(trans.to_json(), columnar=True), trans)
+
+    def test_vectorized(self):
+        from gentle.transcription import Word, WordColumns
+
+        words = [Word(**wd) for wd in WORDS]
+        columns = WordColumns.from_words(words).shift(time=10, offset=100)
+        self.assertEqual(columns, [wd.shift(time=10, offset=100) for wd in words])
+        self.assertEqual(columns.stats(), {'total': 3, 'success': 2, 'not-found-in-audio': 1})
+        self.assertEqual(columns.select(Word.NOT_FOUND_IN_AUDIO), [words[1]])
+
+class Write(unittest.TestCase):
+
+    def test_write(self):
+        import io
+        import json
+        from gentle.transcription import INLINE_JSON, Transcription, Word
+
+        template = '<script>\n%s\nrender();\n</script>\n' % INLINE_JSON
+        words = [Word(**wd) for wd in WORDS] + [Word(case='success', word='</script>', start=3, end=4)]
+        for trans in (Transcription(transcript='hello there world', words=words),
+                      Transcription(transcript='hello there world', words=words).columnar(),
+                      Transcription(transcript='hello', words=[]),
+                      Transcription()):
+            jsfile, csvfile, htmlfile = io.StringIO(), io.StringIO(), io.StringIO()
+            trans.write(json_file=jsfile, csv_file=csvfile, html_file=htmlfile, html_template=template)
+            self.assertEqual(jsfile.getvalue(), trans.to_json(indent=2))
+            self.assertEqual(csvfile.getvalue(), trans.to_csv())
+
+            html = htmlfile.getvalue()
+            self.assertTrue(html.startswith('<script>\nvar INLINE_JSON='))
+            self.assertTrue(html.endswith(';\nrender();\n</script>\n'))
+            inline = html[len('<script>\nvar INLINE_JSON='):-len(';\nrender();\n</script>\n')]
+            self.assertNotIn('</script>', inline)
+            self.assertEqual(json.loads(inline), trans.to_dict())
+
+class Binary(unittest.TestCase):
+
+    def test_roundtrip(self):
+        import os
+        import tempfile
+        from gentle.alignment_file import AlignmentFile
+        from gentle.transcription import Transcription, Word
+
+        words = [Word(**wd) for wd in WORDS] + [Word(case='success', word='hello', start=0.7, end=3.0)]
+        trans = Transcription(transcript='hello there world hello', words=words)
+        fd, path = tempfile.mkstemp(suffix='.bin')
+        try:
+            with os.fdopen(fd, 'wb') as fh:
+                trans.to_binary(fh)
+            self.assertEqual(Transcription.from_binary(path), trans)
+            self.assertEqual(Transcription.from_binary(path, columnar=True), trans)
+
+            with AlignmentFile(path) as af:
+                self.assertEqual(len(af), 4)
+                self.assertEqual(af.transcript, trans.transcript)
+                self.assertEqual(af[2], words[2])
+                self.assertEqual(af[-1], words[-1])
+                self.assertEqual(af.indices_between(0, 0.5), [])
+                self.assertEqual(af.indices_between(0.8, 1.0), [0, 3])
+                self.assertEqual(af.indices_between(1.0, 1.6), [2, 3])
+                self.assertEqual(af.between(2.5, 10), [words[3]])
+                with self.assertRaises(IndexError):
+                    af[4]
+        finally:
+            os.unlink(path)
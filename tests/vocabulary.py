@@ -0,0 +1,61 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+class Vocabulary(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.words_path = os.path.join(self.tmpdir, 'words.txt')
+        self.words = ['<eps>', '!sil', 'a', "it's", 'naïve', 'zebra'] + ['w%d' % i for i in range(1000)]
+        with open(self.words_path, 'w') as fh:
+            for i, word in enumerate(self.words):
+                fh.write('%s %d\n' % (word, i))
+
+    def tearDown(self):
+        os.chmod(self.tmpdir, 0o755)
+        shutil.rmtree(self.tmpdir)
+
+    def test_lookup(self):
+        from gentle import metasentence, vocabulary
+
+        with open(self.words_path) as fh:
+            expected = metasentence.load_vocabulary(fh)
+        vocab = vocabulary.load(self.words_path)
+        self.assertTrue(os.path.exists(self.words_path + '.idx'))
+        self.assertEqual(len(vocab), len(expected))
+        self.assertEqual(set(vocab), expected)
+        for word in ['a', "it's", 'naïve', 'w999', 'zebra']:
+            self.assertIn(word, vocab)
+        for word in ['b', 'naive', 'w1000', '', 'zebra ', None]:
+            self.assertNotIn(word, vocab)
+
+        # from the index this time
+        self.assertEqual(set(vocabulary.load(self.words_path)), expected)
+
+    def test_recompile(self):
+        from gentle import vocabulary
+
+        vocabulary.load(self.words_path)
+        with open(self.words_path, 'a') as fh:
+            fh.write('yak 1006\n')
+        st = os.stat(self.words_path + '.idx')
+        os.utime(self.words_path, (st.st_atime + 10, st.st_mtime + 10))
+        self.assertIn('yak', vocabulary.load(self.words_path))
+
+    @unittest.skipIf(hasattr(os, 'geteuid') and os.geteuid() == 0, "root can write anywhere")
+    def test_read_only(self):
+        from gentle import vocabulary
+
+        os.chmod(self.tmpdir, 0o555)
+        self.assertIn('zebra', vocabulary.load(self.words_path))
+        self.assertFalse(os.path.exists(self.words_path + '.idx'))
+
+    def test_lazy_import(self):
+        out = subprocess.check_output([sys.executable, '-c',
+            'import sys, gentle; print("gentle.forced_aligner" in sys.modules); '
+            'gentle.ForcedAligner; print("gentle.forced_aligner" in sys.modules)'])
+        self.assertEqual(out.split(), [b'False', b'True'])